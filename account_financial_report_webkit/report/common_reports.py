@@ -22,6 +22,7 @@
 # TODO refactor helper in order to act more like mixin
 # By using properties we will have a more simple signature in fuctions
 
+import itertools
 import logging
 
 from openerp.osv import osv
@@ -34,6 +35,52 @@ _logger = logging.getLogger('financial.reports.webkit')
 
 MAX_MONSTER_SLICE = 50000
 
+MOVE_LINE_DATAS_COLUMNS = """l.id AS id,
+            l.date AS ldate,
+            j.code AS jcode ,
+            j.type AS jtype,
+            l.currency_id,
+            l.account_id,
+            l.amount_currency,
+            l.ref AS lref,
+            l.name AS lname,
+            COALESCE(l.debit, 0.0) - COALESCE(l.credit, 0.0) AS balance,
+            l.debit,
+            l.credit,
+            l.period_id AS lperiod_id,
+            per.code as period_code,
+            per.special AS peropen,
+            l.partner_id AS lpartner_id,
+            p.name AS partner_name,
+            m.name AS move_name,
+            COALESCE(partialrec.name, fullrec.name, '') AS rec_name,
+            COALESCE(partialrec.id, fullrec.id, NULL) AS rec_id,
+            m.id AS move_id,
+            c.name AS currency_code,
+            i.id AS invoice_id,
+            i.type AS invoice_type,
+            i.number AS invoice_number,
+            l.date_maturity"""
+
+MOVE_LINE_DATAS_FROM = """FROM account_move_line l
+    JOIN account_move m on (l.move_id=m.id)
+    LEFT JOIN res_currency c on (l.currency_id=c.id)
+    LEFT JOIN account_move_reconcile partialrec
+        on (l.reconcile_partial_id = partialrec.id)
+    LEFT JOIN account_move_reconcile fullrec on (l.reconcile_id = fullrec.id)
+    LEFT JOIN res_partner p on (l.partner_id=p.id)
+    LEFT JOIN account_invoice i on (m.id =i.move_id)
+    LEFT JOIN account_period per on (per.id=l.period_id)
+    JOIN account_journal j on (l.journal_id=j.id)"""
+
+MOVE_LINE_DATAS_QUERY = """
+SELECT %s
+%s""" % (MOVE_LINE_DATAS_COLUMNS, MOVE_LINE_DATAS_FROM)
+
+# names of the server side cursors of _iter_query() and of the temporary
+# tables of _iter_move_line_datas()
+_cursor_sequence = itertools.count()
+
 
 class CommonReportHeaderWebkit(common_report_header):
 
@@ -505,58 +552,128 @@ class CommonReportHeaderWebkit(common_report_header):
             raise osv.except_osv(
                 _('No valid filter'), _('Please set a valid time filter'))
 
-    def _get_move_line_datas(self, move_line_ids,
-                             order='per.special DESC, l.date ASC, \
-                             per.date_start ASC, m.name ASC'):
-        # Possible bang if move_line_ids is too long
-        # We can not slice here as we have to do the sort.
-        # If slice has to be done it means that we have to reorder in python
-        # after all is finished. That quite crapy...
-        # We have a defective desing here (mea culpa) that should be fixed
-        #
-        # TODO improve that by making a better domain or if not possible
-        # by using python sort
+    def _get_move_lines_domain(self, account_ids, main_filter, start, stop,
+                               target_move):
+        """Get the domain of the move lines of accounts based on form
+        data, as get_move_lines_ids() does for one account, or None if
+        there are no periods between start and stop"""
+        if main_filter in ('filter_period', 'filter_no'):
+            period_obj = self.pool.get('account.period')
+            periods = period_obj.build_ctx_periods(
+                self.cursor, self.uid, start.id, stop.id)
+            if not periods:
+                return None
+            domain = [('period_id', 'in', periods)]
+        elif main_filter == 'filter_date':
+            domain = [('date', '>=', start), ('date', '<=', stop)]
+        else:
+            raise osv.except_osv(
+                _('No valid filter'), _('Please set a valid time filter'))
+        domain.append(('account_id', 'in', account_ids))
+        if target_move == 'posted':
+            domain.append(('move_id.state', '=', 'posted'))
+        return domain
+
+    def _get_move_lines_subquery(self, column, account_ids, main_filter,
+                                 start, stop, target_move):
+        """Get the query selecting a column of the move lines of accounts
+        based on form data (see _get_move_lines_domain()), with the record
+        rules of the user, as (sql, params), or None if there are no
+        move lines"""
+        if not account_ids:
+            return None
+        domain = self._get_move_lines_domain(
+            account_ids, main_filter, start, stop, target_move)
+        if domain is None:
+            return None
+        move_line_obj = self.pool.get('account.move.line')
+        query = move_line_obj._where_calc(self.cursor, self.uid, domain)
+        move_line_obj._apply_ir_rules(self.cursor, self.uid, query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        sql = "SELECT account_move_line.%s FROM %s WHERE %s" % (
+            column, from_clause, where_clause or 'TRUE')
+        return sql, params
+
+    def _iter_query(self, sql, params, size=MAX_MONSTER_SLICE):
+        """Execute a query in a server side cursor and yield its rows as
+        dictionaries, fetching them size rows at a time, so the result is
+        never held in memory at once"""
+        name = 'webkit_report_%d' % next(_cursor_sequence)
+        self.cursor.execute(
+            "DECLARE %s NO SCROLL CURSOR FOR %s" % (name, sql), params)
+        try:
+            while True:
+                self.cursor.execute("FETCH FORWARD %d FROM %s" % (size, name))
+                rows = self.cursor.dictfetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        except GeneratorExit:
+            # the rows are not consumed until the end
+            self.cursor.execute("CLOSE %s" % name)
+            raise
+        self.cursor.execute("CLOSE %s" % name)
+
+    def _iter_accounts_move_line_datas(
+            self, account_ids, main_filter, start, stop, target_move,
+            order='per.special DESC, l.date ASC, per.date_start ASC, '
+                  'm.name ASC'):
+        """Iterate over the move line datas (see _get_move_line_datas())
+        of several accounts, ordered by account then by order.
+
+        Move lines are selected on the server, with one query streamed
+        in a server side cursor, instead of searching the move line ids of
+        each account and sending them back to the database."""
+        subquery = self._get_move_lines_subquery(
+            'id', account_ids, main_filter, start, stop, target_move)
+        if subquery is None:
+            return iter([])
+        subquery_sql, params = subquery
+        sql = MOVE_LINE_DATAS_QUERY + """
+    WHERE l.id IN (%s)
+    ORDER BY l.account_id, %s""" % (subquery_sql, order)
+        return self._iter_query(sql, params)
+
+    def _iter_move_line_datas(self, move_line_ids,
+                              order='per.special DESC, l.date ASC, '
+                                    'per.date_start ASC, m.name ASC'):
+        """Iterate over the datas of move lines, sorted by order.
+
+        Above MAX_MONSTER_SLICE ids, the ids are sent in slices of
+        MAX_MONSTER_SLICE ids to a temporary table, and the datas of all
+        move lines are sorted by the database in one query streamed in a
+        server side cursor, so the ids and the result are never sent at
+        once, and lines are sorted with the collation of the database
+        whatever their number."""
         if not move_line_ids:
-            return []
+            return iter([])
         if not isinstance(move_line_ids, list):
             move_line_ids = [move_line_ids]
-        monster = """
-SELECT l.id AS id,
-            l.date AS ldate,
-            j.code AS jcode ,
-            j.type AS jtype,
-            l.currency_id,
-            l.account_id,
-            l.amount_currency,
-            l.ref AS lref,
-            l.name AS lname,
-            COALESCE(l.debit, 0.0) - COALESCE(l.credit, 0.0) AS balance,
-            l.debit,
-            l.credit,
-            l.period_id AS lperiod_id,
-            per.code as period_code,
-            per.special AS peropen,
-            l.partner_id AS lpartner_id,
-            p.name AS partner_name,
-            m.name AS move_name,
-            COALESCE(partialrec.name, fullrec.name, '') AS rec_name,
-            COALESCE(partialrec.id, fullrec.id, NULL) AS rec_id,
-            m.id AS move_id,
-            c.name AS currency_code,
-            i.id AS invoice_id,
-            i.type AS invoice_type,
-            i.number AS invoice_number,
-            l.date_maturity
-FROM account_move_line l
-    JOIN account_move m on (l.move_id=m.id)
-    LEFT JOIN res_currency c on (l.currency_id=c.id)
-    LEFT JOIN account_move_reconcile partialrec
-        on (l.reconcile_partial_id = partialrec.id)
-    LEFT JOIN account_move_reconcile fullrec on (l.reconcile_id = fullrec.id)
-    LEFT JOIN res_partner p on (l.partner_id=p.id)
-    LEFT JOIN account_invoice i on (m.id =i.move_id)
-    LEFT JOIN account_period per on (per.id=l.period_id)
-    JOIN account_journal j on (l.journal_id=j.id)
+        if len(move_line_ids) <= MAX_MONSTER_SLICE:
+            return iter(self._get_move_line_datas_slice(move_line_ids, order))
+        return self._iter_move_line_datas_table(move_line_ids, order)
+
+    def _iter_move_line_datas_table(self, move_line_ids, order):
+        table = 'webkit_report_ids_%d' % next(_cursor_sequence)
+        self.cursor.execute(
+            "CREATE TEMPORARY TABLE %s (id integer) ON COMMIT DROP" % table)
+        try:
+            for i in range(0, len(move_line_ids), MAX_MONSTER_SLICE):
+                self.cursor.execute(
+                    "INSERT INTO %s (id) SELECT unnest(%%s)" % table,
+                    (move_line_ids[i:i + MAX_MONSTER_SLICE],))
+            self.cursor.execute("ANALYZE %s" % table)
+            sql = MOVE_LINE_DATAS_QUERY + """
+    WHERE l.id IN (SELECT id FROM %s)
+    ORDER BY %s""" % (table, order)
+            for row in self._iter_query(sql, None):
+                yield row
+        finally:
+            self.cursor.execute("DROP TABLE IF EXISTS %s" % table)
+
+    def _get_move_line_datas_slice(self, move_line_ids, order):
+        monster = MOVE_LINE_DATAS_QUERY + """
     WHERE l.id in %s"""
         monster += (" ORDER BY %s" % (order,))
         try:
@@ -567,34 +684,61 @@ FROM account_move_line l
             raise
         return res or []
 
-    def _get_moves_counterparts(self, move_ids, account_id, limit=3):
-        if not move_ids:
-            return {}
-        if not isinstance(move_ids, list):
-            move_ids = [move_ids]
+    def _get_move_line_datas(self, move_line_ids,
+                             order='per.special DESC, l.date ASC, \
+                             per.date_start ASC, m.name ASC'):
+        """Get the datas of move lines, sorted by order (see
+        _iter_move_line_datas())"""
+        return list(self._iter_move_line_datas(move_line_ids, order=order))
+
+    def _get_moves_account_codes(self, moves_clause, params):
+        """Get the codes of the accounts of moves, as {move_id: sorted list
+        of account codes}, in one pass grouped by move. moves_clause is
+        the right operand of move_id IN, a subquery or a parameter."""
         sql = """
-SELECT account_move.id,
-       array_to_string(
-          ARRAY(SELECT DISTINCT a.code
-                FROM account_move_line m2
-                  LEFT JOIN account_account a ON (m2.account_id=a.id)
-                WHERE m2.move_id =account_move_line.move_id
-                  AND m2.account_id<>%s limit %s) , ', ')
-
-FROM account_move
-        JOIN account_move_line
-            on (account_move_line.move_id = account_move.id)
-        JOIN account_account
-            on (account_move_line.account_id = account_account.id)
-WHERE move_id in %s"""
-
+SELECT l.move_id, array_agg(DISTINCT a.code)
+FROM account_move_line l
+    JOIN account_account a ON (l.account_id = a.id)
+WHERE l.move_id IN %s
+GROUP BY l.move_id""" % (moves_clause,)
         try:
-            self.cursor.execute(sql, (account_id, limit, tuple(move_ids)))
+            self.cursor.execute(sql, params)
             res = self.cursor.fetchall()
         except Exception:
             self.cursor.rollback()
             raise
-        return res and dict(res) or {}
+        return dict(res)
+
+    def _get_accounts_moves_account_codes(self, account_ids, main_filter,
+                                          start, stop, target_move):
+        """Get the account codes (see _get_moves_account_codes()) of the
+        moves of the move lines of accounts based on form data, for all
+        accounts at once"""
+        subquery = self._get_move_lines_subquery(
+            'move_id', account_ids, main_filter, start, stop, target_move)
+        if subquery is None:
+            return {}
+        subquery_sql, params = subquery
+        return self._get_moves_account_codes('(%s)' % subquery_sql, params)
+
+    def _get_counterparts(self, account_codes, account_code, limit=3):
+        """Get the counterparts of a move line of an account, from the
+        account codes of its move"""
+        return ', '.join([code for code in account_codes
+                          if code != account_code][:limit])
+
+    def _get_moves_counterparts(self, move_ids, account_id, limit=3):
+        if not move_ids:
+            return {}
+        if not isinstance(move_ids, list):
+            move_ids = [move_ids]
+        account_codes = self._get_moves_account_codes(
+            '%s', (tuple(move_ids),))
+        account_code = self.pool.get('account.account').browse(
+            self.cursor, self.uid, account_id).code
+        return dict((move_id, self._get_counterparts(codes, account_code,
+                                                     limit=limit))
+                    for move_id, codes in account_codes.iteritems())
 
     def is_initial_balance_enabled(self, main_filter):
         if main_filter not in ('filter_no', 'filter_year', 'filter_period'):
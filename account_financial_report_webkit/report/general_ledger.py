@@ -210,24 +210,29 @@ class GeneralLedgerWebkit(report_sxw.rml_parse, CommonReportHeaderWebkit):
     def _compute_account_ledger_lines(self, accounts_ids,
                                       init_balance_memoizer, main_filter,
                                       target_move, start, stop):
-        res = {}
-        for acc_id in accounts_ids:
-            move_line_ids = self.get_move_lines_ids(
-                acc_id, main_filter, start, stop, target_move)
-            if not move_line_ids:
-                res[acc_id] = []
-                continue
-
-            lines = self._get_ledger_lines(move_line_ids, acc_id)
-            res[acc_id] = lines
+        """Get the ledger lines of all accounts with one query, streamed
+        and split by account on the fly"""
+        res = dict((acc_id, []) for acc_id in accounts_ids)
+        # counterparts are computed once for the moves of all accounts
+        account_codes = self._get_accounts_moves_account_codes(
+            accounts_ids, main_filter, start, stop, target_move)
+        accounts = self.pool.get('account.account').browse(
+            self.cursor, self.uid, accounts_ids)
+        codes = dict((account.id, account.code) for account in accounts)
+        lines = self._iter_accounts_move_line_datas(
+            accounts_ids, main_filter, start, stop, target_move)
+        for acc_id, account_lines in groupby(lines, itemgetter('account_id')):
+            account_lines = list(account_lines)
+            for line in account_lines:
+                line['counterparts'] = self._get_counterparts(
+                    account_codes.get(line['move_id'], []), codes[acc_id])
+            res[acc_id] = account_lines
         return res
 
     def _get_ledger_lines(self, move_line_ids, account_id):
         if not move_line_ids:
             return []
         res = self._get_move_line_datas(move_line_ids)
-        # computing counter part is really heavy in term of ressouces
-        # consuption looking for a king of SQL to help me improve it
         move_ids = [x.get('move_id') for x in res]
         counter_parts = self._get_moves_counterparts(move_ids, account_id)
         for line in res:
@@ -250,13 +250,17 @@ class PartnersOpenInvoicesWebkit(report_sxw.rml_parse,
                         partner_line_ids, date_stop, date_until)
                     partner_line_ids += clearance_line_ids
 
-                lines = self._get_move_line_datas(list(set(partner_line_ids)))
-                for line in lines:
-                    if line['id'] in initial_move_lines_ids_per_partner.\
-                            get(partner_id, []):
+                initial_line_ids = set(
+                    initial_move_lines_ids_per_partner.get(partner_id, []))
+                clearance_line_ids = set(clearance_line_ids)
+                lines = []
+                for line in self._iter_move_line_datas(
+                        list(set(partner_line_ids))):
+                    if line['id'] in initial_line_ids:
                         line['is_from_previous_periods'] = True
                     if line['id'] in clearance_line_ids:
                         line['is_clearance_line'] = True
+                    lines.append(line)
 
                 res[account_id][partner_id] = lines
         return res
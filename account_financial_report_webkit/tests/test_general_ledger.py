@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from openerp.tests import common
+
+from ..report import common_reports
+from ..report.general_ledger import GeneralLedgerWebkit
+
+
+class TestGeneralLedger(common.TransactionCase):
+
+    def setUp(self):
+        super(TestGeneralLedger, self).setUp()
+        self.report = GeneralLedgerWebkit(
+            self.cr, self.uid, 'test_general_ledger', {})
+        self.fiscalyear = self.env['account.fiscalyear'].search(
+            [], order='date_start desc', limit=1)
+        self.account_ids = self.env['account.move.line'].search(
+            []).mapped('account_id').ids
+
+    def _get_ledger_lines_per_account(self, main_filter, start, stop,
+                                      target_move):
+        res = {}
+        for acc_id in self.account_ids:
+            move_line_ids = self.report.get_move_lines_ids(
+                acc_id, main_filter, start, stop, target_move)
+            res[acc_id] = self.report._get_ledger_lines(move_line_ids,
+                                                        acc_id)
+        return res
+
+    def _check_ledger_lines(self, main_filter, start, stop, target_move):
+        expected = self._get_ledger_lines_per_account(
+            main_filter, start, stop, target_move)
+        res = self.report._compute_account_ledger_lines(
+            self.account_ids, {}, main_filter, target_move, start, stop)
+        self.assertEqual(sorted(res), sorted(self.account_ids))
+        for acc_id in self.account_ids:
+            self.assertEqual(res[acc_id], expected[acc_id])
+
+    def test_ledger_lines_by_period(self):
+        periods = self.fiscalyear.period_ids.sorted(
+            lambda p: (not p.special, p.date_start))
+        for target_move in ('all', 'posted'):
+            self._check_ledger_lines('filter_period', periods[0],
+                                     periods[-1], target_move)
+
+    def test_ledger_lines_by_date(self):
+        for target_move in ('all', 'posted'):
+            self._check_ledger_lines('filter_date',
+                                     self.fiscalyear.date_start,
+                                     self.fiscalyear.date_stop, target_move)
+
+    def test_ledger_lines_no_account(self):
+        res = self.report._compute_account_ledger_lines(
+            [], {}, 'filter_date', 'all', self.fiscalyear.date_start,
+            self.fiscalyear.date_stop)
+        self.assertEqual(res, {})
+
+    def test_move_line_datas_slices(self):
+        move_line_ids = self.env['account.move.line'].search([]).ids
+        expected = self.report._get_move_line_datas(move_line_ids)
+        max_monster_slice = common_reports.MAX_MONSTER_SLICE
+        common_reports.MAX_MONSTER_SLICE = 7
+        try:
+            res = self.report._get_move_line_datas(move_line_ids)
+        finally:
+            common_reports.MAX_MONSTER_SLICE = max_monster_slice
+        self.assertEqual(len(res), len(expected))
+        self.assertEqual(set(line['id'] for line in res),
+                         set(move_line_ids))
+
+        # lines are sorted by the database as with a single query,
+        # including move names, with the collation of the database
+        def keys(lines):
+            return [(line['peropen'], line['ldate'], line['move_name'])
+                    for line in lines]
+        self.assertEqual(keys(res), keys(expected))
+
+    def test_counterparts(self):
+        res = self.report._compute_account_ledger_lines(
+            self.account_ids, {}, 'filter_date', 'all',
+            self.fiscalyear.date_start, self.fiscalyear.date_stop)
+        for acc_id, lines in res.items():
+            account = self.env['account.account'].browse(acc_id)
+            for line in lines:
+                move = self.env['account.move'].browse(line['move_id'])
+                codes = sorted(set(
+                    move.line_id.mapped('account_id.code')) -
+                    set([account.code]))
+                self.assertEqual(line['counterparts'], ', '.join(codes[:3]))
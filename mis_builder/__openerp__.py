@@ -19,8 +19,10 @@
     'data': [
         'wizard/mis_builder_dashboard.xml',
         'views/mis_builder.xml',
+        'views/mis_account_period_balance.xml',
         'security/ir.model.access.csv',
         'security/mis_builder_security.xml',
+        'data/ir_cron.xml',
         'report/report_mis_report_instance.xml',
     ],
     'test': [
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""
+Micro-benchmark of the summing of accounting variables.
+
+This script is not part of the module and is not run by the tests. It
+does not need a database, only an Odoo configuration file (or the
+--addons-path option) to import mis_builder.
+
+It compares AccountingExpressionProcessor.get_var_value(), which sums
+amounts as plain floats and returns AccountingNone only for variables
+without data, with the previous implementation, which summed amounts
+through AccountingNone for each account. It first runs the doctests of
+accounting_none, then checks that both implementations return the same
+values for variables over any number of accounts (some of them without
+data), and prints their time. The script exits with status 1 if a
+doctest fails or if the values differ.
+
+Example::
+
+    python aep_benchmark.py -c odoo.cfg --accounts 10 1000 10000
+"""
+
+import argparse
+import doctest
+import random
+import sys
+import timeit
+
+import openerp
+
+DOMAIN = ()
+MODE = 'p'
+CODE = 'BENCH%'
+
+
+def reference_get_var_value(aep, field, mode, account_codes, domain):
+    """ The previous implementation of get_var_value() """
+    from openerp.addons.mis_builder.models.accounting_none import \
+        AccountingNone
+    key = (domain, mode)
+    account_ids_data = aep._data[key]
+    v = AccountingNone
+    for account_code in account_codes:
+        account_ids = aep._account_ids_by_code[account_code]
+        for account_id in account_ids:
+            debit, credit = \
+                account_ids_data.get(account_id,
+                                     (AccountingNone, AccountingNone))
+            if field == 'bal':
+                v += debit - credit
+            elif field == 'deb':
+                v += debit
+            elif field == 'crd':
+                v += credit
+    return v
+
+
+def _make_aep(account_count, data_ratio, rnd):
+    """ Return a processor with account_count accounts for CODE,
+    data_ratio of them having data """
+    from openerp.addons.mis_builder.models.aep import \
+        AccountingExpressionProcessor as AEP
+    aep = AEP(None)
+    account_ids = range(1, account_count + 1)
+    aep._account_ids_by_code[CODE] = set(account_ids)
+    data = {}
+    for account_id in account_ids:
+        if rnd.random() < data_ratio:
+            data[account_id] = (round(rnd.uniform(0, 10000), 2),
+                                round(rnd.uniform(0, 10000), 2))
+    aep._data = {(DOMAIN, MODE): data}
+    return aep
+
+
+def run_doctests():
+    from openerp.addons.mis_builder.models import accounting_none
+    failed, attempted = doctest.testmod(accounting_none)
+    print("accounting_none doctests: %d attempted, %d failed"
+          % (attempted, failed))
+    return failed == 0
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    ok = run_doctests()
+    print("%8s %6s %5s %12s %12s %8s"
+          % ('accounts', 'data', 'field', 'before (us)', 'after (us)',
+             'speedup'))
+    for account_count in args.accounts:
+        for data_ratio in (0.0, 0.5, 1.0):
+            aep = _make_aep(account_count, data_ratio, rnd)
+            for field in ('bal', 'deb', 'crd'):
+                var = (field, MODE, (CODE,), DOMAIN)
+                expected = reference_get_var_value(aep, *var)
+                value = aep.get_var_value(*var)
+                if type(value) != type(expected) or \
+                        abs(value - expected) > 1e-6:
+                    print("MISMATCH for %s over %d accounts: %r != %r"
+                          % (field, account_count, value, expected))
+                    ok = False
+                before = min(timeit.repeat(
+                    lambda: reference_get_var_value(aep, *var),
+                    repeat=args.repeat, number=args.number))
+                after = min(timeit.repeat(
+                    lambda: aep.get_var_value(*var),
+                    repeat=args.repeat, number=args.number))
+                print("%8d %5d%% %5s %12.1f %12.1f %7.1fx"
+                      % (account_count, data_ratio * 100, field,
+                         before / args.number * 1e6,
+                         after / args.number * 1e6,
+                         after and before / after or 0.0))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of the summing of accounting "
+                    "variables")
+    parser.add_argument('-c', '--config', help="Odoo configuration file")
+    parser.add_argument('--addons-path')
+    parser.add_argument('--accounts', type=int, nargs='*',
+                        default=[10, 100, 1000, 10000],
+                        help="numbers of accounts of the variables")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--seed', type=float, default=0.42)
+    args = parser.parse_args()
+    server_args = []
+    if args.config:
+        server_args.extend(['-c', args.config])
+    if args.addons_path:
+        server_args.extend(['--addons-path', args.addons_path])
+    openerp.tools.config.parse_config(server_args)
+    openerp.modules.module.initialize_sys_path()
+    sys.exit(0 if run(args) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""
+Benchmark of MIS Builder computations on a synthetic ledger.
+
+This script is not part of the module and is not run by the tests. It
+works on a database where mis_builder is installed, and has three commands:
+
+* generate: create a synthetic chart of accounts (under a view account
+  whose code is the prefix, Z by default), fiscal years and periods,
+  a journal, and moves with any number of move lines. Moves and move
+  lines are inserted with SQL, so generating millions of lines takes
+  minutes, not hours. Period balances are rebuilt if they are enabled.
+* run: time the steps of the computation of report instances of several
+  shapes (many KPI's, many account codes, many periods, fiscal period
+  modes...) on the synthetic ledger, and write the results to a JSON file.
+  The reports are created in a transaction that is rolled back.
+  With --baseline, the results are compared to a previous JSON file and
+  the script exits with status 1 if a step is slower than the baseline by
+  more than the tolerance.
+* clean: delete the synthetic moves and move lines.
+
+Examples::
+
+    python mis_benchmark.py -c odoo.cfg -d bench generate --lines 2000000
+    python mis_benchmark.py -c odoo.cfg -d bench run -o before.json
+    python mis_benchmark.py -c odoo.cfg -d bench run -o after.json \\
+        --baseline before.json --tolerance 1.2
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import sys
+import time
+
+import openerp
+from openerp import SUPERUSER_ID, api, fields
+
+_logger = logging.getLogger('mis_benchmark')
+
+JOURNAL_CODE = 'MISBM'
+
+
+def _get_company(env):
+    return env.user.company_id
+
+
+def _get_root_account(env, company):
+    return env['account.account'].search(
+        [('parent_id', '=', False), ('company_id', '=', company.id)],
+        limit=1)
+
+
+def _get_bench_accounts(env, prefix):
+    return env['account.account'].search(
+        [('code', '=like', prefix + '%'), ('type', '!=', 'view')],
+        order='code')
+
+
+def _get_bench_journal(env, company):
+    return env['account.journal'].search(
+        [('code', '=', JOURNAL_CODE), ('company_id', '=', company.id)])
+
+
+def _create_accounts(env, company, prefix, count):
+    """ Create a view account with code prefix under the root account,
+    a view account per class (1 to 7) and count accounts spread over the
+    classes, with codes such as Z6000042 """
+    Account = env['account.account'].with_context(
+        defer_parent_store_computation=True)
+    view_type = env.ref('account.data_account_type_view')
+    user_types = {
+        '1': env.ref('account.data_account_type_liability'),
+        '2': env.ref('account.data_account_type_asset'),
+        '3': env.ref('account.data_account_type_asset'),
+        '4': env.ref('account.data_account_type_liability'),
+        '5': env.ref('account.data_account_type_asset'),
+        '6': env.ref('account.data_account_type_expense'),
+        '7': env.ref('account.data_account_type_income'),
+    }
+    top = Account.create({
+        'code': prefix,
+        'name': 'MIS Builder benchmark',
+        'type': 'view',
+        'user_type': view_type.id,
+        'parent_id': _get_root_account(env, company).id,
+        'company_id': company.id,
+    })
+    parents = {}
+    for cls in sorted(user_types):
+        parents[cls] = Account.create({
+            'code': prefix + cls,
+            'name': 'Class %s' % cls,
+            'type': 'view',
+            'user_type': view_type.id,
+            'parent_id': top.id,
+            'company_id': company.id,
+        })
+    classes = sorted(user_types)
+    for i in range(count):
+        cls = classes[i % len(classes)]
+        Account.create({
+            'code': '%s%s%06d' % (prefix, cls, i),
+            'name': 'Account %d' % i,
+            'type': 'other',
+            'user_type': user_types[cls].id,
+            'parent_id': parents[cls].id,
+            'company_id': company.id,
+        })
+    env['account.account']._parent_store_compute()
+
+
+def _get_periods(env, company, years):
+    """ Return the periods of fiscal years, creating missing fiscal years
+    with monthly periods (and an opening period) """
+    FiscalYear = env['account.fiscalyear']
+    fiscalyears = FiscalYear.browse()
+    for year in years:
+        date = '%d-06-30' % year
+        fiscalyear = FiscalYear.search(
+            [('date_start', '<=', date), ('date_stop', '>=', date),
+             ('company_id', '=', company.id)])
+        if not fiscalyear:
+            fiscalyear = FiscalYear.create({
+                'name': str(year),
+                'code': str(year),
+                'date_start': '%d-01-01' % year,
+                'date_stop': '%d-12-31' % year,
+                'company_id': company.id,
+            })
+            fiscalyear.create_period()
+        fiscalyears |= fiscalyear
+    return env['account.period'].search(
+        [('fiscalyear_id', 'in', fiscalyears.ids)], order='date_start')
+
+
+def generate(env, args):
+    company = _get_company(env)
+    cr = env.cr
+    if not _get_bench_accounts(env, args.prefix):
+        _logger.info("creating %d accounts", args.accounts)
+        _create_accounts(env, company, args.prefix, args.accounts)
+    accounts = _get_bench_accounts(env, args.prefix)
+    this_year = datetime.date.today().year
+    years = range(this_year - args.fiscalyears + 1, this_year + 1)
+    periods = _get_periods(env, company, years)
+    journal = _get_bench_journal(env, company)
+    if not journal:
+        journal = env['account.journal'].create({
+            'name': 'MIS Builder benchmark',
+            'code': JOURNAL_CODE,
+            'type': 'general',
+            'company_id': company.id,
+        })
+    # temporary tables of accounts and periods, numbered from 0
+    cr.execute("""
+        CREATE TEMPORARY TABLE mis_bm_account ON COMMIT DROP AS
+        SELECT row_number() OVER (ORDER BY code) - 1 AS idx, id
+        FROM account_account WHERE id IN %s
+    """, (tuple(accounts.ids),))
+    cr.execute("""
+        CREATE TEMPORARY TABLE mis_bm_period ON COMMIT DROP AS
+        SELECT row_number() OVER (ORDER BY date_start, special DESC) - 1
+               AS idx, id, date_start, date_stop - date_start + 1 AS days
+        FROM account_period WHERE id IN %s
+    """, (tuple(periods.ids),))
+    cr.execute("SELECT setseed(%s)", (args.seed,))
+    moves = args.lines // (2 * args.pairs)
+    _logger.info("creating %d moves with %d lines each in %d periods",
+                 moves, 2 * args.pairs, len(periods))
+    # moves are spread over periods, one out of draft_every is a draft
+    cr.execute("""
+        INSERT INTO account_move
+            (name, ref, journal_id, period_id, date, state, company_id,
+             create_uid, create_date, write_uid, write_date)
+        SELECT 'MISBM/' || g, 'benchmark', %(journal_id)s, p.id,
+               p.date_start + (g / %(nperiods)s) %% p.days,
+               CASE WHEN g %% %(draft_every)s = 0
+                    THEN 'draft' ELSE 'posted' END,
+               %(company_id)s,
+               %(uid)s, now() at time zone 'UTC',
+               %(uid)s, now() at time zone 'UTC'
+        FROM generate_series(1, %(moves)s) g
+        JOIN mis_bm_period p ON p.idx = g %% %(nperiods)s
+    """, {
+        'journal_id': journal.id,
+        'nperiods': len(periods),
+        'draft_every': args.draft_every,
+        'company_id': company.id,
+        'uid': env.uid,
+        'moves': moves,
+    })
+    # each pair of lines debits and credits the same random amount
+    # on two random accounts
+    cr.execute("""
+        CREATE TEMPORARY TABLE mis_bm_pair ON COMMIT DROP AS
+        SELECT m.id AS move_id, m.journal_id, m.period_id, m.date,
+               m.state,
+               round((random() * 10000)::numeric, 2) AS amount,
+               floor(random() * %(naccounts)s)::int AS debit_idx,
+               floor(random() * %(naccounts)s)::int AS credit_idx
+        FROM account_move m, generate_series(1, %(pairs)s)
+        WHERE m.journal_id = %(journal_id)s
+          AND m.id NOT IN (SELECT move_id FROM account_move_line
+                           WHERE journal_id = %(journal_id)s)
+    """, {
+        'naccounts': len(accounts),
+        'pairs': args.pairs,
+        'journal_id': journal.id,
+    })
+    for side in ('debit', 'credit'):
+        cr.execute("""
+            INSERT INTO account_move_line
+                (move_id, name, ref, account_id, journal_id, period_id,
+                 date, date_created, debit, credit, state, company_id,
+                 blocked, centralisation,
+                 create_uid, create_date, write_uid, write_date)
+            SELECT p.move_id, 'benchmark', 'benchmark', a.id,
+                   p.journal_id, p.period_id, p.date, p.date,
+                   %(debit)s * p.amount, %(credit)s * p.amount,
+                   'valid', %(company_id)s, false, 'normal',
+                   %(uid)s, now() at time zone 'UTC',
+                   %(uid)s, now() at time zone 'UTC'
+            FROM mis_bm_pair p
+            JOIN mis_bm_account a ON a.idx = p.{side}_idx
+        """.format(side=side), {
+            'debit': 1 if side == 'debit' else 0,
+            'credit': 1 if side == 'credit' else 0,
+            'company_id': company.id,
+            'uid': env.uid,
+        })
+        _logger.info("created %d %s lines", cr.rowcount, side)
+    cr.execute("ANALYZE account_move")
+    cr.execute("ANALYZE account_move_line")
+    period_balance = env['mis.account.period.balance']
+    if period_balance._is_enabled():
+        # move lines inserted with SQL are not maintained incrementally
+        _logger.info("rebuilding period balances")
+        period_balance.rebuild()
+
+
+def clean(env, args):
+    journal = _get_bench_journal(env, _get_company(env))
+    if not journal:
+        return
+    env.cr.execute("DELETE FROM account_move_line WHERE journal_id = %s",
+                   (journal.id,))
+    env.cr.execute("DELETE FROM account_move WHERE journal_id = %s",
+                   (journal.id,))
+    period_balance = env['mis.account.period.balance']
+    if period_balance._is_enabled():
+        period_balance.rebuild()
+
+
+def _get_shapes(prefix, codes):
+    """ Return {shape name: (kpis, periods)} where kpis is a list of
+    (name, expression) and periods a list of mis.report.instance.period
+    values """
+    months = [dict(name='m%d' % i, type='fp', offset=-i, duration=1)
+              for i in range(12)]
+
+    def chunks(n, size):
+        return [codes[(i * size) % len(codes):][:size] for i in range(n)]
+
+    return {
+        'many_kpis': (
+            [('k%d' % i, 'bal[%s%d%%]' % (prefix, 1 + i % 7))
+             for i in range(200)] +
+            [('t%d' % i, 'k%d + k%d' % (i, i + 1)) for i in range(199)],
+            months[:3]),
+        'many_codes': (
+            [('k%d' % i, 'bal[%s]' % ','.join(chunk))
+             for i, chunk in enumerate(chunks(20, 100))],
+            months[:3]),
+        'many_periods': (
+            [('revenue', '-bal[%s7%%]' % prefix),
+             ('expenses', 'bal[%s6%%]' % prefix),
+             ('result', 'revenue - expenses'),
+             ('margin', 'result / revenue if revenue else AccountingNone')],
+            [dict(name='p%d' % i, type='fp', offset=-i, duration=1)
+             for i in range(36)]),
+        'modes': (
+            [('i%d' % c, 'bali[%s%d%%]' % (prefix, c)) for c in range(1, 8)] +
+            [('e%d' % c, 'bale[%s%d%%]' % (prefix, c)) for c in range(1, 8)] +
+            [('p%d' % c, 'balp[%s%d%%]' % (prefix, c)) for c in range(1, 8)] +
+            [('d%d' % c, 'debp[%s%d%%] - crdp[%s%d%%]' %
+              (prefix, c, prefix, c)) for c in range(1, 8)],
+            months),
+        'dates': (
+            [('k%d' % c, 'bal[%s%d%%]' % (prefix, c)) for c in range(1, 8)],
+            [dict(name='d%d' % i, type='d', offset=-30 * i, duration=30)
+             for i in range(6)]),
+    }
+
+
+def _measure(env, fn):
+    env.invalidate_all()
+    sql_count = env.cr.sql_log_count
+    start = time.time()
+    fn()
+    return time.time() - start, env.cr.sql_log_count - sql_count
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    return (values[(n - 1) // 2] + values[n // 2]) / 2.0
+
+
+def _run_shape(env, args, name, kpis, periods):
+    company = _get_company(env)
+    report = env['mis.report'].create({
+        'name': 'benchmark %s' % name,
+        'kpi_ids': [(0, 0, dict(name=kpi_name, description=kpi_name,
+                                expression=expression))
+                    for kpi_name, expression in kpis],
+    })
+    instance = env['mis.report.instance'].create({
+        'name': 'benchmark %s' % name,
+        'report_id': report.id,
+        'root_account': _get_root_account(env, company).id,
+        'company_id': company.id,
+        'target_move': args.target_move,
+        'date': args.date,
+        'period_ids': [(0, 0, period) for period in periods],
+    })
+    period = instance.period_ids.filtered(lambda p: p.valid)[0]
+    lang_id = env['res.lang'].search([('code', '=', 'en_US')]).id
+    root_account = instance.root_account
+
+    def prepare_aep():
+        return report._prepare_aep(root_account)
+
+    def do_queries():
+        aep = report._prepare_aep(root_account)
+        aep.do_queries(period.date_from, period.date_to,
+                       period.period_from, period.period_to,
+                       instance.target_move,
+                       period._get_additional_move_line_filter())
+
+    def period_compute():
+        period._compute(lang_id, report._prepare_aep(root_account))
+
+    steps = [
+        ('prepare_aep', prepare_aep),
+        ('do_queries', do_queries),
+        ('period_compute', period_compute),
+        ('compute', instance.compute),
+    ]
+    results = []
+    for step, fn in steps:
+        measures = [_measure(env, fn) for i in range(args.repeat)]
+        times = [t for t, sql in measures]
+        results.append({
+            'shape': name,
+            'step': step,
+            'kpis': len(kpis),
+            'periods': len(periods),
+            'times': times,
+            'min': min(times),
+            'median': _median(times),
+            'sql': measures[-1][1],
+        })
+        _logger.info("%s %s: median %.3fs, %d queries",
+                     name, step, results[-1]['median'], results[-1]['sql'])
+    return results
+
+
+def run(env, args):
+    company = _get_company(env)
+    accounts = _get_bench_accounts(env, args.prefix)
+    if not accounts:
+        raise SystemExit("no synthetic ledger, run generate first")
+    env.cr.execute("SELECT count(*) FROM account_move_line")
+    move_line_count = env.cr.fetchone()[0]
+    shapes = _get_shapes(args.prefix, accounts.mapped('code'))
+    names = args.shapes or sorted(shapes)
+    results = []
+    for name in names:
+        kpis, periods = shapes[name]
+        results.extend(_run_shape(env, args, name, kpis, periods))
+    output = {
+        'database': env.cr.dbname,
+        'date': fields.Datetime.now(),
+        'company': company.name,
+        'accounts': len(accounts),
+        'move_lines': move_line_count,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1, sort_keys=True)
+    if args.baseline:
+        return _compare(args.baseline, results, args.tolerance)
+    return 0
+
+
+def _compare(baseline_file, results, tolerance):
+    """ Compare the median times of results with a baseline file,
+    return 1 if a step is slower than tolerance times the baseline """
+    with open(baseline_file) as f:
+        baseline = dict(((r['shape'], r['step']), r)
+                        for r in json.load(f)['results'])
+    status = 0
+    for result in results:
+        base = baseline.get((result['shape'], result['step']))
+        if not base or not base['median']:
+            continue
+        ratio = result['median'] / base['median']
+        if ratio > tolerance:
+            _logger.error("%s %s is %.2f times slower than the baseline "
+                          "(%.3fs vs %.3fs)", result['shape'],
+                          result['step'], ratio, result['median'],
+                          base['median'])
+            status = 1
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', help="Odoo configuration file")
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--prefix', default='Z',
+                        help="code of the synthetic chart of accounts")
+    subparsers = parser.add_subparsers(dest='command')
+
+    gen_parser = subparsers.add_parser('generate')
+    gen_parser.add_argument('--accounts', type=int, default=1000)
+    gen_parser.add_argument('--fiscalyears', type=int, default=3)
+    gen_parser.add_argument('--lines', type=int, default=1000000)
+    gen_parser.add_argument('--pairs', type=int, default=2,
+                            help="debit/credit pairs of lines per move")
+    gen_parser.add_argument('--draft-every', type=int, default=10,
+                            help="one move out of N is a draft")
+    gen_parser.add_argument('--seed', type=float, default=0.42)
+
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('-o', '--output', required=True,
+                            help="JSON file to write the results to")
+    run_parser.add_argument('--shapes', nargs='*')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--target-move', default='posted',
+                            choices=['posted', 'all'])
+    run_parser.add_argument('--date', default=fields.Date.today(),
+                            help="base date of the report instances")
+    run_parser.add_argument('--baseline',
+                            help="JSON file of results to compare with")
+    run_parser.add_argument('--tolerance', type=float, default=1.2)
+
+    subparsers.add_parser('clean')
+
+    args = parser.parse_args()
+    server_args = ['-d', args.database]
+    if args.config:
+        server_args.extend(['-c', args.config])
+    openerp.tools.config.parse_config(server_args)
+    openerp.netsvc.init_logger()
+    logging.getLogger('mis_benchmark').setLevel(logging.INFO)
+    registry = openerp.modules.registry.RegistryManager.get(args.database)
+    status = 0
+    with api.Environment.manage():
+        cr = registry.cursor()
+        try:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            if args.command == 'generate':
+                generate(env, args)
+                cr.commit()
+            elif args.command == 'clean':
+                clean(env, args)
+                cr.commit()
+            else:
+                # the reports created by the benchmark are not kept
+                status = run(env, args)
+                cr.rollback()
+        finally:
+            cr.close()
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,9 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
 from . import mis_builder
+from . import mis_report_instance_profile
+from . import mis_report_instance_precomputed
 from . import aep
+from . import account_account
+from . import mis_account_period_balance
+from . import mis_data_version
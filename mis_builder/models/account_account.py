@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import bisect
+import re
+from collections import defaultdict
+
+from openerp import api, models, tools
+
+# changing these fields may change the resolution of account codes
+_ACCOUNT_CODE_FIELDS = ('code', 'parent_id', 'type', 'child_consol_ids',
+                        'active')
+
+
+def _like_to_regex(pattern):
+    """ Convert a pattern of the orm like operator, which matches the
+    pattern anywhere in the value, to a regular expression
+
+    >>> bool(_like_to_regex('6%').match('60'))
+    True
+    >>> bool(_like_to_regex('6%').match('16'))
+    True
+    >>> bool(_like_to_regex('6_1').match('6010'))
+    True
+    >>> bool(_like_to_regex('6_1').match('61'))
+    False
+    >>> bool(_like_to_regex(r'6\\_1').match('6_1'))
+    True
+    >>> bool(_like_to_regex(r'6\\_1').match('601'))
+    False
+    """
+    regex = []
+    chars = iter(pattern)
+    for char in chars:
+        if char == '\\':
+            regex.append(re.escape(next(chars, '\\')))
+        elif char == '%':
+            regex.append('.*')
+        elif char == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char))
+    return re.compile('.*%s.*$' % ''.join(regex), re.DOTALL)
+
+
+class AccountCodeIndex(object):
+    """ In-memory index of the codes, hierarchy and consolidation children
+    of all accounts, to resolve the account codes of accounting expressions
+    without querying the database.
+
+    Codes are resolved like account.account searches on code (with the =
+    operator, or the like operator for codes with % wildcards) and
+    parent_id child_of the root account, with view and consolidation
+    accounts replaced by their children (see _get_children_and_consol).
+    """
+
+    def __init__(self, cr):
+        cr.execute("""
+            SELECT id, code, type, active, parent_left, parent_right
+            FROM account_account
+            WHERE parent_left IS NOT NULL
+            ORDER BY parent_left
+        """)
+        rows = cr.fetchall()
+        self.ids = [row[0] for row in rows]
+        self.codes = [row[1] for row in rows]
+        self.types = [row[2] for row in rows]
+        self.active = [row[3] for row in rows]
+        self.parent_lefts = [row[4] for row in rows]
+        self.parent_rights = [row[5] for row in rows]
+        self.index_by_id = dict((account_id, i)
+                                for i, account_id in enumerate(self.ids))
+        # {consolidation account id: [consolidated children ids]}
+        self.consol_children = defaultdict(list)
+        cr.execute("SELECT child_id, parent_id "
+                   "FROM account_account_consol_rel")
+        for account_id, child_id in cr.fetchall():
+            self.consol_children[account_id].append(child_id)
+        # {(root account id, code): frozenset of account ids}
+        self._resolved = {}
+
+    def _subtree(self, account_id):
+        """ Return the range of indices of an account and its
+        descendants """
+        i = self.index_by_id.get(account_id)
+        if i is None:
+            return range(0)
+        end = bisect.bisect_left(self.parent_lefts, self.parent_rights[i])
+        return range(i, end)
+
+    def expand(self, account_ids):
+        """ Return the set of active accounts of account_ids and their
+        descendants, and of their consolidated children, recursively """
+        res = set()
+        todo = list(account_ids)
+        done = set()
+        while todo:
+            account_id = todo.pop()
+            if account_id in done:
+                continue
+            done.add(account_id)
+            for i in self._subtree(account_id):
+                if not self.active[i] or self.ids[i] in res:
+                    continue
+                res.add(self.ids[i])
+                todo.extend(self.consol_children.get(self.ids[i], []))
+        return res
+
+    def resolve(self, root_account_id, codes):
+        """ Resolve account codes (or None for the root account) of
+        accounts under a root account.
+
+        Returns {code: frozenset of account ids}. """
+        res = {}
+        todo = []
+        for code in codes:
+            try:
+                res[code] = self._resolved[(root_account_id, code)]
+            except KeyError:
+                todo.append(code)
+        if not todo:
+            return res
+        subtree = [i for i in self._subtree(root_account_id)
+                   if self.active[i]]
+        root_code = None
+        if root_account_id in self.index_by_id:
+            root_code = self.codes[self.index_by_id[root_account_id]]
+        for code in todo:
+            if code is None:
+                code_to_match = root_code
+            else:
+                code_to_match = code
+            if code_to_match is None:
+                matched = []
+            elif '%' in code_to_match:
+                regex = _like_to_regex(code_to_match)
+                matched = [i for i in subtree
+                           if regex.match(self.codes[i])]
+            else:
+                matched = [i for i in subtree
+                           if self.codes[i] == code_to_match]
+            account_ids = set()
+            for i in matched:
+                if self.types[i] in ('view', 'consolidation'):
+                    account_ids.update(self.expand([self.ids[i]]))
+                else:
+                    account_ids.add(self.ids[i])
+            res[code] = self._resolved[(root_account_id, code)] = \
+                frozenset(account_ids)
+        return res
+
+
+class AccountAccount(models.Model):
+
+    _inherit = 'account.account'
+
+    @tools.ormcache(skiparg=3)
+    def _mis_get_account_index(self, cr, uid):
+        """ Return the AccountCodeIndex of all accounts.
+
+        The index is cached, and built again when accounts are
+        modified. """
+        return AccountCodeIndex(cr)
+
+    def _mis_get_account_ids_by_codes(self, cr, uid, root_account_id,
+                                      codes):
+        """ Resolve account codes of accounting expressions to
+        account ids.
+
+        Codes may contain % wildcards, or be None for the root account.
+        View and consolidation accounts are replaced by their children.
+        Codes are resolved in memory, with an index of all accounts
+        (see AccountCodeIndex), and results are kept in the index, so
+        uid is expected to be the superuser.
+
+        Returns {code: frozenset of account ids}. """
+        return self._mis_get_account_index(cr, uid).resolve(
+            root_account_id, codes)
+
+    def _mis_get_account_ids_by_code(self, cr, uid, root_account_id, code):
+        """ Resolve an account code of an accounting expression to
+        account ids (see _mis_get_account_ids_by_codes()).
+
+        Returns a frozenset of account ids. """
+        return self._mis_get_account_ids_by_codes(
+            cr, uid, root_account_id, [code])[code]
+
+    def _mis_get_children_and_consol(self, cr, uid, account_ids):
+        """ Return the set of ids of accounts and their children and
+        consolidated children, like _get_children_and_consol, for
+        several accounts at once and without querying the database. """
+        return self._mis_get_account_index(cr, uid).expand(account_ids)
+
+    def _mis_clear_caches(self):
+        # ormcache lives on the registry model, not on recordsets;
+        # caches are cleared after the change, so resolutions done
+        # during the change do not stay cached with the former accounts
+        self.pool[self._name].clear_caches()
+
+    @api.model
+    def create(self, vals):
+        res = super(AccountAccount, self).create(vals)
+        self._mis_clear_caches()
+        return res
+
+    @api.multi
+    def write(self, vals):
+        res = super(AccountAccount, self).write(vals)
+        if any(f in vals for f in _ACCOUNT_CODE_FIELDS):
+            self._mis_clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super(AccountAccount, self).unlink()
+        self._mis_clear_caches()
+        return res
@@ -2,19 +2,102 @@
 # © 2014-2015 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import copy
 import re
 from collections import defaultdict
 
+from openerp import SUPERUSER_ID
 from openerp.exceptions import Warning as UserError
 from openerp.models import expression
+from openerp.tools.lru import LRU
 from openerp.tools.safe_eval import safe_eval
 from openerp.tools.translate import _
 from .accounting_none import AccountingNone
+from .period_calendar import get_period_calendar
+from .profiler import NULL_PROFILER
+
+PERIOD_BALANCE_MODEL = 'mis.account.period.balance'
+# fields of move lines having the same value on period balances:
+# record rules of move lines on these fields only are applied to
+# period balances
+PERIOD_BALANCE_RULE_FIELDS = ('company_id', 'account_id', 'period_id')
 
 MODE_VARIATION = 'p'
 MODE_INITIAL = 'i'
 MODE_END = 'e'
 
+# accounting variables of expressions, keyed by expression
+# (see AccountingExpressionProcessor._tokenize())
+_tokens_cache = LRU(4096)
+
+
+def _sum_field(field, sums):
+    """ Sum the field (bal, deb or crd) of accounting variables over
+    a non empty list of (debit, credit).
+
+    Amounts are summed as plain floats: AccountingNone, whose arithmetic
+    goes through python methods, is only returned by callers when there
+    is no data at all.
+    """
+    if field == 'bal':
+        return sum(debit - credit for debit, credit in sums)
+    elif field == 'deb':
+        return sum(debit for debit, credit in sums)
+    elif field == 'crd':
+        return sum(credit for debit, credit in sums)
+    return AccountingNone
+
+
+class OrmQueryBackend(object):
+    """ Query backend summing move lines with the orm read_group.
+
+    The orm does an additional query per group to fetch the display
+    name of many2one groupby fields. """
+
+    def read_sums(self, env, domain, groupby,
+                  model_name='account.move.line'):
+        aml_model = env[model_name]
+        res = []
+        for group in aml_model.read_group(domain,
+                                          ['debit', 'credit'] + groupby,
+                                          groupby,
+                                          lazy=False):
+            values = tuple(group[g] and group[g][0] for g in groupby)
+            res.append((values, group['debit'] or 0.0,
+                        group['credit'] or 0.0))
+        return res
+
+
+class SqlQueryBackend(object):
+    """ Query backend summing move lines with a direct SQL query.
+
+    The domain is compiled with the orm (_where_calc), and access rights
+    and record rules are checked and applied the same way as read_group
+    does, but the groupby values are returned as raw ids, without fetching
+    their display name. """
+
+    def read_sums(self, env, domain, groupby,
+                  model_name='account.move.line'):
+        aml_model = env[model_name]
+        aml_model.check_access_rights('read')
+        query = aml_model._where_calc(domain)
+        aml_model._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        table = aml_model._table
+        groupby_terms = []
+        for field_name in groupby:
+            assert field_name in aml_model._columns
+            groupby_terms.append('"%s"."%s"' % (table, field_name))
+        groupby_str = ', '.join(groupby_terms)
+        sql = ('SELECT %s, SUM("%s".debit), SUM("%s".credit) FROM %s'
+               % (groupby_str, table, table, from_clause))
+        if where_clause:
+            sql += ' WHERE %s' % where_clause
+        sql += ' GROUP BY %s' % groupby_str
+        env.cr.execute(sql, where_params)
+        return [(tuple(row[:-2]), row[-2] or 0.0, row[-1] or 0.0)
+                for row in env.cr.fetchall()]
+
 
 class AccountingExpressionProcessor(object):
     """ Processor for accounting expressions.
@@ -44,18 +127,48 @@ class AccountingExpressionProcessor(object):
           be queried;
         * for each period, call do_queries(), then call replace_expr() for each
           expression to replace accounting variables with their resulting value
-          for the given period.
+          for the given period;
+        * optionally, when several fiscal period ranges must be computed,
+          call do_queries_multi() once for all of them before the first
+          do_queries(), so all columns are fetched in a single pass;
+        * optionally, when the processor is created with a dimension
+          (a many2one field of move lines such as partner_id,
+          analytic_account_id or company_id), call
+          get_var_values_by_dimension() to obtain the value of
+          accounting variables for each value of the dimension.
 
     How it works:
         * by accumulating the expressions before hand, it ensures to do the
           strict minimum number of queries to the database (for each period,
-          one query per domain and mode);
-        * it queries using the orm read_group which reduces to a query with
-          sum on debit and credit and group by on account_id (note: it seems
-          the orm then does one query per account to fetch the account
-          name...);
-        * additionally, one query per view/consolidation account is done to
-          discover the children accounts.
+          one query per domain and mode, or one query per domain for all
+          periods when using do_queries_multi());
+        * it queries through a pluggable query backend: by default
+          SqlQueryBackend, which compiles the domain with the orm (so record
+          rules apply) into one SQL query with sum on debit and credit
+          and group by on account_id; OrmQueryBackend uses the orm
+          read_group instead, which does the same query but then does one
+          query per account to fetch the account name;
+        * when period balances (mis.account.period.balance) are enabled,
+          fiscal period based modes on expressions without move line domain
+          are read from these pre-aggregated balances instead of move lines,
+          filtered with the record rules of move lines of the user;
+        * normal fiscal periods of each company are loaded once and looked
+          up by date with bisect (see period_calendar.PeriodCalendar);
+        * account codes are resolved to account ids (including children
+          of view and consolidation accounts) in memory, with an index of
+          all accounts cached in the registry and built again when
+          accounts are modified (see account_account.AccountCodeIndex);
+        * expressions are matched and their domains evaluated once per
+          process (see _tokenize());
+        * amounts of accounting variables are summed as plain floats,
+          AccountingNone being returned only for variables without data
+          (see _sum_field());
+        * queries are measured by the profiler attribute (see profiler.py),
+          with keys obtained with get_profile_key();
+        * with a dimension, queries are grouped by the dimension too, so
+          a single query per domain and mode returns the amounts of all
+          values of the dimension, instead of one query per value with
+          a domain on the dimension.
     """
 
     ACC_RE = re.compile(r"(?P<field>\bbal|\bcrd|\bdeb)"
@@ -63,62 +176,74 @@ class AccountingExpressionProcessor(object):
                         r"(?P<accounts>_[a-zA-Z0-9]+|\[.*?\])"
                         r"(?P<domain>\[.*?\])?")
 
-    def __init__(self, env):
+    def __init__(self, env, query_backend=None, dimension=None):
         self.env = env
+        self.query_backend = query_backend or SqlQueryBackend()
+        # optional many2one field of move lines to group amounts by
+        self.dimension = dimension
         # before done_parsing: {(domain, mode): set(account_codes)}
         # after done_parsing: {(domain, mode): list(account_ids)}
         self._map_account_ids = defaultdict(set)
         self._account_ids_by_code = defaultdict(set)
+        # results of do_queries_multi():
+        # {(period_from_id, period_to_id, target_move, filter):
+        #  (data, dimension data) as in do_queries()}
+        self._prefetched_data = {}
+        self._period_balance_enabled = None
+        # record rules of move lines applied to period balances
+        self._period_balance_rule_domain = None
+        # {company_id: PeriodCalendar}
+        self._period_calendars = {}
+        self.profiler = NULL_PROFILER
+
+    def with_env(self, env):
+        """Return a copy of the processor bound to another environment.
+
+        The copy shares parsed expressions with the original, and has
+        its own copy of resolved account codes, period calendars and
+        prefetched data, so it can be used to query periods with another
+        cursor in another thread.
+        """
+        aep = copy.copy(self)
+        aep.env = env
+        aep._account_ids_by_code = copy.copy(self._account_ids_by_code)
+        aep._prefetched_data = dict(self._prefetched_data)
+        aep._period_calendars = dict(self._period_calendars)
+        return aep
+
+    def with_profiler(self, profiler):
+        """Return a copy of the processor recording its queries
+        in another profiler (typically the profiler of a period)."""
+        aep = copy.copy(self)
+        aep.profiler = profiler
+        return aep
+
+    @staticmethod
+    def get_profile_key(domain, mode):
+        """Return the key of profiling entries of queries
+        of a domain and mode"""
+        return u'%s%s' % (mode, list(domain))
 
     def _load_account_codes(self, account_codes, root_account):
-        account_model = self.env['account.account']
-        # TODO: account_obj is necessary because _get_children_and_consol
-        #       does not work in new API?
+        # TODO: account_obj is necessary because ormcache does not
+        #       work in new API
         account_obj = self.env.registry('account.account')
-        exact_codes = set()
-        like_codes = set()
-        for account_code in account_codes:
-            if account_code in self._account_ids_by_code:
-                continue
-            if account_code is None:
-                # by convention the root account is keyed as
-                # None in _account_ids_by_code, so it is consistent
-                # with what _parse_match_object returns for an
-                # empty list of account codes, ie [None]
-                exact_codes.add(root_account.code)
-            elif '%' in account_code:
-                like_codes.add(account_code)
-            else:
-                exact_codes.add(account_code)
-        for account in account_model.\
-                search([('code', 'in', list(exact_codes)),
-                        ('parent_id', 'child_of', root_account.id)]):
-            if account.code == root_account.code:
-                code = None
-            else:
-                code = account.code
-            if account.type in ('view', 'consolidation'):
-                self._account_ids_by_code[code].update(
-                    account_obj._get_children_and_consol(
-                        self.env.cr, self.env.uid,
-                        [account.id],
-                        self.env.context))
-            else:
-                self._account_ids_by_code[code].add(account.id)
-        for like_code in like_codes:
-            for account in account_model.\
-                    search([('code', 'like', like_code),
-                            ('parent_id', 'child_of', root_account.id)]):
-                if account.type in ('view', 'consolidation'):
-                    self._account_ids_by_code[like_code].update(
-                        account_obj._get_children_and_consol(
-                            self.env.cr, self.env.uid,
-                            [account.id],
-                            self.env.context))
-                else:
-                    self._account_ids_by_code[like_code].add(account.id)
+        account_codes = [account_code for account_code in account_codes
+                         if account_code not in self._account_ids_by_code]
+        if not account_codes:
+            return
+        # by convention the root account is keyed as
+        # None in _account_ids_by_code, so it is consistent
+        # with what _parse_match_object returns for an
+        # empty list of account codes, ie [None];
+        # the resolution is cached across requests, so it is done
+        # as superuser (move lines are queried as the current user)
+        self._account_ids_by_code.update(
+            account_obj._mis_get_account_ids_by_codes(
+                self.env.cr, SUPERUSER_ID, root_account.id, account_codes))
 
-    def _parse_match_object(self, mo):
+    @classmethod
+    def _parse_match_object(cls, mo):
         """Split a match object corresponding to an accounting variable
 
         Returns field, mode, [account codes], (domain expression).
@@ -140,6 +265,41 @@ class AccountingExpressionProcessor(object):
         domain = tuple(safe_eval(domain))
         return field, mode, account_codes, domain
 
+    @classmethod
+    def _tokenize(cls, expr):
+        """Return the accounting variables of an expression, as a tuple
+        of (field, mode, (account codes), domain, span) where span is the
+        (start, end) position of the variable in expr.
+
+        Tokens are cached by expression, so expressions are matched and
+        their domains evaluated once per process.
+        """
+        try:
+            return _tokens_cache[expr]
+        except KeyError:
+            pass
+        tokens = []
+        for mo in cls.ACC_RE.finditer(expr):
+            field, mode, account_codes, domain = cls._parse_match_object(mo)
+            tokens.append((field, mode, tuple(account_codes), domain,
+                           mo.span()))
+        tokens = _tokens_cache[expr] = tuple(tokens)
+        return tokens
+
+    @classmethod
+    def _replace_tokens(cls, expr, f):
+        """Replace the accounting variables of an expression by the
+        string returned by f(field, mode, (account codes), domain)."""
+        parts = []
+        pos = 0
+        for field, mode, account_codes, domain, (start, end) in \
+                cls._tokenize(expr):
+            parts.append(expr[pos:start])
+            parts.append(f(field, mode, account_codes, domain))
+            pos = end
+        parts.append(expr[pos:])
+        return ''.join(parts)
+
     def parse_expr(self, expr):
         """Parse an expression, extracting accounting variables.
 
@@ -147,25 +307,47 @@ class AccountingExpressionProcessor(object):
         so when all expressions have been parsed, we know which
         account codes to query for each domain and mode.
         """
-        for mo in self.ACC_RE.finditer(expr):
-            _, mode, account_codes, domain = self._parse_match_object(mo)
+        for field, mode, account_codes, domain, span in self._tokenize(expr):
             key = (domain, mode)
             self._map_account_ids[key].update(account_codes)
 
     def done_parsing(self, root_account):
         """Load account codes and replace account codes by
         account ids in map."""
+        # resolve the account codes of all domains and modes at once
+        all_account_codes = set()
+        for account_codes in self._map_account_ids.values():
+            all_account_codes.update(account_codes)
+        self._load_account_codes(all_account_codes, root_account)
         for key, account_codes in self._map_account_ids.items():
-            self._load_account_codes(account_codes, root_account)
             account_ids = set()
             for account_code in account_codes:
                 account_ids.update(self._account_ids_by_code[account_code])
             self._map_account_ids[key] = list(account_ids)
 
+    @classmethod
+    def bind_expr(cls, expr, var_names):
+        """Replace accounting variables in an expression by python names.
+
+        var_names is a dictionary mapping accounting variables, as
+        (field, mode, tuple(account codes), domain) tuples, to python
+        names. Accounting variables of expr that are not in var_names yet
+        are added to it with a new name.
+
+        Returns a new expression string. The value of each variable
+        can then be obtained with get_var_value().
+        """
+        def f(field, mode, account_codes, domain):
+            var = (field, mode, account_codes, domain)
+            if var not in var_names:
+                var_names[var] = '_aep_%d' % len(var_names)
+            return var_names[var]
+        return cls._replace_tokens(expr, f)
+
     @classmethod
     def has_account_var(cls, expr):
         """Test if an string contains an accounting variable."""
-        return bool(cls.ACC_RE.search(expr))
+        return bool(cls._tokenize(expr))
 
     def get_aml_domain_for_expr(self, expr,
                                 date_from, date_to,
@@ -179,8 +361,7 @@ class AccountingExpressionProcessor(object):
         """
         aml_domains = []
         date_domain_by_mode = {}
-        for mo in self.ACC_RE.finditer(expr):
-            field, mode, account_codes, domain = self._parse_match_object(mo)
+        for field, mode, account_codes, domain, span in self._tokenize(expr):
             aml_domain = list(domain)
             account_ids = set()
             for account_code in account_codes:
@@ -214,33 +395,24 @@ class AccountingExpressionProcessor(object):
             limit=1)
         return periods and periods[0]
 
+    def _get_period_calendar(self, company_id):
+        """ Return the PeriodCalendar of the normal periods of a company,
+        loaded once for the processor """
+        return get_period_calendar(self.env, company_id,
+                                   self._period_calendars)
+
     def _get_previous_normal_period(self, period, company_id):
-        period_model = self.env['account.period']
-        periods = period_model.search(
-            [('date_start', '<', period.date_start),
-             ('special', '=', False),
-             ('company_id', '=', company_id)],
-            order="date_start desc",
-            limit=1)
-        return periods and periods[0]
+        period_id = self._get_period_calendar(company_id).get_previous(
+            period.date_start)
+        return self.env['account.period'].browse(period_id or [])
 
     def _get_first_normal_period(self, company_id):
-        period_model = self.env['account.period']
-        periods = period_model.search(
-            [('special', '=', False),
-             ('company_id', '=', company_id)],
-            order="date_start asc",
-            limit=1)
-        return periods and periods[0]
+        period_id = self._get_period_calendar(company_id).get_first()
+        return self.env['account.period'].browse(period_id or [])
 
     def _get_period_ids_between(self, period_from, period_to, company_id):
-        period_model = self.env['account.period']
-        periods = period_model.search(
-            [('date_start', '>=', period_from.date_start),
-             ('date_stop', '<=', period_to.date_stop),
-             ('special', '=', False),
-             ('company_id', '=', company_id)])
-        period_ids = [p.id for p in periods]
+        period_ids = self._get_period_calendar(company_id).get_between(
+            period_from.date_start, period_to.date_stop)
         if period_from.special:
             period_ids.append(period_from.id)
         return period_ids
@@ -308,35 +480,261 @@ class AccountingExpressionProcessor(object):
             domain.append(('move_id.state', '=', 'posted'))
         return expression.normalize_domain(domain)
 
+    @staticmethod
+    def _get_prefetch_key(period_from, period_to, target_move,
+                          additional_move_line_filter):
+        return (period_from.id, period_to.id, target_move,
+                repr(additional_move_line_filter or []))
+
+    def _get_groupby(self):
+        """ Return the fields move line sums are grouped by """
+        if self.dimension:
+            return ['account_id', self.dimension]
+        return ['account_id']
+
+    def _add_sums(self, data, dimension_data, values, debit, credit):
+        """ Add debit and credit to the sums of an account, and to the
+        sums of the account by dimension value.
+
+        values are the values of the fields returned by _get_groupby(). """
+        account_id = values[0]
+        if account_id in data:
+            prev_debit, prev_credit = data[account_id]
+            data[account_id] = (prev_debit + debit, prev_credit + credit)
+        else:
+            data[account_id] = (debit, credit)
+        if self.dimension:
+            # move lines without value are grouped under None
+            dimension_value = values[1] or None
+            sums = dimension_data.setdefault(account_id, {})
+            if dimension_value in sums:
+                prev_debit, prev_credit = sums[dimension_value]
+                sums[dimension_value] = (prev_debit + debit,
+                                         prev_credit + credit)
+            else:
+                sums[dimension_value] = (debit, credit)
+
+    def _read_sums(self, domain, groupby):
+        """Sum debit and credit of move lines matching domain.
+
+        Returns a list of (tuple of groupby values, debit, credit),
+        where many2one groupby values are ids.
+        """
+        return self.query_backend.read_sums(self.env, domain, groupby)
+
+    def _use_period_balance(self, domain, additional_move_line_filter):
+        """Test if sums for a domain can be read from period balances
+        (mis.account.period.balance) instead of move lines.
+
+        This is possible for fiscal period based modes, if period
+        balances are enabled, if there is no domain on move lines,
+        and if the record rules of move lines of the current user
+        can be applied to period balances (see
+        _get_period_balance_rule_domain()).
+        """
+        if domain or additional_move_line_filter:
+            return False
+        if self.dimension and \
+                self.dimension not in self.env[PERIOD_BALANCE_MODEL]._fields:
+            return False
+        if self._period_balance_enabled is None:
+            self._period_balance_enabled = \
+                self.env.registry(PERIOD_BALANCE_MODEL)._is_enabled(
+                    self.env.cr, self.env.uid)
+            if self._period_balance_enabled:
+                self._period_balance_rule_domain = \
+                    self._get_period_balance_rule_domain()
+                self._period_balance_enabled = \
+                    self._period_balance_rule_domain is not None
+        return self._period_balance_enabled
+
+    def _get_period_balance_rule_domain(self):
+        """Return the domain of the read record rules of move lines
+        of the current user, to filter period balances the same way.
+
+        Period balances are read as superuser with this domain, so
+        users see the balances of the move lines they can read, and
+        access to period balances can be restricted to accountants.
+        Returns None when a rule is on a move line field that period
+        balances do not have (eg partner_id): then sums must be read
+        from move lines.
+        """
+        rule_domain = self.env.registry('ir.rule')._compute_domain(
+            self.env.cr, self.env.uid, 'account.move.line', 'read') or []
+        for element in rule_domain:
+            if not isinstance(element, (list, tuple)) or \
+                    element in (expression.TRUE_LEAF, expression.FALSE_LEAF):
+                continue
+            if element[0].split('.')[0] not in PERIOD_BALANCE_RULE_FIELDS:
+                return None
+        return list(rule_domain)
+
+    def _read_period_balance_sums(self, period_ids, account_ids,
+                                  target_move, groupby):
+        """Sum debit and credit of period balances.
+
+        Returns the same as _read_sums().
+        """
+        domain = [('period_id', 'in', list(period_ids)),
+                  ('account_id', 'in', list(account_ids))]
+        if target_move == 'posted':
+            domain.append(('move_state', '=', 'posted'))
+        domain.extend(self._period_balance_rule_domain or [])
+        return self.query_backend.read_sums(self.env(user=SUPERUSER_ID),
+                                            domain, groupby,
+                                            model_name=PERIOD_BALANCE_MODEL)
+
+    def do_queries_multi(self, periods, target_move,
+                         additional_move_line_filter=None):
+        """Query sums of debit and credit for several fiscal period
+        ranges at once.
+
+        periods is a list of (period_from, period_to) tuples, typically
+        one per report column. Instead of querying each period range and
+        mode separately, one query per domain is done, grouped by account
+        and fiscal period, over all fiscal periods needed by all period
+        ranges and modes. The result is then split by period range, so
+        subsequent invocations of do_queries() for these period ranges
+        do not hit the database.
+
+        With a dimension, queries are grouped by the dimension too.
+
+        This method must be executed after done_parsing().
+        """
+        # {mode: {(period_from_id, period_to_id): period_ids}}
+        period_ids_by_mode = defaultdict(dict)
+        # {domain: set(modes)}
+        modes_by_domain = defaultdict(set)
+        for domain, mode in self._map_account_ids:
+            modes_by_domain[domain].add(mode)
+            if period_ids_by_mode[mode]:
+                continue
+            for period_from, period_to in periods:
+                period_ids_by_mode[mode][(period_from.id, period_to.id)] = \
+                    set(self._get_period_ids_for_mode(
+                        period_from, period_to, mode))
+        # {period range key: (data, dimension data)}
+        data_by_range = {}
+        for period_from, period_to in periods:
+            range_key = self._get_prefetch_key(
+                period_from, period_to, target_move,
+                additional_move_line_filter)
+            data_by_range[range_key] = (defaultdict(dict), defaultdict(dict))
+        for domain, modes in modes_by_domain.items():
+            all_account_ids = set()
+            all_period_ids = set()
+            for mode in modes:
+                all_account_ids.update(self._map_account_ids[(domain, mode)])
+                for period_ids in period_ids_by_mode[mode].values():
+                    all_period_ids.update(period_ids)
+            if not all_period_ids:
+                continue
+            # fetch sum of debit/credit, grouped by account and period
+            # (and dimension)
+            groupby = self._get_groupby()
+            groupby.insert(1, 'period_id')
+            with self.profiler.measure(
+                    self.env.cr, 'aep',
+                    self.get_profile_key(domain, ''.join(sorted(modes)))) \
+                    as profile_entry:
+                if self._use_period_balance(domain,
+                                            additional_move_line_filter):
+                    sums = self._read_period_balance_sums(
+                        all_period_ids, all_account_ids, target_move, groupby)
+                else:
+                    aml_domain = list(domain)
+                    aml_domain.append(('period_id', 'in',
+                                       list(all_period_ids)))
+                    aml_domain.append(('account_id', 'in',
+                                       list(all_account_ids)))
+                    if target_move == 'posted':
+                        aml_domain.append(('move_id.state', '=', 'posted'))
+                    if additional_move_line_filter:
+                        aml_domain.extend(additional_move_line_filter)
+                    sums = self._read_sums(aml_domain, groupby)
+                profile_entry['rows'] = len(sums)
+            sums_by_period_id = defaultdict(list)
+            for values, debit, credit in sums:
+                sums_by_period_id[values[1]].append(
+                    ((values[0],) + values[2:], debit, credit))
+            for mode in modes:
+                key = (domain, mode)
+                account_ids = set(self._map_account_ids[key])
+                for period_from, period_to in periods:
+                    period_ids = period_ids_by_mode[mode][
+                        (period_from.id, period_to.id)]
+                    range_key = self._get_prefetch_key(
+                        period_from, period_to, target_move,
+                        additional_move_line_filter)
+                    data, dimension_data = data_by_range[range_key]
+                    for period_id in period_ids:
+                        for values, debit, credit in \
+                                sums_by_period_id.get(period_id, []):
+                            if values[0] not in account_ids:
+                                continue
+                            self._add_sums(data[key], dimension_data[key],
+                                           values, debit, credit)
+        self._prefetched_data.update(data_by_range)
+
     def do_queries(self, date_from, date_to, period_from, period_to,
                    target_move, additional_move_line_filter=None):
         """Query sums of debit and credit for all accounts and domains
         used in expressions.
 
+        With a dimension, queries are grouped by the dimension too.
+
         This method must be executed after done_parsing().
         """
-        aml_model = self.env['account.move.line']
+        if period_from and period_to:
+            prefetch_key = self._get_prefetch_key(
+                period_from, period_to, target_move,
+                additional_move_line_filter)
+            if prefetch_key in self._prefetched_data:
+                self._data, self._dimension_data = \
+                    self._prefetched_data[prefetch_key]
+                return
         # {(domain, mode): {account_id: (debit, credit)}}
         self._data = defaultdict(dict)
+        # {(domain, mode): {account_id: {dimension value: (debit, credit)}}}
+        self._dimension_data = defaultdict(dict)
+        groupby = self._get_groupby()
         domain_by_mode = {}
+        period_ids_by_mode = {}
         for key in self._map_account_ids:
             domain, mode = key
-            if mode not in domain_by_mode:
-                domain_by_mode[mode] = \
-                    self.get_aml_domain_for_dates(date_from, date_to,
-                                                  period_from, period_to,
-                                                  mode, target_move)
-            domain = list(domain) + domain_by_mode[mode]
-            domain.append(('account_id', 'in', self._map_account_ids[key]))
-            if additional_move_line_filter:
-                domain.extend(additional_move_line_filter)
-            # fetch sum of debit/credit, grouped by account_id
-            accs = aml_model.read_group(domain,
-                                        ['debit', 'credit', 'account_id'],
-                                        ['account_id'])
-            for acc in accs:
-                self._data[key][acc['account_id'][0]] = \
-                    (acc['debit'] or 0.0, acc['credit'] or 0.0)
+            with self.profiler.measure(
+                    self.env.cr, 'aep',
+                    self.get_profile_key(domain, mode)) as profile_entry:
+                if period_from and period_to and \
+                        self._use_period_balance(domain,
+                                                 additional_move_line_filter):
+                    if mode not in period_ids_by_mode:
+                        period_ids_by_mode[mode] = \
+                            self._get_period_ids_for_mode(
+                                period_from, period_to, mode)
+                    sums = self._read_period_balance_sums(
+                        period_ids_by_mode[mode],
+                        self._map_account_ids[key],
+                        target_move, groupby)
+                else:
+                    if mode not in domain_by_mode:
+                        domain_by_mode[mode] = \
+                            self.get_aml_domain_for_dates(
+                                date_from, date_to,
+                                period_from, period_to,
+                                mode, target_move)
+                    domain = list(domain) + domain_by_mode[mode]
+                    domain.append(('account_id', 'in',
+                                   self._map_account_ids[key]))
+                    if additional_move_line_filter:
+                        domain.extend(additional_move_line_filter)
+                    # fetch sum of debit/credit, grouped by account_id
+                    # (and dimension)
+                    sums = self._read_sums(domain, groupby)
+                profile_entry['rows'] = len(sums)
+            for values, debit, credit in sums:
+                self._add_sums(self._data[key], self._dimension_data[key],
+                               values, debit, credit)
 
     def replace_expr(self, expr):
         """Replace accounting variables in an expression by their amount.
@@ -345,22 +743,60 @@ class AccountingExpressionProcessor(object):
 
         This method must be executed after do_queries().
         """
-        def f(mo):
-            field, mode, account_codes, domain = self._parse_match_object(mo)
-            key = (domain, mode)
-            account_ids_data = self._data[key]
-            v = AccountingNone
-            for account_code in account_codes:
-                account_ids = self._account_ids_by_code[account_code]
-                for account_id in account_ids:
-                    debit, credit = \
-                        account_ids_data.get(account_id,
-                                             (AccountingNone, AccountingNone))
-                    if field == 'bal':
-                        v += debit - credit
-                    elif field == 'deb':
-                        v += debit
-                    elif field == 'crd':
-                        v += credit
+        def f(field, mode, account_codes, domain):
+            v = self.get_var_value(field, mode, account_codes, domain)
             return '(' + repr(v) + ')'
-        return self.ACC_RE.sub(f, expr)
+        return self._replace_tokens(expr, f)
+
+    def get_var_value(self, field, mode, account_codes, domain):
+        """Get the amount of an accounting variable.
+
+        The accounting variable is given in the form returned by
+        _parse_match_object() and used as key by bind_expr().
+
+        This method must be executed after do_queries().
+        """
+        key = (domain, mode)
+        account_ids_data = self._data[key]
+        sums = [account_ids_data[account_id]
+                for account_code in account_codes
+                for account_id in self._account_ids_by_code[account_code]
+                if account_id in account_ids_data]
+        if not sums:
+            return AccountingNone
+        return _sum_field(field, sums)
+
+    def get_dimension_values(self):
+        """Get the values of the dimension found in the data
+        queried by do_queries(), None standing for move lines
+        without value.
+
+        This method must be executed after do_queries().
+        """
+        res = set()
+        for account_ids_data in self._dimension_data.values():
+            for sums_by_dimension in account_ids_data.values():
+                res.update(sums_by_dimension)
+        return res
+
+    def get_var_values_by_dimension(self, field, mode, account_codes,
+                                    domain):
+        """Get the amount of an accounting variable for each value of
+        the dimension, as {dimension value: amount}, None standing for
+        move lines without value. Values without data are omitted.
+
+        The accounting variable is given in the same form
+        as for get_var_value().
+
+        This method must be executed after do_queries().
+        """
+        key = (domain, mode)
+        account_ids_data = self._dimension_data.get(key, {})
+        sums_by_dimension = defaultdict(list)
+        for account_code in account_codes:
+            for account_id in self._account_ids_by_code[account_code]:
+                for dimension_value, sums in \
+                        account_ids_data.get(account_id, {}).items():
+                    sums_by_dimension[dimension_value].append(sums)
+        return dict((dimension_value, _sum_field(field, sums))
+                    for dimension_value, sums in sums_by_dimension.items())
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""
+Compilation of MIS report KPI expressions.
+
+KPI expressions are compiled once, with accounting variables replaced by
+python names, so evaluating a KPI for a period only needs a dictionary
+of variable values, without parsing and compiling the expression again.
+
+KPI expressions may reference other KPI's by name. The names referenced by
+each expression are analyzed statically to obtain an evaluation order
+where each KPI is evaluated after the KPI's it depends on, so each KPI
+is evaluated exactly once per period. KPI's involved in cyclic dependencies
+are detected at compilation time.
+
+KPI's made of arithmetic operations only can also be evaluated once
+for all periods of a report, with arrays of values (see kpi_vector).
+
+Compiled KPI's are cached, keyed on the names and expressions of the KPI's
+of a report, so any change to the KPI's of a report invalidates the cache.
+"""
+
+import ast
+import heapq
+from collections import defaultdict
+
+from openerp.tools.lru import LRU
+from openerp.tools.safe_eval import safe_eval, test_expr, _SAFE_OPCODES
+
+from .accounting_none import AccountingNone
+from .aep import AccountingExpressionProcessor as AEP
+from .kpi_vector import is_vectorizable
+
+__all__ = ['get_compiled_kpis']
+
+# obtain the restricted builtins used by safe_eval
+_globals_dict = {}
+safe_eval('None', _globals_dict, nocopy=True)
+_BUILTINS = _globals_dict['__builtins__']
+
+_compiled_kpis_cache = LRU(512)
+
+
+class CompiledKpis(object):
+    """ The KPI expressions of a report, compiled.
+
+    KPI's are identified by their index in the list of (name, expression)
+    the CompiledKpis was created with.
+    """
+
+    def __init__(self, kpis):
+        # {(field, mode, account codes, domain): python name}
+        self.aep_vars = {}
+        self.names = []
+        self.exprs = []
+        self.codes = []
+        self.has_account_var = []
+        # True for expressions that can be evaluated with AccountingArray's
+        self.vectorizable = []
+        for name, expression in kpis:
+            expr = AEP.bind_expr(expression, self.aep_vars)
+            try:
+                code = test_expr(expr, _SAFE_OPCODES, mode='eval')
+            except Exception:
+                # compilation errors are raised when evaluating
+                code = None
+            self.names.append(name)
+            self.exprs.append(expr)
+            self.codes.append(code)
+            self.has_account_var.append(AEP.has_account_var(expression))
+            self.vectorizable.append(code is not None and
+                                     is_vectorizable(expr))
+        self._compute_order()
+
+    def _get_names(self, i):
+        """ Return the set of names an expression reads """
+        try:
+            tree = ast.parse(self.exprs[i], mode='eval')
+        except SyntaxError:
+            return set()
+        loaded = set()
+        stored = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    loaded.add(node.id)
+                else:
+                    # eg loop variables of generator expressions
+                    stored.add(node.id)
+        return loaded - stored
+
+    def _compute_order(self):
+        """ Compute the evaluation order of KPI's (self.order)
+        and detect cyclic dependencies (self.cycles).
+
+        self.order is a topological order of the KPI's, which preserves
+        the original order as much as possible, followed by KPI's that
+        cannot be ordered. The latter are in self.cycles, which maps
+        their index to the names of the KPI's they depend on and
+        that cannot be evaluated before them. """
+        indices_by_name = defaultdict(list)
+        for i, name in enumerate(self.names):
+            indices_by_name[name].append(i)
+        # names read by each expression (kpis, accounting variables,
+        # queries...)
+        self.used_names = [self._get_names(i)
+                           for i in range(len(self.names))]
+        # {i: set of indices of kpis i depends on}
+        deps = {}
+        # {i: indices of kpis depending on i}
+        dependents = defaultdict(list)
+        for i in range(len(self.names)):
+            deps[i] = set()
+            for name in self.used_names[i]:
+                deps[i].update(indices_by_name.get(name, []))
+            for j in deps[i]:
+                dependents[j].append(i)
+        # Kahn's algorithm, picking the smallest available index first
+        ready = [i for i in deps if not deps[i]]
+        heapq.heapify(ready)
+        remaining = dict((i, len(deps[i])) for i in deps)
+        self.order = []
+        while ready:
+            i = heapq.heappop(ready)
+            self.order.append(i)
+            for j in dependents[i]:
+                remaining[j] -= 1
+                if not remaining[j]:
+                    heapq.heappush(ready, j)
+        ordered = set(self.order)
+        self.cycles = {}
+        for i in range(len(self.names)):
+            if i not in ordered:
+                self.order.append(i)
+                self.cycles[i] = sorted(set(
+                    self.names[j] for j in deps[i] if j not in ordered))
+
+    def get_aep_values(self, aep):
+        """ Return the value of all accounting variables, keyed
+        by their python name, for the period aep has been queried for. """
+        res = {}
+        for var, var_name in self.aep_vars.items():
+            res[var_name] = aep.get_var_value(*var)
+        return res
+
+    def get_aep_values_by_dimension(self, aep):
+        """ Return the value of all accounting variables for each value
+        of the dimension of aep, as {dimension value: {python name: value}}
+        (see AccountingExpressionProcessor.get_var_values_by_dimension()).
+        Variables without data for a dimension value are AccountingNone. """
+        res = {}
+        for dimension_value in aep.get_dimension_values():
+            res[dimension_value] = dict.fromkeys(self.aep_vars.values(),
+                                                 AccountingNone)
+        for var, var_name in self.aep_vars.items():
+            for dimension_value, value in \
+                    aep.get_var_values_by_dimension(*var).items():
+                res[dimension_value][var_name] = value
+        return res
+
+    def eval_kpi(self, i, localdict):
+        """ Evaluate a KPI in localdict, which must contain the
+        values of accounting variables (see get_aep_values) """
+        code = self.codes[i]
+        if code is None:
+            # compile again to raise the error
+            code = test_expr(self.exprs[i], _SAFE_OPCODES, mode='eval')
+        localdict['__builtins__'] = _BUILTINS
+        return eval(code, localdict)
+
+
+def get_compiled_kpis(kpis):
+    """ Get the CompiledKpis for a list of (name, expression) """
+    key = tuple(kpis)
+    try:
+        return _compiled_kpis_cache[key]
+    except KeyError:
+        compiled_kpis = _compiled_kpis_cache[key] = CompiledKpis(kpis)
+        return compiled_kpis
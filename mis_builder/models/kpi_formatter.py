@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""
+Rendering of MIS report KPI values.
+
+A KpiFormatter resolves the grouping and separators of a language once,
+and builds the format of numbers once per divider, rounding, sign,
+prefix and suffix, so rendering the cells of a report does not read the
+language and rebuild formats for each cell.
+"""
+
+from locale import localeconv
+
+from openerp.addons.base.res.res_lang import intersperse
+from openerp.tools.safe_eval import safe_eval
+
+from .accounting_none import AccountingNone
+
+__all__ = ['KpiFormatter']
+
+
+class KpiFormatter(object):
+    """ Render KPI values as unicode strings, ready for display.
+
+    A formatter does not keep a reference to the environment it has been
+    created with, so it can be shared by threads computing periods.
+    """
+
+    def __init__(self, lang, divider_labels, pp_label):
+        """
+        :param lang: a res.lang record
+        :param divider_labels: {divider: label} of the KPI divider selection
+        :param pp_label: the translated suffix of percentage points
+        """
+        self.grouping = safe_eval(lang.grouping)
+        self.thousands_sep = lang.thousands_sep or \
+            localeconv()['thousands_sep']
+        self.decimal_point = lang.decimal_point
+        self.divider_labels = divider_labels
+        self.pp_label = pp_label
+        # {(divider, dp, prefix, suffix, sign): (divisor, format, head, tail)}
+        self._num_formats = {}
+        # {kpi id: (type, divider, dp, prefix, suffix, compare_method)}
+        self._kpi_specs = {}
+
+    def _get_num_format(self, divider, dp, prefix, suffix, sign):
+        key = (divider, dp, prefix, suffix, sign)
+        try:
+            return self._num_formats[key]
+        except KeyError:
+            pass
+        divider_label = self.divider_labels.get(divider, '')
+        if divider_label == '1':
+            divider_label = ''
+        head = u'%s\N{NARROW NO-BREAK SPACE}' % (prefix or '',)
+        tail = u'\N{NO-BREAK SPACE}%s%s' % (divider_label, suffix or '')
+        num_format = self._num_formats[key] = (
+            float(divider or 1),
+            '%%%s.%df' % (sign, dp),
+            head.replace('-', u'\N{NON-BREAKING HYPHEN}'),
+            tail.replace('-', u'\N{NON-BREAKING HYPHEN}'),
+        )
+        return num_format
+
+    def render_num(self, value, divider, dp, prefix, suffix, sign='-'):
+        """ Render a number divided by divider, rounded to dp digits,
+        with grouping following the language """
+        divisor, num_format, head, tail = \
+            self._get_num_format(divider, dp, prefix, suffix, sign)
+        value = round(value / divisor, dp) or 0
+        parts = (num_format % value).split('.')
+        parts[0] = intersperse(parts[0], self.grouping,
+                               self.thousands_sep)[0]
+        value = self.decimal_point.join(parts)
+        return head + value.replace('-', u'\N{NON-BREAKING HYPHEN}') + tail
+
+    def _get_kpi_spec(self, kpi):
+        try:
+            return self._kpi_specs[kpi.id]
+        except KeyError:
+            spec = self._kpi_specs[kpi.id] = (
+                kpi.type, kpi.divider, kpi.dp,
+                kpi.prefix, kpi.suffix, kpi.compare_method)
+            return spec
+
+    def _render(self, spec, value):
+        kpi_type, divider, dp, prefix, suffix, compare_method = spec
+        if value is None or value is AccountingNone:
+            return ''
+        elif kpi_type == 'num':
+            return self.render_num(value, divider, dp, prefix, suffix)
+        elif kpi_type == 'pct':
+            return self.render_num(value, 0.01, dp, '', '%')
+        else:
+            return unicode(value)
+
+    def render(self, kpi, value):
+        """ Render a value of a KPI """
+        return self._render(self._get_kpi_spec(kpi), value)
+
+    def render_row(self, kpi, values):
+        """ Render a list of values of a KPI (eg the values of all
+        periods), returning the list of rendered values """
+        spec = self._get_kpi_spec(kpi)
+        return [self._render(spec, value) for value in values]
+
+    def render_comparison(self, kpi, value, base_value,
+                          average_value, average_base_value):
+        """ Render the comparison of two values of a KPI
+
+        If the difference is 0, an empty string is returned.
+        """
+        kpi_type, divider, dp, prefix, suffix, compare_method = \
+            self._get_kpi_spec(kpi)
+        if value is None:
+            value = AccountingNone
+        if base_value is None:
+            base_value = AccountingNone
+        if kpi_type == 'pct':
+            delta = value - base_value
+            if delta and round(delta, dp) != 0:
+                return self.render_num(delta, 0.01, dp, '', self.pp_label,
+                                       sign='+')
+        elif kpi_type == 'num':
+            if value and average_value:
+                value = value / float(average_value)
+            if base_value and average_base_value:
+                base_value = base_value / float(average_base_value)
+            if compare_method == 'diff':
+                delta = value - base_value
+                if delta and round(delta, dp) != 0:
+                    return self.render_num(delta, divider, dp,
+                                           prefix, suffix, sign='+')
+            elif compare_method == 'pct':
+                if base_value and round(base_value, dp) != 0:
+                    delta = (value - base_value) / abs(base_value)
+                    if delta and round(delta, dp) != 0:
+                        return self.render_num(delta, 0.01, dp, '', '%',
+                                               sign='+')
+        return ''
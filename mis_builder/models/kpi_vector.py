@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""
+Vectorised evaluation of KPI expressions across periods.
+
+An AccountingArray holds the values of a variable for several periods,
+with a mask of the periods where the value is AccountingNone. Arithmetic
+operations on AccountingArray's follow the semantics of AccountingNone
+period by period, so evaluating a KPI expression once with arrays gives
+the same values as evaluating it for each period (except that results are
+always floats, where the scalar evaluation may return integers, such as
+1 - AccountingNone).
+
+>>> a = AccountingArray.from_values([1.0, AccountingNone, AccountingNone])
+>>> b = AccountingArray.from_values([2.0, 3.0, AccountingNone])
+>>> (a + b).to_values()
+[3.0, 3.0, AccountingNone]
+>>> (a - b).to_values()
+[-1.0, -3.0, AccountingNone]
+>>> (a * b).to_values()
+[2.0, 0.0, AccountingNone]
+>>> (-a * 2).to_values()
+[-2.0, 0.0, 0.0]
+>>> (a / b).to_values()
+[0.5, 0.0, AccountingNone]
+>>> (1 - a).to_values()
+[0.0, 1.0, 1.0]
+>>> (a + AccountingNone).to_values()
+[1.0, AccountingNone, AccountingNone]
+>>> b / a
+Traceback (most recent call last):
+ ...
+ZeroDivisionError
+>>> a / AccountingArray.from_values([0.0, 0.0, 0.0])
+Traceback (most recent call last):
+ ...
+ZeroDivisionError
+
+Only floats and AccountingNone can be stored in arrays:
+
+>>> AccountingArray.from_values([1.0, 'a']) is None
+True
+
+Only expressions made of arithmetic operators, numbers and names
+are evaluated with arrays, other expressions (using queries, functions,
+comparisons...) must be evaluated for each period:
+
+>>> is_vectorizable('_aep_0 + kpi1 * 2 / -_aep_1')
+True
+>>> is_vectorizable('_aep_0 if _aep_0 > 0 else 0')
+False
+>>> is_vectorizable('query.amount')
+False
+>>> is_vectorizable('sum([_aep_0])')
+False
+"""
+
+import ast
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # vectorised evaluation is not available
+
+from .accounting_none import AccountingNone
+
+__all__ = ['AccountingArray', 'is_vectorizable', 'HAS_NUMPY']
+
+HAS_NUMPY = np is not None
+
+_VECTORIZABLE_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Num, ast.Name, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.UAdd, ast.USub,
+)
+
+
+def is_vectorizable(expr):
+    """ Return True if expr can be evaluated with AccountingArray's
+    in place of its names """
+    try:
+        tree = ast.parse(expr, mode='eval')
+    except SyntaxError:
+        return False
+    return all(isinstance(node, _VECTORIZABLE_NODES)
+               for node in ast.walk(tree))
+
+
+class AccountingArray(object):
+    """ Values of an accounting variable or KPI for several periods.
+
+    values is an array of floats, and none is a mask of the values that
+    are AccountingNone (the corresponding floats are 0).
+    """
+
+    __slots__ = ('values', 'none')
+
+    def __init__(self, values, none):
+        self.values = values
+        self.none = none
+
+    @classmethod
+    def from_values(cls, values):
+        """ Create an array from a list of floats and AccountingNone,
+        or return None if the list contains other values """
+        if np is None:
+            return None
+        none = []
+        floats = []
+        for value in values:
+            if value is AccountingNone:
+                none.append(True)
+                floats.append(0.0)
+            elif type(value) is float:
+                none.append(False)
+                floats.append(value)
+            else:
+                return None
+        return cls(np.array(floats, dtype=float), np.array(none, dtype=bool))
+
+    def to_values(self):
+        """ Return the list of floats and AccountingNone """
+        return [AccountingNone if none else float(value)
+                for value, none in zip(self.values.tolist(),
+                                       self.none.tolist())]
+
+    @classmethod
+    def broadcast(cls, value, size):
+        """ Return the list of values for size periods of the result
+        of an expression evaluated with arrays, which may be a scalar
+        if the expression does not depend on arrays """
+        if isinstance(value, cls):
+            return value.to_values()
+        return [value] * size
+
+    def _coerce(self, other):
+        if isinstance(other, AccountingArray):
+            return other
+        if other is AccountingNone:
+            return AccountingArray(np.zeros_like(self.values),
+                                   np.ones_like(self.none))
+        if isinstance(other, (int, long, float)):
+            return AccountingArray(np.full_like(self.values, other),
+                                   np.zeros_like(self.none))
+        return None
+
+    def __add__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return AccountingArray(self.values + other.values,
+                               self.none & other.none)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return AccountingArray(self.values - other.values,
+                               self.none & other.none)
+
+    def __rsub__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return other.__sub__(self)
+
+    def __mul__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return AccountingArray(self.values * other.values,
+                               self.none & other.none)
+
+    __rmul__ = __mul__
+
+    def _divide(self, other, divide):
+        # x / 0 and x / AccountingNone raise ZeroDivisionError,
+        # AccountingNone / y is 0 and AccountingNone / AccountingNone
+        # is AccountingNone
+        zero = other.none | (other.values == 0)
+        if (zero & ~self.none).any():
+            raise ZeroDivisionError
+        divisor = np.where(zero, 1.0, other.values)
+        values = np.where(self.none, 0.0, divide(self.values, divisor))
+        return AccountingArray(values, self.none & other.none)
+
+    def __div__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._divide(other, np.true_divide)
+
+    __truediv__ = __div__
+
+    def __rdiv__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return other._divide(self, np.true_divide)
+
+    __rtruediv__ = __rdiv__
+
+    def __floordiv__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._divide(other, np.floor_divide)
+
+    def __rfloordiv__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return other._divide(self, np.floor_divide)
+
+    def __neg__(self):
+        # AccountingNone stays 0 (and not -0.0)
+        return AccountingArray(np.where(self.none, 0.0, -self.values),
+                               self.none)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return AccountingArray(np.abs(self.values), self.none)
+
+    def __nonzero__(self):
+        # the truth value of several periods is ambiguous
+        raise TypeError("AccountingArray has no truth value")
+
+    __bool__ = __nonzero__
+
+    def __repr__(self):
+        return 'AccountingArray(%r)' % (self.to_values(),)
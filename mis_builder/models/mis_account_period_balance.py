@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import logging
+
+import psycopg2
+
+from openerp import SUPERUSER_ID, api, fields, models, tools, _
+from openerp.exceptions import Warning as UserError
+import openerp.addons.decimal_precision as dp
+
+_logger = logging.getLogger(__name__)
+
+ENABLED_PARAM = 'mis_builder.period_balance'
+# context key disabling the maintenance of period balances by move line
+# hooks, while moves are posted or cancelled (see AccountMove)
+NO_UPDATE_KEY = 'mis_period_balance_no_update'
+
+# changing these fields of move lines changes period balances
+_MOVE_LINE_BALANCE_FIELDS = ('debit', 'credit', 'account_id',
+                             'period_id', 'move_id')
+
+
+class MisAccountPeriodBalance(models.Model):
+    """ Debit and credit of move lines per account, fiscal period
+    and move state.
+
+    This optional pre-aggregated table lets the accounting expression
+    processor compute fiscal period based balances (in particular initial
+    and ending balances, which cover all periods since the last opening
+    period) without scanning move lines.
+
+    It is enabled and built by rebuild(), then maintained incrementally
+    when move lines are created, modified or deleted and when moves
+    are posted or cancelled. check_consistency() compares it with
+    account_move_line.
+    """
+
+    _name = 'mis.account.period.balance'
+    _description = 'MIS Builder period balance'
+    _log_access = False
+
+    company_id = fields.Many2one('res.company', string='Company',
+                                 readonly=True)
+    account_id = fields.Many2one('account.account', string='Account',
+                                 required=True, readonly=True, index=True)
+    period_id = fields.Many2one('account.period', string='Period',
+                                required=True, readonly=True, index=True)
+    move_state = fields.Selection([('draft', 'Unposted'),
+                                   ('posted', 'Posted')],
+                                  string='Move status',
+                                  required=True, readonly=True)
+    debit = fields.Float(digits=dp.get_precision('Account'), readonly=True)
+    credit = fields.Float(digits=dp.get_precision('Account'), readonly=True)
+
+    _sql_constraints = [
+        ('account_period_state_unique',
+         'unique(account_id, period_id, move_state)',
+         'Period balances must be unique by account, period and state!'),
+    ]
+
+    @tools.ormcache(skiparg=2)
+    def _is_enabled(self, cr, uid):
+        return self.pool['ir.config_parameter'].get_param(
+            cr, SUPERUSER_ID, ENABLED_PARAM) == '1'
+
+    def _set_enabled(self, enabled):
+        self.env['ir.config_parameter'].sudo().set_param(
+            ENABLED_PARAM, enabled and '1' or '0')
+        # ormcache lives on the registry model, not on recordsets
+        self.pool[self._name].clear_caches()
+
+    @api.model
+    def rebuild(self):
+        """ Rebuild all period balances from move lines,
+        and enable their use in MIS reports. """
+        self.env.cr.execute("DELETE FROM %s" % self._table)
+        self.env.cr.execute("""
+            INSERT INTO %s
+                (company_id, account_id, period_id, move_state,
+                 debit, credit)
+            SELECT l.company_id, l.account_id, l.period_id, m.state,
+                   SUM(l.debit), SUM(l.credit)
+            FROM account_move_line l
+            JOIN account_move m ON m.id = l.move_id
+            GROUP BY l.company_id, l.account_id, l.period_id, m.state
+        """ % self._table)
+        _logger.info("rebuilt %d period balances", self.env.cr.rowcount)
+        self.invalidate_cache()
+        self._set_enabled(True)
+        return True
+
+    @api.model
+    def disable(self):
+        """ Stop using and maintaining period balances """
+        self._set_enabled(False)
+        self.env.cr.execute("DELETE FROM %s" % self._table)
+        self.invalidate_cache()
+        return True
+
+    @api.model
+    def check_consistency(self):
+        """ Compare period balances with the sum of move lines.
+
+        Returns a list of dictionaries describing the differences. """
+        self.env.cr.execute("""
+            WITH actual AS (
+                SELECT l.account_id, l.period_id, m.state AS move_state,
+                       SUM(l.debit) AS debit, SUM(l.credit) AS credit
+                FROM account_move_line l
+                JOIN account_move m ON m.id = l.move_id
+                GROUP BY l.account_id, l.period_id, m.state
+            )
+            SELECT COALESCE(a.account_id, b.account_id) AS account_id,
+                   COALESCE(a.period_id, b.period_id) AS period_id,
+                   COALESCE(a.move_state, b.move_state) AS move_state,
+                   COALESCE(a.debit, 0) AS debit,
+                   COALESCE(a.credit, 0) AS credit,
+                   COALESCE(b.debit, 0) AS balance_debit,
+                   COALESCE(b.credit, 0) AS balance_credit
+            FROM actual a
+            FULL OUTER JOIN %s b ON
+                a.account_id = b.account_id AND
+                a.period_id = b.period_id AND
+                a.move_state = b.move_state
+            WHERE COALESCE(a.debit, 0) != COALESCE(b.debit, 0) OR
+                  COALESCE(a.credit, 0) != COALESCE(b.credit, 0)
+        """ % self._table)
+        res = self.env.cr.dictfetchall()
+        for diff in res:
+            _logger.warning("inconsistent period balance %s", diff)
+        return res
+
+    @api.model
+    def action_check_consistency(self):
+        diffs = self.check_consistency()
+        if diffs:
+            raise UserError(
+                _("%d period balances do not match move lines. "
+                  "Please rebuild period balances.") % len(diffs))
+        return True
+
+    @api.model
+    def _add_balance(self, account_id, period_id, move_state,
+                     debit, credit):
+        self.env.cr.execute("""
+            UPDATE %s SET debit = debit + %%s, credit = credit + %%s
+            WHERE account_id = %%s AND period_id = %%s AND move_state = %%s
+        """ % self._table, (debit, credit, account_id, period_id, move_state))
+        return self.env.cr.rowcount
+
+    @api.model
+    def _update_move_lines(self, line_ids, sign):
+        """ Add (sign=1) or remove (sign=-1) the current debit and credit
+        of move lines to the period balances.
+
+        Modifications of move lines are handled by removing the lines
+        before the modification and adding them back after.
+
+        Maintaining period balances adds contention to posting: the
+        updated balance rows stay locked until the end of the transaction,
+        so transactions posting on the same accounts and periods wait
+        for each other. Rows are updated in a fixed order so such
+        transactions do not deadlock. A row created concurrently by
+        another transaction makes the insert fail on the unique
+        constraint: it is then rolled back to a savepoint and the
+        existing row is updated instead. """
+        cr = self.env.cr
+        if not line_ids or self.env.context.get(NO_UPDATE_KEY) or \
+                not self.pool[self._name]._is_enabled(cr, self.env.uid):
+            return
+        cr.execute("""
+            SELECT l.company_id, l.account_id, l.period_id, m.state,
+                   SUM(l.debit), SUM(l.credit)
+            FROM account_move_line l
+            JOIN account_move m ON m.id = l.move_id
+            WHERE l.id IN %s
+            GROUP BY l.company_id, l.account_id, l.period_id, m.state
+            ORDER BY l.account_id, l.period_id, m.state
+        """, (tuple(line_ids),))
+        for company_id, account_id, period_id, move_state, debit, credit \
+                in cr.fetchall():
+            debit = sign * (debit or 0.0)
+            credit = sign * (credit or 0.0)
+            if self._add_balance(account_id, period_id, move_state,
+                                 debit, credit):
+                continue
+            try:
+                with cr.savepoint():
+                    cr.execute("""
+                        INSERT INTO %s
+                            (company_id, account_id, period_id, move_state,
+                             debit, credit)
+                        VALUES (%%s, %%s, %%s, %%s, %%s, %%s)
+                    """ % self._table,
+                               (company_id, account_id, period_id,
+                                move_state, debit, credit),
+                               log_exceptions=False)
+            except psycopg2.IntegrityError:
+                # inserted by a concurrent transaction since the update
+                self._add_balance(account_id, period_id, move_state,
+                                  debit, credit)
+        self.invalidate_cache()
+
+    def _get_move_line_ids(self, cr, uid, move_ids):
+        cr.execute("SELECT id FROM account_move_line WHERE move_id IN %s",
+                   (tuple(move_ids),))
+        return [r[0] for r in cr.fetchall()]
+
+    def _update_moves(self, cr, uid, move_ids, method, context=None):
+        """ Call method of account.move on move_ids, moving their lines
+        from the period balances of their former state to the ones of
+        their new state.
+
+        Move line hooks are disabled during the call: lines created,
+        modified or deleted by method (eg centralisation counterparts
+        created when posting) are accounted for by removing the lines
+        of the moves before the call and adding the lines of the moves
+        after the call. """
+        if not move_ids or not self._is_enabled(cr, uid):
+            return method(cr, uid, move_ids, context=context)
+        self._update_move_lines(
+            cr, uid, self._get_move_line_ids(cr, uid, move_ids), -1,
+            context=context)
+        res = method(cr, uid, move_ids,
+                     context=dict(context or {}, **{NO_UPDATE_KEY: True}))
+        self._update_move_lines(
+            cr, uid, self._get_move_line_ids(cr, uid, move_ids), 1,
+            context=context)
+        return res
+
+
+class AccountMoveLine(models.Model):
+
+    _inherit = 'account.move.line'
+
+    def create(self, cr, uid, vals, context=None, check=True):
+        res = super(AccountMoveLine, self).create(
+            cr, uid, vals, context=context, check=check)
+        self.pool['mis.account.period.balance']._update_move_lines(
+            cr, uid, [res], 1, context=context)
+        return res
+
+    def write(self, cr, uid, ids, vals, context=None, check=True,
+              update_check=True):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        balance_obj = self.pool['mis.account.period.balance']
+        update_balance = any(f in vals for f in _MOVE_LINE_BALANCE_FIELDS)
+        if update_balance:
+            balance_obj._update_move_lines(cr, uid, ids, -1, context=context)
+        res = super(AccountMoveLine, self).write(
+            cr, uid, ids, vals, context=context, check=check,
+            update_check=update_check)
+        if update_balance:
+            balance_obj._update_move_lines(cr, uid, ids, 1, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None, check=True):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool['mis.account.period.balance']._update_move_lines(
+            cr, uid, ids, -1, context=context)
+        return super(AccountMoveLine, self).unlink(
+            cr, uid, ids, context=context, check=check)
+
+
+class AccountMove(models.Model):
+
+    _inherit = 'account.move'
+
+    def post(self, cr, uid, ids, context=None):
+        # the move state is changed with SQL, move lines
+        # from draft to posted period balances
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        return self.pool['mis.account.period.balance']._update_moves(
+            cr, uid, ids, super(AccountMove, self).post, context=context)
+
+    def button_cancel(self, cr, uid, ids, context=None):
+        # the move state is changed with SQL, move lines
+        # from posted to draft period balances
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        return self.pool['mis.account.period.balance']._update_moves(
+            cr, uid, ids, super(AccountMove, self).button_cancel,
+            context=context)
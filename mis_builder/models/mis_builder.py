@@ -2,24 +2,61 @@
 # © 2014-2015 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import copy
+from collections import defaultdict
 import datetime
 import dateutil
 import logging
 import re
+import threading
 import time
 import traceback
+from multiprocessing.pool import ThreadPool
 
 import pytz
 
-from openerp import api, fields, models, _
+from openerp import api, fields, models, tools, _
+from openerp.exceptions import ValidationError
+from openerp.tools.lru import LRU
 from openerp.tools.safe_eval import safe_eval
 
 from .aep import AccountingExpressionProcessor as AEP
 from .aggregate import _sum, _avg, _min, _max
 from .accounting_none import AccountingNone
+from .kpi_compiler import get_compiled_kpis
+from .kpi_formatter import KpiFormatter
+from .kpi_vector import AccountingArray, HAS_NUMPY
+from .period_calendar import get_period_calendar
+from .profiler import Profiler, NULL_PROFILER
 
 _logger = logging.getLogger(__name__)
 
+# results of mis.report.instance.compute(), for instances with cache_results
+_compute_cache = LRU(64)
+
+# kpi values of report columns, keyed by window (dates, fiscal periods),
+# report settings, filters and data watermark, so columns of instances with
+# cache_results are not computed again when other columns change
+_window_cache = LRU(1024)
+
+# number of periods of the layout computed by each call of
+# mis.report.instance.compute_period_columns() in the preview, unless
+# more periods are compared with each other
+PERIOD_BATCH_SIZE = 3
+
+# maximum number of threads computing the periods of a report instance,
+# each with its own database connection (see compute_workers)
+MAX_COMPUTE_WORKERS = 8
+
+# SQL expressions of query aggregates; null values are aggregated as 0
+# for avg, min and max, as they are read as 0 by search_read
+_SQL_AGGREGATES = {
+    'sum': 'SUM(%s)',
+    'avg': 'AVG(COALESCE(%s, 0))',
+    'min': 'MIN(COALESCE(%s, 0))',
+    'max': 'MAX(COALESCE(%s, 0))',
+}
+
 
 class AutoStruct(object):
 
@@ -28,6 +65,59 @@ class AutoStruct(object):
             setattr(self, k, v)
 
 
+class QueryResult(object):
+    """ The records of a non aggregated query, as a sequence of AutoStruct.
+
+    Records are searched when first needed, and read by chunks
+    while iterating, so they are not all loaded in memory. len() counts
+    records without searching them.
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, model, domain, field_names, limit=None):
+        self._model = model
+        self._domain = domain
+        self._field_names = field_names
+        self._limit = limit
+        self._ids = None
+
+    def _get_ids(self):
+        if self._ids is None:
+            self._ids = self._model.search(self._domain,
+                                           limit=self._limit).ids
+        return self._ids
+
+    def _read(self, ids):
+        return [AutoStruct(**d)
+                for d in self._model.browse(ids).read(self._field_names)]
+
+    def __len__(self):
+        if self._ids is None:
+            count = self._model.search_count(self._domain)
+            if self._limit:
+                count = min(count, self._limit)
+            return count
+        return len(self._ids)
+
+    def __nonzero__(self):
+        if self._ids is None:
+            return bool(self._model.search(self._domain, limit=1))
+        return bool(self._ids)
+
+    def __iter__(self):
+        ids = self._get_ids()
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            for record in self._read(ids[i:i + self.CHUNK_SIZE]):
+                yield record
+
+    def __getitem__(self, index):
+        ids = self._get_ids()
+        if isinstance(index, slice):
+            return self._read(ids[index])
+        return self._read([ids[index]])[0]
+
+
 def _get_selection_label(selection, value):
     for v, l in selection:
         if v == value:
@@ -95,6 +185,11 @@ class MisReportKpi(models.Model):
                                       required=True,
                                       string='Comparison Method',
                                       default='pct')
+    expand = fields.Boolean(
+        string='Expand',
+        help='On report instances expanded by a dimension (partner, '
+             'analytic account or company), display the value of the KPI '
+             'for each value of the dimension, in rows or columns.')
     sequence = fields.Integer(string='Sequence', default=100)
     report_id = fields.Many2one('mis.report',
                                 string='Report',
@@ -138,19 +233,17 @@ class MisReportKpi(models.Model):
             self.divider = ''
             self.dp = 0
 
+    @api.model
+    def _get_formatter(self, lang_id):
+        """ Get a KpiFormatter to render KPI values in a language """
+        return KpiFormatter(self.env['res.lang'].browse(lang_id),
+                            dict(self._columns['divider'].selection),
+                            _('pp'))
+
     def render(self, lang_id, value):
         """ render a KPI value as a unicode string, ready for display """
         assert len(self) == 1
-        if value is None or value is AccountingNone:
-            return ''
-        elif self.type == 'num':
-            return self._render_num(lang_id, value, self.divider,
-                                    self.dp, self.prefix, self.suffix)
-        elif self.type == 'pct':
-            return self._render_num(lang_id, value, 0.01,
-                                    self.dp, '', '%')
-        else:
-            return unicode(value)
+        return self._get_formatter(lang_id).render(self, value)
 
     def render_comparison(self, lang_id, value, base_value,
                           average_value, average_base_value):
@@ -159,58 +252,13 @@ class MisReportKpi(models.Model):
         If the difference is 0, an empty string is returned.
         """
         assert len(self) == 1
-        if value is None:
-            value = AccountingNone
-        if base_value is None:
-            base_value = AccountingNone
-        if self.type == 'pct':
-            delta = value - base_value
-            if delta and round(delta, self.dp) != 0:
-                return self._render_num(
-                    lang_id,
-                    delta,
-                    0.01, self.dp, '', _('pp'),
-                    sign='+')
-        elif self.type == 'num':
-            if value and average_value:
-                value = value / float(average_value)
-            if base_value and average_base_value:
-                base_value = base_value / float(average_base_value)
-            if self.compare_method == 'diff':
-                delta = value - base_value
-                if delta and round(delta, self.dp) != 0:
-                    return self._render_num(
-                        lang_id,
-                        delta,
-                        self.divider, self.dp, self.prefix, self.suffix,
-                        sign='+')
-            elif self.compare_method == 'pct':
-                if base_value and round(base_value, self.dp) != 0:
-                    delta = (value - base_value) / abs(base_value)
-                    if delta and round(delta, self.dp) != 0:
-                        return self._render_num(
-                            lang_id,
-                            delta,
-                            0.01, self.dp, '', '%',
-                            sign='+')
-        return ''
+        return self._get_formatter(lang_id).render_comparison(
+            self, value, base_value, average_value, average_base_value)
 
     def _render_num(self, lang_id, value, divider,
                     dp, prefix, suffix, sign='-'):
-        divider_label = _get_selection_label(
-            self._columns['divider'].selection, divider)
-        if divider_label == '1':
-            divider_label = ''
-        # format number following user language
-        value = round(value / float(divider or 1), dp) or 0
-        value = self.env['res.lang'].browse(lang_id).format(
-            '%%%s.%df' % (sign, dp),
-            value,
-            grouping=True)
-        value = u'%s\N{NARROW NO-BREAK SPACE}%s\N{NO-BREAK SPACE}%s%s' % \
-            (prefix or '', value, divider_label, suffix or '')
-        value = value.replace('-', u'\N{NON-BREAKING HYPHEN}')
-        return value
+        return self._get_formatter(lang_id).render_num(
+            value, divider, dp, prefix, suffix, sign=sign)
 
 
 class MisReportQuery(models.Model):
@@ -241,6 +289,9 @@ class MisReportQuery(models.Model):
                                   ('min', _('Min')),
                                   ('max', _('Max'))],
                                  string='Aggregate')
+    limit = fields.Integer(string='Max rows',
+                           help='Maximum number of records of queries '
+                                'without aggregate (leave 0 for no limit).')
     date_field = fields.Many2one('ir.model.fields', required=True,
                                  string='Date field',
                                  domain=[('ttype', 'in',
@@ -262,8 +313,9 @@ class MisReport(models.Model):
 
     The MIS report holds:
     * a list of explicit queries; the result of each query is
-      stored in a variable with same name as a query, containing as list
-      of data structures populated with attributes for each fields to fetch;
+      stored in a variable with same name as a query, containing a sequence
+      of data structures populated with attributes for each fields to fetch
+      (read lazily, optionally limited to a maximum number of records);
       when queries have an aggregate method and no fields to group, it returns
       a data structure with the aggregated fields
     * a list of KPI to be evaluated based on the variables resulting
@@ -293,69 +345,255 @@ class MisReport(models.Model):
     # TODO: kpi name cannot be start with query name
 
     @api.multi
-    def _prepare_aep(self, root_account):
+    def _prepare_aep(self, root_account, dimension=None):
         self.ensure_one()
-        aep = AEP(self.env)
+        aep = AEP(self.env, dimension=dimension)
         for kpi in self.kpi_ids:
             aep.parse_expr(kpi.expression)
         aep.done_parsing(root_account)
         return aep
 
+    @api.multi
+    def _get_compiled_kpis(self):
+        """ Get the compiled expressions of the KPI's of the report,
+        in the order of kpi_ids """
+        self.ensure_one()
+        return get_compiled_kpis(
+            [(kpi.name, kpi.expression) for kpi in self.kpi_ids])
+
+    @api.multi
+    def _get_query_domain(self, query, get_additional_query_filter=None):
+        """ Return the domain of a query, without the date criteria """
+        self.ensure_one()
+        eval_context = {
+            'env': self.env,
+            'time': time,
+            'datetime': datetime,
+            'dateutil': dateutil,
+            # deprecated
+            'uid': self.env.uid,
+            'context': self.env.context,
+        }
+        domain = query.domain and \
+            safe_eval(query.domain, eval_context) or []
+        if get_additional_query_filter:
+            domain.extend(get_additional_query_filter(query))
+        return domain
+
+    @api.multi
+    def _get_query_date_domain(self, query, date_from, date_to):
+        """ Return the domain selecting the records of a query
+        between date_from and date_to (included) """
+        self.ensure_one()
+        if query.date_field.ttype == 'date':
+            return [(query.date_field.name, '>=', date_from),
+                    (query.date_field.name, '<=', date_to)]
+        else:
+            datetime_from = _utc_midnight(
+                date_from, self._context.get('tz', 'UTC'))
+            datetime_to = _utc_midnight(
+                date_to, self._context.get('tz', 'UTC'), add_day=1)
+            return [(query.date_field.name, '>=', datetime_from),
+                    (query.date_field.name, '<', datetime_to)]
+
     @api.multi
     def _fetch_queries(self, date_from, date_to,
-                       get_additional_query_filter=None):
+                       get_additional_query_filter=None,
+                       prefetched_queries=None,
+                       profiler=NULL_PROFILER):
+        """ Fetch the results of queries between date_from and date_to
+
+        :param prefetched_queries: optional results of some queries
+                                   for this period, keyed by query name
+                                   (see _fetch_queries_multi())
+        :param profiler: an optional Profiler measuring each query
+        """
         self.ensure_one()
         res = {}
+        for query in self.query_ids:
+            if prefetched_queries and query.name in prefetched_queries:
+                res[query.name] = prefetched_queries[query.name]
+                continue
+            with profiler.measure(self.env.cr, 'query', query.name) \
+                    as profile_entry:
+                res[query.name] = self._fetch_query(
+                    query, date_from, date_to, get_additional_query_filter)
+                profile_entry['rows'] = getattr(res[query.name], 'count',
+                                                None)
+        return res
+
+    @api.multi
+    def _fetch_query(self, query, date_from, date_to,
+                     get_additional_query_filter=None):
+        """ Fetch the result of a query between date_from and date_to """
+        self.ensure_one()
+        model = self.env[query.model_id.model]
+        domain = self._get_query_domain(query, get_additional_query_filter)
+        domain.extend(self._get_query_date_domain(query, date_from, date_to))
+        field_names = [f.name for f in query.field_ids]
+        if not query.aggregate:
+            return QueryResult(model, domain, field_names,
+                               query.limit or None)
+        s = self._fetch_query_aggregates(model, domain, field_names,
+                                         query.aggregate)
+        if s is not None:
+            return s
+        elif query.aggregate == 'sum':
+            data = model.read_group(
+                domain, field_names, [])
+            s = AutoStruct(count=data[0]['__count'])
+            for field_name in field_names:
+                v = data[0][field_name]
+                setattr(s, field_name, v)
+            return s
+        else:
+            data = model.search_read(domain, field_names)
+            s = AutoStruct(count=len(data))
+            if query.aggregate == 'min':
+                agg = _min
+            elif query.aggregate == 'max':
+                agg = _max
+            elif query.aggregate == 'avg':
+                agg = _avg
+            for field_name in field_names:
+                setattr(s, field_name,
+                        agg([d[field_name] for d in data]))
+            return s
+
+    @api.model
+    def _can_aggregate_in_sql(self, model, field_names):
+        """ Return True if the fields are numeric fields
+        stored in the table of model """
+        for field_name in field_names:
+            field = model._fields.get(field_name)
+            if field is None or field.type not in ('integer', 'float') or \
+                    not field.store or field.inherited:
+                return False
+        return True
+
+    @api.model
+    def _read_aggregates(self, model, domain, select,
+                         groupby=None, groupby_params=()):
+        """ Execute a SQL query selecting COUNT(*) and the select
+        expressions on the records of model matching domain,
+        applying access rights and record rules, optionally grouped by
+        the groupby expression (which is then selected first).
+
+        Returns the list of rows. """
+        model.check_access_rights('read')
+        query = model._where_calc(domain)
+        model._apply_ir_rules(query, 'read')
+        from_clause, where_clause, where_params = query.get_sql()
+        select = ['COUNT(*)'] + select
+        if groupby:
+            select.insert(0, groupby)
+        sql = "SELECT %s FROM %s" % (', '.join(select), from_clause)
+        if where_clause:
+            sql += " WHERE %s" % where_clause
+        if groupby:
+            sql += " GROUP BY 1"
+        self.env.cr.execute(sql, list(groupby_params) + where_params)
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _fetch_query_aggregates(self, model, domain, field_names, aggregate):
+        """ Aggregate fields of the records of model matching domain
+        in a single SQL query, applying access rights and record rules.
+
+        Returns an AutoStruct with the count of records and the aggregated
+        value of each field (None if there are no records), or None if
+        some fields cannot be aggregated in SQL (fields that are not
+        numeric or not stored in the table of model). """
+        if not self._can_aggregate_in_sql(model, field_names):
+            return None
+        row = self._read_aggregates(
+            model, domain,
+            [_SQL_AGGREGATES[aggregate] %
+             ('"%s"."%s"' % (model._table, field_name),)
+             for field_name in field_names])[0]
+        s = AutoStruct(count=row[0])
+        for field_name, value in zip(field_names, row[1:]):
+            setattr(s, field_name, value)
+        return s
+
+    @api.multi
+    def _fetch_queries_multi(self, date_ranges,
+                             get_additional_query_filter=None,
+                             profiler=NULL_PROFILER):
+        """ Fetch the results of aggregated queries for several date ranges
+        at once.
+
+        Each query is executed once for the whole span of the date ranges,
+        with results grouped by day (in the timezone of the user for
+        datetime fields), and the daily results are then combined for each
+        date range. Queries without aggregate and queries that cannot be
+        aggregated in SQL are not fetched.
+
+        :param date_ranges: a list of (date_from, date_to)
+        Returns a list of dictionaries (one per date range) of AutoStruct's
+        keyed by query name, to pass as prefetched_queries to
+        _fetch_queries(). """
+        self.ensure_one()
+        res = [{} for date_range in date_ranges]
+        if not date_ranges:
+            return res
+        span_from = min(date_from for date_from, date_to in date_ranges)
+        span_to = max(date_to for date_from, date_to in date_ranges)
         for query in self.query_ids:
             model = self.env[query.model_id.model]
-            eval_context = {
-                'env': self.env,
-                'time': time,
-                'datetime': datetime,
-                'dateutil': dateutil,
-                # deprecated
-                'uid': self.env.uid,
-                'context': self.env.context,
-            }
-            domain = query.domain and \
-                safe_eval(query.domain, eval_context) or []
-            if get_additional_query_filter:
-                domain.extend(get_additional_query_filter(query))
+            field_names = [f.name for f in query.field_ids]
+            date_field = model._fields.get(query.date_field.name)
+            if not query.aggregate or \
+                    not self._can_aggregate_in_sql(model, field_names) or \
+                    not date_field or not date_field.store or \
+                    date_field.inherited:
+                continue
+            domain = self._get_query_domain(query,
+                                            get_additional_query_filter)
+            domain.extend(self._get_query_date_domain(query,
+                                                      span_from, span_to))
+            date_column = '"%s"."%s"' % (model._table, date_field.name)
             if query.date_field.ttype == 'date':
-                domain.extend([(query.date_field.name, '>=', date_from),
-                               (query.date_field.name, '<=', date_to)])
+                groupby = "to_char(%s, 'YYYY-MM-DD')" % date_column
+                groupby_params = ()
             else:
-                datetime_from = _utc_midnight(
-                    date_from, self._context.get('tz', 'UTC'))
-                datetime_to = _utc_midnight(
-                    date_to, self._context.get('tz', 'UTC'), add_day=1)
-                domain.extend([(query.date_field.name, '>=', datetime_from),
-                               (query.date_field.name, '<', datetime_to)])
-            field_names = [f.name for f in query.field_ids]
-            if not query.aggregate:
-                data = model.search_read(domain, field_names)
-                res[query.name] = [AutoStruct(**d) for d in data]
-            elif query.aggregate == 'sum':
-                data = model.read_group(
-                    domain, field_names, [])
-                s = AutoStruct(count=data[0]['__count'])
-                for field_name in field_names:
-                    v = data[0][field_name]
-                    setattr(s, field_name, v)
-                res[query.name] = s
+                groupby = "to_char((%s AT TIME ZONE 'UTC') " \
+                    "AT TIME ZONE %%s, 'YYYY-MM-DD')" % date_column
+                groupby_params = (self._context.get('tz', 'UTC'),)
+            if query.aggregate == 'avg':
+                # average of each range = sum / count
+                aggregate = 'sum'
+                select = ['SUM(COALESCE(%s, 0))' % (
+                    '"%s"."%s"' % (model._table, field_name),)
+                    for field_name in field_names]
             else:
-                data = model.search_read(domain, field_names)
-                s = AutoStruct(count=len(data))
-                if query.aggregate == 'min':
-                    agg = _min
-                elif query.aggregate == 'max':
-                    agg = _max
-                elif query.aggregate == 'avg':
-                    agg = _avg
-                for field_name in field_names:
-                    setattr(s, field_name,
-                            agg([d[field_name] for d in data]))
-                res[query.name] = s
+                aggregate = query.aggregate
+                select = [_SQL_AGGREGATES[aggregate] % (
+                    '"%s"."%s"' % (model._table, field_name),)
+                    for field_name in field_names]
+            with profiler.measure(self.env.cr, 'query', query.name) \
+                    as profile_entry:
+                rows = self._read_aggregates(model, domain, select,
+                                             groupby, groupby_params)
+                profile_entry['rows'] = len(rows)
+            if aggregate == 'sum':
+                agg = _sum
+            elif aggregate == 'min':
+                agg = _min
+            elif aggregate == 'max':
+                agg = _max
+            for (date_from, date_to), queries in zip(date_ranges, res):
+                range_rows = [row for row in rows
+                              if date_from <= row[0] <= date_to]
+                count = sum(row[1] for row in range_rows)
+                s = AutoStruct(count=count)
+                for i, field_name in enumerate(field_names, 2):
+                    value = agg([row[i] for row in range_rows
+                                 if row[i] is not None])
+                    if query.aggregate == 'avg' and value is not None:
+                        value = value / float(count)
+                    setattr(s, field_name, value)
+                queries[query.name] = s
         return res
 
     @api.multi
@@ -365,7 +603,9 @@ class MisReport(models.Model):
                  target_move,
                  get_additional_move_line_filter=None,
                  get_additional_query_filter=None,
-                 period_id=None):
+                 period_id=None,
+                 formatter=None,
+                 prefetched_queries=None):
         """ Evaluate a report for a given period.
 
         It returns a dictionary keyed on kpi.name with the following values:
@@ -403,10 +643,95 @@ class MisReport(models.Model):
         :param period_id: an optional opaque value that is returned as
                           query_id field in the result (may change in the
                           future!)
+        :param formatter: an optional KpiFormatter for lang_id, to share
+                          between periods (see MisReportKpi._get_formatter())
+        :param prefetched_queries: optional results of some queries
+                                   (see _fetch_queries_multi())
+
+        When aep has a dimension, the values of KPI's with expand for each
+        value of the dimension are added too (see _compute_dimensions()).
         """
         self.ensure_one()
-        res = {}
+        compiled_kpis = self._get_compiled_kpis()
+        localdict = self._prepare_localdict(
+            compiled_kpis, aep,
+            date_from, date_to,
+            period_from, period_to,
+            target_move,
+            get_additional_move_line_filter,
+            get_additional_query_filter,
+            prefetched_queries)
+        kpi_evals = {}
+        # evaluate kpis in dependency order, so kpis referencing
+        # other kpis are evaluated after them
+        for i in compiled_kpis.order:
+            kpi_evals[i] = self._eval_kpi(compiled_kpis, i, localdict,
+                                          aep.profiler)
+        res = self._render_kpis(lang_id, compiled_kpis, localdict, kpi_evals,
+                                period_id, formatter)
+        if aep.dimension:
+            self._compute_dimensions(lang_id, compiled_kpis, localdict, aep,
+                                     res, period_id, formatter)
+        return res
 
+    @api.multi
+    def _compute_dimensions(self, lang_id, compiled_kpis, localdict, aep,
+                            kpi_values, period_id=None, formatter=None):
+        """ Evaluate the KPI's of a period for each value of the dimension
+        of aep, and add the values of KPI's with expand to kpi_values
+        (as returned by _compute()) under the dimensions key, as
+        {dimension value: kpi value}, where kpi values have a
+        dimension_value key (the id of the value, or False for
+        move lines without value).
+
+        The values of accounting variables of each dimension value
+        come from the queries done for the period, so no query is done.
+        Queries are not split by dimension: KPI's using them are evaluated
+        with the results of queries for the whole period.
+
+        :param localdict: the localdict the KPI's of the period have been
+                          evaluated in (see _prepare_localdict())
+        """
+        self.ensure_one()
+        expanded_kpis = self.kpi_ids.filtered(lambda kpi: kpi.expand)
+        if not expanded_kpis:
+            return
+        for kpi in expanded_kpis:
+            kpi_values[kpi.name]['dimensions'] = {}
+        # KPI's are evaluated again with the values of the dimension
+        kpi_names = set(compiled_kpis.names)
+        base_localdict = dict((name, value)
+                              for name, value in localdict.items()
+                              if name not in kpi_names)
+        for dimension_value, aep_values in \
+                compiled_kpis.get_aep_values_by_dimension(aep).items():
+            dimension_localdict = dict(base_localdict)
+            dimension_localdict.update(aep_values)
+            kpi_evals = {}
+            for i in compiled_kpis.order:
+                kpi_evals[i] = self._eval_kpi(compiled_kpis, i,
+                                              dimension_localdict)
+            dimension_kpi_values = self._render_kpis(
+                lang_id, compiled_kpis, dimension_localdict, kpi_evals,
+                period_id, formatter)
+            for kpi in expanded_kpis:
+                kpi_value = dimension_kpi_values[kpi.name]
+                kpi_value['dimension_value'] = dimension_value or False
+                kpi_values[kpi.name]['dimensions'][dimension_value] = \
+                    kpi_value
+
+    @api.multi
+    def _prepare_localdict(self, compiled_kpis, aep,
+                           date_from, date_to,
+                           period_from, period_to,
+                           target_move,
+                           get_additional_move_line_filter=None,
+                           get_additional_query_filter=None,
+                           prefetched_queries=None):
+        """ Prepare the dictionary KPI's of a period are evaluated in,
+        with the results of queries and the values of accounting
+        variables (see _compute() for the parameters) """
+        self.ensure_one()
         localdict = {
             'registry': self.pool,
             'sum': _sum,
@@ -418,7 +743,8 @@ class MisReport(models.Model):
         }
 
         localdict.update(self._fetch_queries(
-            date_from, date_to, get_additional_query_filter))
+            date_from, date_to, get_additional_query_filter,
+            prefetched_queries, aep.profiler))
 
         additional_move_line_filter = None
         if get_additional_move_line_filter:
@@ -427,69 +753,134 @@ class MisReport(models.Model):
                        period_from, period_to,
                        target_move,
                        additional_move_line_filter)
+        localdict.update(compiled_kpis.get_aep_values(aep))
+        return localdict
 
-        compute_queue = self.kpi_ids
-        recompute_queue = []
-        while True:
-            for kpi in compute_queue:
-                try:
-                    kpi_val_comment = kpi.name + " = " + kpi.expression
-                    kpi_eval_expression = aep.replace_expr(kpi.expression)
-                    kpi_val = safe_eval(kpi_eval_expression, localdict)
-                    localdict[kpi.name] = kpi_val
-                except ZeroDivisionError:
-                    kpi_val = None
-                    kpi_val_rendered = '#DIV/0'
-                    kpi_val_comment += '\n\n%s' % (traceback.format_exc(),)
-                except (NameError, ValueError):
-                    recompute_queue.append(kpi)
-                    kpi_val = None
-                    kpi_val_rendered = '#ERR'
-                    kpi_val_comment += '\n\n%s' % (traceback.format_exc(),)
-                except:
-                    kpi_val = None
-                    kpi_val_rendered = '#ERR'
-                    kpi_val_comment += '\n\n%s' % (traceback.format_exc(),)
-                else:
-                    kpi_val_rendered = kpi.render(lang_id, kpi_val)
+    @api.multi
+    def _eval_kpi(self, compiled_kpis, i, localdict, profiler=NULL_PROFILER):
+        """ Evaluate the KPI at index i in localdict, and store its
+        value in localdict.
+
+        Returns a tuple (value, rendered, comment) where rendered is None,
+        or '#ERR' or '#DIV/0' in case of error, and comment explains
+        the error. """
+        if profiler.enabled:
+            with profiler.measure(self.env.cr, 'kpi', compiled_kpis.names[i]):
+                return self._eval_kpi(compiled_kpis, i, localdict)
+        if i in compiled_kpis.cycles:
+            return (None, '#ERR', _('Cyclic dependency on %s') %
+                    ', '.join(compiled_kpis.cycles[i]))
+        try:
+            kpi_val = compiled_kpis.eval_kpi(i, localdict)
+        except ZeroDivisionError:
+            return None, '#DIV/0', traceback.format_exc()
+        except Exception:
+            return None, '#ERR', traceback.format_exc()
+        localdict[compiled_kpis.names[i]] = kpi_val
+        return kpi_val, None, None
 
-                try:
-                    kpi_style = None
-                    if kpi.css_style:
-                        kpi_style = safe_eval(kpi.css_style, localdict)
-                except:
-                    _logger.warning("error evaluating css stype expression %s",
-                                    kpi.css_style, exc_info=True)
-                    kpi_style = None
-
-                drilldown = (kpi_val is not None and
-                             AEP.has_account_var(kpi.expression))
-
-                res[kpi.name] = {
-                    'val': None if kpi_val is AccountingNone else kpi_val,
-                    'val_r': kpi_val_rendered,
-                    'val_c': kpi_val_comment,
-                    'style': kpi_style,
-                    'prefix': kpi.prefix,
-                    'suffix': kpi.suffix,
-                    'dp': kpi.dp,
-                    'is_percentage': kpi.type == 'pct',
-                    'period_id': period_id,
-                    'expr': kpi.expression,
-                    'drilldown': drilldown,
-                }
+    @api.multi
+    def _eval_kpis_vectorized(self, compiled_kpis, localdicts,
+                              profiler=NULL_PROFILER):
+        """ Evaluate the KPI's of several periods, each KPI being evaluated
+        once for all periods with arrays of values when possible, and for
+        each period otherwise (eg expressions using queries, string KPI's,
+        or errors in some periods).
+
+        Returns a list of {kpi index: (value, error, comment)}, one per
+        localdict. """
+        self.ensure_one()
+        kpi_types = [kpi.type for kpi in self.kpi_ids]
+        kpi_evals_list = [{} for localdict in localdicts]
+        arrays = {'AccountingNone': AccountingNone}
+        for var_name in compiled_kpis.aep_vars.values():
+            array = AccountingArray.from_values(
+                [localdict[var_name] for localdict in localdicts])
+            if array is not None:
+                arrays[var_name] = array
+        for i in compiled_kpis.order:
+            name = compiled_kpis.names[i]
+            with profiler.measure(self.env.cr, 'kpi', name):
+                self._eval_kpi_vectorized(compiled_kpis, i, localdicts,
+                                          kpi_evals_list, arrays,
+                                          kpi_types[i])
+            # make the kpi available to kpis depending on it
+            array = AccountingArray.from_values(
+                [localdict.get(name) for localdict in localdicts])
+            if array is not None:
+                arrays[name] = array
+            else:
+                arrays.pop(name, None)
+        return kpi_evals_list
+
+    @api.multi
+    def _eval_kpi_vectorized(self, compiled_kpis, i, localdicts,
+                             kpi_evals_list, arrays, kpi_type):
+        """ Evaluate the KPI at index i for all periods
+        (see _eval_kpis_vectorized()) """
+        name = compiled_kpis.names[i]
+        kpi_vals = None
+        if compiled_kpis.vectorizable[i] and kpi_type != 'str' \
+                and i not in compiled_kpis.cycles:
+            try:
+                kpi_vals = AccountingArray.broadcast(
+                    compiled_kpis.eval_kpi(i, arrays), len(localdicts))
+            except Exception:
+                # evaluate each period to obtain the actual errors
+                kpi_vals = None
+        if kpi_vals is not None:
+            for localdict, kpi_evals, kpi_val in \
+                    zip(localdicts, kpi_evals_list, kpi_vals):
+                localdict[name] = kpi_val
+                kpi_evals[i] = (kpi_val, None, None)
+        else:
+            for localdict, kpi_evals in zip(localdicts, kpi_evals_list):
+                kpi_evals[i] = self._eval_kpi(compiled_kpis, i, localdict)
+
+    @api.multi
+    def _render_kpis(self, lang_id, compiled_kpis, localdict, kpi_evals,
+                     period_id=None, formatter=None):
+        """ Render the KPI's evaluated by _eval_kpi() for a period,
+        in the format returned by _compute().
 
-            if len(recompute_queue) == 0:
-                # nothing to recompute, we are done
-                break
-            if len(recompute_queue) == len(compute_queue):
-                # could not compute anything in this iteration
-                # (ie real Value errors or cyclic dependency)
-                # so we stop trying
-                break
-            # try again
-            compute_queue = recompute_queue
-            recompute_queue = []
+        KPI's with a rendered value in kpi_evals are not rendered again. """
+        self.ensure_one()
+        if formatter is None:
+            formatter = self.env['mis.report.kpi']._get_formatter(lang_id)
+        res = {}
+        for i, kpi in enumerate(self.kpi_ids):
+            kpi_val, kpi_val_rendered, kpi_val_error = kpi_evals[i]
+            kpi_val_comment = kpi.name + " = " + kpi.expression
+            if kpi_val_error:
+                kpi_val_comment += '\n\n%s' % (kpi_val_error,)
+            if kpi_val_rendered is None:
+                kpi_val_rendered = formatter.render(kpi, kpi_val)
+
+            try:
+                kpi_style = None
+                if kpi.css_style:
+                    kpi_style = safe_eval(kpi.css_style, localdict)
+            except:
+                _logger.warning("error evaluating css stype expression %s",
+                                kpi.css_style, exc_info=True)
+                kpi_style = None
+
+            drilldown = (kpi_val is not None and
+                         compiled_kpis.has_account_var[i])
+
+            res[kpi.name] = {
+                'val': None if kpi_val is AccountingNone else kpi_val,
+                'val_r': kpi_val_rendered,
+                'val_c': kpi_val_comment,
+                'style': kpi_style,
+                'prefix': kpi.prefix,
+                'suffix': kpi.suffix,
+                'dp': kpi.dp,
+                'is_percentage': kpi.type == 'pct',
+                'period_id': period_id,
+                'expr': kpi.expression,
+                'drilldown': drilldown,
+            }
 
         return res
 
@@ -502,9 +893,17 @@ class MisReportInstancePeriod(models.Model):
     are defined as an offset relative to a pivot date.
     """
 
-    @api.one
+    @api.multi
     @api.depends('report_instance_id.pivot_date', 'type', 'offset', 'duration')
     def _compute_dates(self):
+        # fiscal periods of each company, loaded once for all records
+        calendars = {}
+        for record in self:
+            record._compute_record_dates(calendars)
+
+    @api.multi
+    def _compute_record_dates(self, calendars):
+        self.ensure_one()
         self.date_from = False
         self.date_to = False
         self.period_from = False
@@ -527,27 +926,18 @@ class MisReportInstancePeriod(models.Model):
             self.date_to = fields.Date.to_string(date_to)
             self.valid = True
         elif self.type == 'fp':
-            current_periods = self.env['account.period'].search(
-                [('special', '=', False),
-                 ('date_start', '<=', d),
-                 ('date_stop', '>=', d),
-                 ('company_id', '=',
-                  self.report_instance_id.company_id.id)])
-            if current_periods:
-                all_periods = self.env['account.period'].search(
-                    [('special', '=', False),
-                     ('company_id', '=',
-                      self.report_instance_id.company_id.id)],
-                    order='date_start')
-                all_period_ids = [p.id for p in all_periods]
-                p = all_period_ids.index(current_periods[0].id) + self.offset
-                if p >= 0 and p + self.duration <= len(all_period_ids):
-                    periods = all_periods[p:p + self.duration]
-                    self.date_from = periods[0].date_start
-                    self.date_to = periods[-1].date_stop
-                    self.period_from = periods[0]
-                    self.period_to = periods[-1]
-                    self.valid = True
+            calendar = get_period_calendar(
+                self.env, self.report_instance_id.company_id.id, calendars)
+            period_ids = calendar.get_slice(
+                self.report_instance_id.pivot_date,
+                self.offset, self.duration)
+            if period_ids:
+                periods = self.env['account.period'].browse(period_ids)
+                self.date_from = periods[0].date_start
+                self.date_to = periods[-1].date_stop
+                self.period_from = periods[0]
+                self.period_to = periods[-1]
+                self.valid = True
 
     _name = 'mis.report.instance.period'
 
@@ -632,7 +1022,13 @@ class MisReportInstancePeriod(models.Model):
         return []
 
     @api.multi
-    def drilldown(self, expr):
+    def drilldown(self, expr, dimension_value=None):
+        """ Return an action displaying the move lines of the accounting
+        variables of expr for the period.
+
+        dimension_value restricts the move lines to a value of the
+        dimension the report instance is expanded by (False for move
+        lines without value). """
         self.ensure_one()
         if AEP.has_account_var(expr):
             aep = AEP(self.env)
@@ -644,6 +1040,9 @@ class MisReportInstancePeriod(models.Model):
                 self.period_from, self.period_to,
                 self.report_instance_id.target_move)
             domain.extend(self._get_additional_move_line_filter())
+            expand_by = self.report_instance_id.expand_by
+            if expand_by and dimension_value is not None:
+                domain.append((expand_by, '=', dimension_value))
             return {
                 'name': expr + ' - ' + self.name,
                 'domain': domain,
@@ -658,7 +1057,8 @@ class MisReportInstancePeriod(models.Model):
             return False
 
     @api.multi
-    def _compute(self, lang_id, aep):
+    def _compute(self, lang_id, aep, formatter=None,
+                 prefetched_queries=None):
         self.ensure_one()
         return self.report_instance_id.report_id._compute(
             lang_id, aep,
@@ -668,6 +1068,22 @@ class MisReportInstancePeriod(models.Model):
             self._get_additional_move_line_filter,
             self._get_additional_query_filter,
             period_id=self.id,
+            formatter=formatter,
+            prefetched_queries=prefetched_queries,
+        )
+
+    @api.multi
+    def _prepare_localdict(self, compiled_kpis, aep,
+                           prefetched_queries=None):
+        self.ensure_one()
+        return self.report_instance_id.report_id._prepare_localdict(
+            compiled_kpis, aep,
+            self.date_from, self.date_to,
+            self.period_from, self.period_to,
+            self.report_instance_id.target_move,
+            self._get_additional_move_line_filter,
+            self._get_additional_query_filter,
+            prefetched_queries,
         )
 
 
@@ -717,6 +1133,74 @@ class MisReportInstance(models.Model):
                                    string="Account chart",
                                    required=True)
     landscape_pdf = fields.Boolean(string='Landscape PDF')
+    compute_workers = fields.Integer(
+        string='Parallel workers',
+        default=0,
+        help='Number of periods to compute in parallel, each in a thread '
+             'with its own database connection sharing the snapshot of '
+             'the current transaction (at most %d, and half the size of '
+             'the connection pool). Periods are computed sequentially '
+             'when the transaction has uncommitted changes. Leave 0 to '
+             'compute periods sequentially.' % MAX_COMPUTE_WORKERS)
+    vectorize = fields.Boolean(
+        string='Vectorised evaluation',
+        help='Evaluate each KPI once for all periods, with arrays of '
+             'values (requires numpy). KPI\'s that cannot be evaluated '
+             'this way, such as those using queries, are still evaluated '
+             'for each period. Periods are then computed sequentially.')
+    precompute = fields.Boolean(
+        string='Precompute for dashboards',
+        help='Compute the report in advance, on a schedule and after '
+             'entries are posted, for the users having it in a dashboard, '
+             'and display the result computed in advance, with its date.')
+    profile = fields.Boolean(
+        string='Profile computations',
+        help='Measure the time and number of SQL queries of accounting '
+             'queries, queries and KPI\'s, display them in the preview, '
+             'and record them in the profiling history. Profiling can also '
+             'be enabled with the mis_report_profile context key.')
+    profile_ids = fields.One2many('mis.report.instance.profile',
+                                  'instance_id',
+                                  string='Profiling history')
+    expand_by = fields.Selection(
+        [('partner_id', 'Partner'),
+         ('analytic_account_id', 'Analytic account'),
+         ('company_id', 'Company')],
+        string='Expand by',
+        help='Display the value of KPI\'s with expand for each partner, '
+             'analytic account or company. Accounting data is queried once '
+             'for all values, grouped by the dimension.')
+    expand_mode = fields.Selection(
+        [('rows', 'Rows'),
+         ('columns', 'Columns')],
+        string='Expand in',
+        required=True,
+        default='rows',
+        help='Display the values of the dimension in rows below each '
+             'KPI, or in columns after each period.')
+    cache_results = fields.Boolean(
+        string='Cache results',
+        help='Keep computed results in memory, and serve them again as long '
+             'as the report settings and the accounting data did not '
+             'change. Columns are also kept individually, so columns '
+             'that did not change are not computed again when the base '
+             'date or other columns change.')
+
+    @api.one
+    @api.constrains('compute_workers')
+    def _check_compute_workers(self):
+        max_workers = self._get_max_compute_workers()
+        if not 0 <= self.compute_workers <= max_workers:
+            raise ValidationError(
+                _("The number of parallel workers must be between "
+                  "0 and %d.") % max_workers)
+
+    @api.model
+    def _get_max_compute_workers(self):
+        """ Return the maximum number of threads computing periods,
+        leaving half of the connection pool to other requests """
+        return max(1, min(MAX_COMPUTE_WORKERS,
+                          tools.config['db_maxconn'] // 2))
 
     @api.one
     def copy(self, default=None):
@@ -786,89 +1270,967 @@ class MisReportInstance(models.Model):
             'target': 'current',
         }
 
+    @api.multi
+    def _prefetch_aep(self, aep, periods=None):
+        """ Query accounting data of all fiscal period columns at once
+
+        Columns based on fiscal periods that share the same additional
+        move line filter are fetched together using
+        AccountingExpressionProcessor.do_queries_multi(), so
+        the subsequent per-period computation does not query
+        the database for accounting data.
+
+        periods are the columns to prefetch (all columns by default). """
+        self.ensure_one()
+        if periods is None:
+            periods = self.period_ids
+        columns_by_filter = {}
+        for period in periods:
+            if not period.valid or \
+                    not period.period_from or not period.period_to:
+                continue
+            move_line_filter = period._get_additional_move_line_filter()
+            columns = columns_by_filter.setdefault(
+                repr(move_line_filter), (move_line_filter, []))[1]
+            columns.append((period.period_from, period.period_to))
+        for move_line_filter, columns in columns_by_filter.values():
+            if len(columns) > 1:
+                aep.do_queries_multi(columns, self.target_move,
+                                     move_line_filter)
+
+    @api.multi
+    def _prefetch_queries(self, profiler=NULL_PROFILER, periods=None):
+        """ Fetch aggregated queries of all columns at once
+
+        Columns that share the same additional query filters are fetched
+        together using MisReport._fetch_queries_multi(), so each query is
+        executed once instead of once per column.
+
+        periods are the columns to prefetch (all columns by default).
+
+        Returns a dictionary of prefetched queries keyed by period id. """
+        self.ensure_one()
+        if periods is None:
+            periods = self.period_ids
+        report = self.report_id
+        queries = report.query_ids.filtered(lambda q: q.aggregate)
+        if not queries:
+            return {}
+        periods_by_filter = {}
+        for period in periods:
+            if not period.valid:
+                continue
+            query_filters = [period._get_additional_query_filter(query)
+                             for query in queries]
+            periods_by_filter.setdefault(
+                repr(query_filters), []).append(period)
+        res = {}
+        for periods in periods_by_filter.values():
+            if len(periods) < 2:
+                continue
+            prefetched_queries_list = report._fetch_queries_multi(
+                [(period.date_from, period.date_to) for period in periods],
+                periods[0]._get_additional_query_filter,
+                profiler)
+            for period, prefetched_queries in \
+                    zip(periods, prefetched_queries_list):
+                res[period.id] = prefetched_queries
+        return res
+
+    @api.model
+    def _has_pending_writes(self):
+        """ Test if the current transaction has written to the database,
+        in which case threads importing its snapshot would not see its
+        changes """
+        cr = self.env.cr
+        # statistics views are read from a snapshot taken once per
+        # transaction, unless it is cleared
+        cr.execute("SELECT pg_stat_clear_snapshot()")
+        cr.execute("SELECT backend_xid IS NOT NULL FROM pg_stat_activity "
+                   "WHERE pid = pg_backend_pid()")
+        row = cr.fetchone()
+        return row is None or row[0]
+
+    @api.multi
+    def _compute_periods_parallel(self, lang_id, aep, periods,
+                                  formatter=None, prefetched_queries=None,
+                                  workers=None):
+        """ Compute periods in a pool of threads.
+
+        Each thread uses its own cursor, importing the snapshot of the
+        current transaction, so all periods see the same data (but not
+        uncommitted changes of the current transaction, see
+        _has_pending_writes()).
+
+        workers is the number of threads (compute_workers by default),
+        bounded by _get_max_compute_workers().
+
+        Returns a dictionary of kpi values keyed by period id. """
+        self.ensure_one()
+        if workers is None:
+            workers = self.compute_workers
+        workers = max(1, min(workers, len(periods),
+                             self._get_max_compute_workers()))
+        prefetched_queries = prefetched_queries or {}
+        self.env.cr.execute("SELECT pg_export_snapshot()")
+        snapshot_id = self.env.cr.fetchone()[0]
+        registry = self.pool
+        uid = self.env.uid
+        context = self.env.context
+
+        def compute_period(period_id):
+            threading.current_thread().dbname = registry.db_name
+            threading.current_thread().uid = uid
+            with api.Environment.manage():
+                cr = registry.cursor()
+                try:
+                    cr.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                    env = api.Environment(cr, uid, context)
+                    period = env['mis.report.instance.period'].\
+                        browse(period_id)
+                    period_aep = aep.with_env(env).with_profiler(
+                        aep.profiler.for_period(period_id))
+                    return period_id, period._compute(
+                        lang_id, period_aep, formatter,
+                        prefetched_queries.get(period_id))
+                finally:
+                    cr.rollback()
+                    cr.close()
+
+        thread_pool = ThreadPool(workers)
+        try:
+            return dict(thread_pool.map(compute_period, periods.ids))
+        finally:
+            thread_pool.close()
+
+    @api.multi
+    def _compute_periods_vectorized(self, lang_id, aep, periods,
+                                    formatter=None, prefetched_queries=None):
+        """ Compute periods evaluating each KPI once for all periods
+        (see MisReport._eval_kpis_vectorized()).
+
+        Returns a dictionary of kpi values keyed by period id. """
+        self.ensure_one()
+        prefetched_queries = prefetched_queries or {}
+        report = self.report_id
+        compiled_kpis = report._get_compiled_kpis()
+        period_aeps = [aep.with_profiler(aep.profiler.for_period(period.id))
+                       for period in periods]
+        localdicts = [
+            period._prepare_localdict(
+                compiled_kpis, period_aep,
+                prefetched_queries.get(period.id))
+            for period, period_aep in zip(periods, period_aeps)]
+        kpi_evals_list = report._eval_kpis_vectorized(compiled_kpis,
+                                                      localdicts,
+                                                      aep.profiler)
+        # render kpis row by row
+        if formatter is None:
+            formatter = self.env['mis.report.kpi']._get_formatter(lang_id)
+        for i, kpi in enumerate(report.kpi_ids):
+            kpi_vals_rendered = formatter.render_row(
+                kpi, [kpi_evals[i][0] for kpi_evals in kpi_evals_list])
+            for kpi_evals, kpi_val_rendered in \
+                    zip(kpi_evals_list, kpi_vals_rendered):
+                kpi_val, error, comment = kpi_evals[i]
+                if error is None:
+                    kpi_evals[i] = (kpi_val, kpi_val_rendered, comment)
+        res = {}
+        for period, period_aep, localdict, kpi_evals in \
+                zip(periods, period_aeps, localdicts, kpi_evals_list):
+            res[period.id] = report._render_kpis(
+                lang_id, compiled_kpis, localdict, kpi_evals,
+                period_id=period.id, formatter=formatter)
+            if aep.dimension:
+                report._compute_dimensions(
+                    lang_id, compiled_kpis, localdict, period_aep,
+                    res[period.id], period.id, formatter)
+        return res
+
+    @api.multi
+    def _get_data_watermark(self, watermarks=None):
+        """ Return a value that changes when the data the report is computed
+        from changes, or None if it cannot be determined.
+
+        It is made of the versions of move lines up to the end of the
+        last period (see mis.data.version), of the last modification date
+        and number of accounts and fiscal periods, and of the models
+        queried by the report.
+
+        watermarks are the watermarks of the end dates of the periods
+        (see _get_period_watermarks()), read if not given. """
+        self.ensure_one()
+        date_to = max([p.date_to for p in self.period_ids if p.valid] or
+                      [False])
+        if not date_to:
+            return self._get_undated_data_watermark()
+        if watermarks is None:
+            watermarks = self._get_data_watermarks([date_to])
+        return watermarks[date_to]
+
+    @api.multi
+    def _get_period_watermarks(self):
+        """ Return the watermarks of the end dates of all valid periods,
+        to read them once for the result and the window caches """
+        self.ensure_one()
+        return self._get_data_watermarks(list(set(
+            p.date_to for p in self.period_ids if p.valid)))
+
+    @api.multi
+    def _get_data_watermarks(self, dates):
+        """ Return {date: watermark} where watermark changes when the data
+        a column ending at date is computed from changes (see
+        _get_data_watermark()), or None if it cannot be determined. """
+        self.ensure_one()
+        other_watermark = self._get_undated_data_watermark()
+        if other_watermark is None:
+            return dict.fromkeys(dates)
+        versions = self.env['mis.data.version']._get_versions(dates)
+        return dict((date, (versions[date],) + other_watermark)
+                    for date in dates)
+
+    @api.multi
+    def _get_undated_data_watermark(self):
+        """ Return the part of the data watermark that does not depend on
+        dates (accounts, fiscal periods and models queried by the report),
+        or None if it cannot be determined. """
+        self.ensure_one()
+        cr = self.env.cr
+        watermark = []
+        for table in ('account_account', 'account_period'):
+            cr.execute("SELECT MAX(write_date), COUNT(*) FROM %s" % table)
+            watermark.append(cr.fetchone())
+        for query in self.report_id.query_ids:
+            if query.model_id.model in ('account.move.line',
+                                        'account.move'):
+                # covered by the versions of move lines
+                continue
+            model = self.env[query.model_id.model]
+            if not model._auto or not model._log_access:
+                # eg a SQL view
+                return None
+            cr.execute("SELECT MAX(write_date), COUNT(*) FROM %s" %
+                       model._table)
+            watermark.append(cr.fetchone())
+        return tuple(watermark)
+
+    @api.multi
+    def _get_settings_key(self):
+        """ Return a value that changes when the settings of the instance
+        or its report change, when accounts change (which may change the
+        accounts of the codes of expressions), or when it is computed for
+        another date, language or time zone. """
+        self.ensure_one()
+        report = self.report_id
+        self.env.cr.execute(
+            "SELECT MAX(write_date), COUNT(*) FROM account_account")
+        settings = (
+            self.write_date,
+            report.write_date,
+            tuple((kpi.id, kpi.write_date) for kpi in report.kpi_ids),
+            tuple((q.id, q.write_date) for q in report.query_ids),
+            tuple((p.id, p.write_date) for p in self.period_ids),
+            self.env.cr.fetchone(),
+        )
+        return (settings, self.pivot_date, self.env.user.lang,
+                self.env.context.get('tz'))
+
+    @api.multi
+    def _get_compute_cache_key(self, watermarks=None):
+        """ Return the key of the compute() result in the result cache,
+        or None if the result must not be cached.
+
+        watermarks are the watermarks of the end dates of the periods
+        (see _get_period_watermarks()), read if not given. """
+        self.ensure_one()
+        if not self.cache_results:
+            return None
+        watermark = self._get_data_watermark(watermarks)
+        if watermark is None:
+            return None
+        return (self.env.cr.dbname, self.id, self.env.uid,
+                self._get_settings_key(), watermark)
+
+    @api.multi
+    def _get_window_cache_keys(self, periods, watermarks=None):
+        """ Return {period id: key} of the kpi values of columns in the
+        window cache, for instances with cache_results.
+
+        The key of a column is made of its window (dates and fiscal
+        periods), the report settings, the additional filters of the column
+        and the data watermark up to the end of the window, so a column
+        is reused by any instance of the report computing the same window,
+        such as the columns of a rolling report moved forward.
+
+        watermarks are the watermarks of the end dates of periods
+        (see _get_period_watermarks()), read if not given. """
+        self.ensure_one()
+        if not self.cache_results or self._is_profiling() or not periods:
+            return {}
+        report = self.report_id
+        settings = (
+            report.id,
+            report.write_date,
+            tuple((kpi.id, kpi.write_date) for kpi in report.kpi_ids),
+            tuple((q.id, q.write_date) for q in report.query_ids),
+        )
+        if watermarks is None:
+            watermarks = self._get_data_watermarks(
+                list(set(periods.mapped('date_to'))))
+        res = {}
+        for period in periods:
+            watermark = watermarks[period.date_to]
+            if watermark is None:
+                continue
+            filters = repr((
+                period._get_additional_move_line_filter(),
+                [period._get_additional_query_filter(query)
+                 for query in report.query_ids],
+            ))
+            res[period.id] = (
+                self.env.cr.dbname, settings,
+                self.root_account.id, self.target_move, self.expand_by,
+                period.date_from, period.date_to,
+                period.period_from.id, period.period_to.id, filters,
+                self.env.uid, self.env.user.lang,
+                self.env.context.get('tz'), watermark)
+        return res
+
+    @api.model
+    def _copy_window_kpi_values(self, kpi_values, period_id):
+        """ Copy kpi values of the window cache for a period """
+        kpi_values = copy.deepcopy(kpi_values)
+        for kpi_value in kpi_values.values():
+            kpi_value['period_id'] = period_id
+        return kpi_values
+
+    @api.multi
+    def invalidate_compute_cache(self):
+        """ Remove the results of these instances from the result cache """
+        for key in _compute_cache.keys():
+            if key[0] == self.env.cr.dbname and key[1] in self.ids:
+                _compute_cache.pop(key)
+        return True
+
     @api.multi
     def compute(self):
         self.ensure_one()
+        cache_key = None
+        watermarks = None
+        if self.cache_results and not self._is_profiling():
+            watermarks = self._get_period_watermarks()
+            cache_key = self._get_compute_cache_key(watermarks)
+        res = None
+        if cache_key is not None:
+            try:
+                res = copy.deepcopy(_compute_cache[cache_key])
+            except KeyError:
+                pass
+        if res is None:
+            res = self._compute_report(watermarks)
+            # uncommitted changes of move lines increment data versions
+            # that a rollback would let other changes reuse
+            if cache_key is not None and not self._has_pending_writes():
+                self.invalidate_compute_cache()
+                _compute_cache[cache_key] = copy.deepcopy(res)
+        return res
 
-        aep = self.report_id._prepare_aep(self.root_account)
+    @api.multi
+    def _precompute(self, access=True):
+        """ Compute the report instance, and store the result as the
+        precomputed result of the current user (see
+        mis.report.instance.precomputed).
 
-        # fetch user language only once
+        access tells if the user is opening the instance, as opposed
+        to the scheduled job precomputing it. """
+        self.ensure_one()
+        res = self.compute()
+        self.env['mis.report.instance.precomputed']._store_result(
+            self, res, access)
+        return res
+
+    @api.multi
+    def compute_layout(self):
+        """ Return the layout of the report, to load its columns
+        progressively with compute_period_columns().
+
+        Returns a dictionary with the header and content of the report,
+        where cells are empty and marked as loading, periods, the list
+        of {'period_id', 'col_index', 'col_count'} giving the columns of
+        each period, and batches, the periods grouped by call of
+        compute_period_columns().
+
+        If the result is available without computing it (precomputed or
+        cached), or when profiling, the whole result is returned under
+        the result key instead. The whole result is also returned
+        for instances expanded by a dimension, as their layout depends
+        on the values of the dimension found in the data.
+
+        For instances with precompute, the result computed in advance
+        for the current user is returned, with its date in as_of, unless
+        the mis_report_refresh context key is set. Otherwise, the report
+        is computed at once and its result stored for the next time. """
+        self.ensure_one()
+        if self._is_profiling() or self.expand_by:
+            return {'result': self.compute()}
+        if self.precompute:
+            res = None
+            if not self.env.context.get('mis_report_refresh'):
+                res = self.env['mis.report.instance.precomputed'].\
+                    _get_result(self)
+            if res is None:
+                res = self._precompute()
+            return {'result': res}
+        cache_key = self._get_compute_cache_key()
+        if cache_key is not None:
+            try:
+                return {'result': copy.deepcopy(_compute_cache[cache_key])}
+            except KeyError:
+                pass
+        lang_id = self._get_lang_id()
+        header, content = self._get_report_layout()
+        periods = []
+        # {period id: id of a period of its group}, grouping periods
+        # compared with each other
+        group_ids = {}
+
+        def get_group_id(period_id):
+            while group_ids[period_id] != period_id:
+                period_id = group_ids[period_id]
+            return period_id
+
+        valid_periods = self.period_ids.filtered(lambda p: p.valid)
+        for period in valid_periods:
+            group_ids[period.id] = period.id
+        for period in valid_periods:
+            columns = self._get_period_columns(lang_id, period)
+            periods.append({
+                'period_id': period.id,
+                'col_index': len(header[0]['cols']),
+                'col_count': len(columns),
+            })
+            for header_col, compare_col in columns:
+                header[0]['cols'].append(header_col)
+                for row in content:
+                    row['cols'].append({'val_r': '', 'loading': True})
+                if compare_col:
+                    group_ids[get_group_id(compare_col.id)] = \
+                        get_group_id(period.id)
+        groups = []
+        groups_by_id = {}
+        for period in periods:
+            group_id = get_group_id(period['period_id'])
+            if group_id not in groups_by_id:
+                groups_by_id[group_id] = []
+                groups.append(groups_by_id[group_id])
+            groups_by_id[group_id].append(period)
+        batches = []
+        for group in groups:
+            if batches and \
+                    len(batches[-1]) + len(group) <= PERIOD_BATCH_SIZE:
+                batches[-1].extend(group)
+            else:
+                batches.append(list(group))
+        return {
+            'header': header,
+            'content': content,
+            'periods': periods,
+            'batches': batches,
+        }
+
+    @api.multi
+    def compute_period_columns(self, period_ids):
+        """ Compute the columns of periods of the layout returned by
+        compute_layout(): for each period, its own column and its
+        comparison columns.
+
+        The periods and the periods they are compared with are computed
+        together, with one preparation and one fetch of the accounting
+        data and queries for all of them, unless their kpi values are in
+        the window cache (see cache_results). Periods are therefore
+        passed in the batches of the layout, which group the periods
+        compared with each other, so each period is computed once.
+
+        Returns, for each period id, the list of cells of each row of
+        the content (an empty list for an invalid period). """
+        self.ensure_one()
+        lang_id = self._get_lang_id()
+        formatter = self.env['mis.report.kpi']._get_formatter(lang_id)
+        periods_by_id = dict((p.id, p) for p in self.period_ids if p.valid)
+        columns_by_period_id = {}
+        periods = self.env['mis.report.instance.period']
+        for period_id in period_ids:
+            period = periods_by_id.get(period_id)
+            if not period:
+                continue
+            columns = columns_by_period_id[period_id] = \
+                self._get_period_columns(lang_id, period)
+            periods |= period
+            for header_col, compare_col in columns:
+                if compare_col:
+                    periods |= compare_col
+        kpi_values_by_period_ids = {}
+        if periods:
+            kpi_values_by_period_ids = self._compute_kpi_values(
+                lang_id, periods, formatter)[0]
+        res = []
+        for period_id in period_ids:
+            if period_id not in columns_by_period_id:
+                res.append([])
+                continue
+            rows = [[] for kpi in self.report_id.kpi_ids]
+            for header_col, compare_col in columns_by_period_id[period_id]:
+                column_cells = self._get_column_cells(
+                    periods_by_id[period_id], compare_col,
+                    kpi_values_by_period_ids, formatter)
+                for row, cell in zip(rows, column_cells):
+                    row.append(cell)
+            res.append(rows)
+        return res
+
+    @api.multi
+    def _get_precompute_user_ids(self):
+        """ Return the ids of the users to precompute the instance for:
+        users having it in a dashboard (see
+        add.mis.report.instance.dashboard.wizard) and users who opened it
+        recently (see mis.report.instance.precomputed). """
+        self.ensure_one()
+        user_ids = set(self.env['mis.report.instance.precomputed'].
+                       _get_recent_user_ids(self))
+        actions = self.env['ir.actions.act_window'].search(
+            [('res_model', '=', self._name), ('res_id', '=', self.id)])
+        for action in actions:
+            customs = self.env['ir.ui.view.custom'].search(
+                [('arch', 'like', 'name="%d"' % action.id)])
+            user_ids.update(customs.mapped('user_id').ids)
+        return sorted(user_ids)
+
+    @api.model
+    def _cron_precompute(self):
+        """ Compute instances with precompute for their users, and
+        store the results (see _precompute()). Results of other users
+        (who did not open their instance recently) are deleted.
+
+        Instances are computed in a pool of threads, each with its own
+        cursor. The size of the pool is the mis_builder.precompute_workers
+        system parameter (2 by default). """
+        Precomputed = self.env['mis.report.instance.precomputed']
+        jobs = []
+        for instance in self.sudo().search([('precompute', '=', True)]):
+            user_ids = instance._get_precompute_user_ids()
+            Precomputed._delete_other_users(instance, user_ids)
+            for user_id in user_ids:
+                jobs.append((instance.id, user_id))
+        if not jobs:
+            return True
+        workers = int(self.env['ir.config_parameter'].sudo().get_param(
+            'mis_builder.precompute_workers', '2'))
+        registry = self.pool
+
+        def precompute(job):
+            instance_id, user_id = job
+            threading.current_thread().dbname = registry.db_name
+            threading.current_thread().uid = user_id
+            with api.Environment.manage():
+                cr = registry.cursor()
+                try:
+                    env = api.Environment(cr, user_id, {})
+                    env = env(context=env['res.users'].context_get())
+                    instance = env['mis.report.instance'].browse(instance_id)
+                    instance._precompute(access=False)
+                    cr.commit()
+                except Exception:
+                    _logger.exception("Error precomputing MIS report "
+                                      "instance %s for user %s",
+                                      instance_id, user_id)
+                    cr.rollback()
+                finally:
+                    cr.close()
+
+        thread_pool = ThreadPool(max(1, min(workers, len(jobs))))
+        try:
+            thread_pool.map(precompute, jobs)
+        finally:
+            thread_pool.close()
+        return True
+
+    @api.multi
+    def _is_profiling(self):
+        self.ensure_one()
+        return self.profile or \
+            bool(self.env.context.get('mis_report_profile'))
+
+    @api.multi
+    def _get_lang_id(self):
+        """ Return the id of the language of the user """
         # TODO: is this necessary?
         lang = self.env.user.lang
         if not lang:
             lang = 'en_US'
-        lang_id = self.env['res.lang'].search([('code', '=', lang)]).id
+        return self.env['res.lang'].search([('code', '=', lang)]).id
 
-        # compute kpi values for each period
+    @api.multi
+    def _compute_kpi_values(self, lang_id, periods, formatter,
+                            profiler=NULL_PROFILER, watermarks=None):
+        """ Compute the kpi values of periods, reusing the kpi values
+        of the window cache (see _get_window_cache_keys() for watermarks).
+
+        Returns a dictionary of kpi values keyed by period id, and
+        True if periods have been computed in parallel threads. """
+        self.ensure_one()
+        # reuse kpi values of columns computed before for the same window
+        window_cache_keys = self._get_window_cache_keys(periods, watermarks)
         kpi_values_by_period_ids = {}
-        for period in self.period_ids:
-            if not period.valid:
+        for period_id, window_cache_key in window_cache_keys.items():
+            try:
+                kpi_values = _window_cache[window_cache_key]
+            except KeyError:
                 continue
-            kpi_values = period._compute(lang_id, aep)
-            kpi_values_by_period_ids[period.id] = kpi_values
+            kpi_values_by_period_ids[period_id] = \
+                self._copy_window_kpi_values(kpi_values, period_id)
+        periods = periods.filtered(
+            lambda p: p.id not in kpi_values_by_period_ids)
+
+        # compute kpi values for the other periods
+        if self.vectorize and not HAS_NUMPY:
+            _logger.warning("numpy is not installed, vectorised evaluation "
+                            "of MIS reports is not available")
+        parallel = False
+        if periods:
+            aep = self.report_id._prepare_aep(self.root_account,
+                                              self.expand_by or None)
+            aep.profiler = profiler
+            self._prefetch_aep(aep, periods)
+            prefetched_queries = self._prefetch_queries(profiler, periods)
+            if self.vectorize and HAS_NUMPY and len(periods) > 1:
+                computed_kpi_values = self._compute_periods_vectorized(
+                    lang_id, aep, periods, formatter, prefetched_queries)
+            elif self.compute_workers > 1 and len(periods) > 1 and \
+                    not self._has_pending_writes():
+                parallel = True
+                computed_kpi_values = self._compute_periods_parallel(
+                    lang_id, aep, periods, formatter, prefetched_queries)
+            else:
+                computed_kpi_values = {}
+                for period in periods:
+                    computed_kpi_values[period.id] = period._compute(
+                        lang_id,
+                        aep.with_profiler(profiler.for_period(period.id)),
+                        formatter,
+                        prefetched_queries.get(period.id))
+            if window_cache_keys and self._has_pending_writes():
+                # computed with uncommitted changes of move lines
+                # (see compute())
+                window_cache_keys = {}
+            for period_id, kpi_values in computed_kpi_values.items():
+                if period_id in window_cache_keys:
+                    _window_cache[window_cache_keys[period_id]] = \
+                        copy.deepcopy(kpi_values)
+            kpi_values_by_period_ids.update(computed_kpi_values)
+        return kpi_values_by_period_ids, parallel
 
-        # prepare header and content
+    @api.multi
+    def _get_report_layout(self):
+        """ Return the header and content of the report, without columns.
+
+        Rows of the content are in the order of the kpi's of the report.
+        """
+        self.ensure_one()
         header = []
         header.append({
             'kpi_name': '',
             'cols': []
         })
         content = []
-        rows_by_kpi_name = {}
         for kpi in self.report_id.kpi_ids:
-            rows_by_kpi_name[kpi.name] = {
+            content.append({
                 'kpi_name': kpi.description,
                 'cols': [],
                 'default_style': kpi.default_css_style
-            }
-            content.append(rows_by_kpi_name[kpi.name])
+            })
+        return header, content
 
-        # populate header and content
-        for period in self.period_ids:
-            if not period.valid:
-                continue
-            # add the column header
-            if period.duration > 1 or period.type == 'w':
-                # from, to
-                if period.period_from and period.period_to:
-                    date_from = period.period_from.name
-                    date_to = period.period_to.name
-                else:
-                    date_from = self._format_date(lang_id, period.date_from)
-                    date_to = self._format_date(lang_id, period.date_to)
-                header_date = _('from %s to %s') % (date_from, date_to)
+    @api.multi
+    def _get_period_columns(self, lang_id, period):
+        """ Return the columns of a valid period: its own column and its
+        comparison columns, as a list of (header column, period compared
+        with or None) """
+        self.ensure_one()
+        if period.duration > 1 or period.type == 'w':
+            # from, to
+            if period.period_from and period.period_to:
+                date_from = period.period_from.name
+                date_to = period.period_to.name
+            else:
+                date_from = self._format_date(lang_id, period.date_from)
+                date_to = self._format_date(lang_id, period.date_to)
+            header_date = _('from %s to %s') % (date_from, date_to)
+        else:
+            # one period or one day
+            if period.period_from and period.period_to:
+                header_date = period.period_from.name
             else:
-                # one period or one day
-                if period.period_from and period.period_to:
-                    header_date = period.period_from.name
+                header_date = self._format_date(lang_id, period.date_from)
+        res = [(dict(name=period.name, date=header_date), None)]
+        for compare_col in period.comparison_column_ids:
+            if compare_col.valid:
+                res.append((dict(name=_('%s vs %s') % (period.name,
+                                                       compare_col.name),
+                                 date=''),
+                            compare_col))
+        return res
+
+    @api.multi
+    def _get_column_cells(self, period, compare_col,
+                          kpi_values_by_period_ids, formatter):
+        """ Return the cells of a column of a period, or of the comparison
+        of a period with compare_col, in the order of the kpi's """
+        self.ensure_one()
+        kpi_values = kpi_values_by_period_ids[period.id]
+        if not compare_col:
+            return [kpi_values[kpi.name] for kpi in self.report_id.kpi_ids]
+        compare_kpi_values = kpi_values_by_period_ids[compare_col.id]
+        return [{
+            'val_r': formatter.render_comparison(
+                kpi,
+                kpi_values[kpi.name]['val'],
+                compare_kpi_values[kpi.name]['val'],
+                period.normalize_factor,
+                compare_col.normalize_factor)
+        } for kpi in self.report_id.kpi_ids]
+
+    @api.multi
+    def _get_dimension_labels(self, kpi_values_by_period_ids):
+        """ Return {dimension value: label} for the values of the dimension
+        the instance is expanded by in kpi values of periods
+        (see MisReport._compute_dimensions()) """
+        self.ensure_one()
+        dimension_values = set()
+        for kpi_values in kpi_values_by_period_ids.values():
+            for kpi_value in kpi_values.values():
+                dimension_values.update(kpi_value.get('dimensions', ()))
+        comodel_name = self.env['account.move.line'].\
+            _fields[self.expand_by].comodel_name
+        res = dict(self.env[comodel_name].sudo().browse(
+            [v for v in dimension_values if v]).name_get())
+        res[None] = _('Undefined')
+        return res
+
+    @api.model
+    def _get_dimension_cell(self, kpi, dimension_value, period, compare_col,
+                            kpi_values_by_period_ids, formatter):
+        """ Return the cell of a KPI for a dimension value in the column
+        of a period, or of the comparison of a period with compare_col """
+        cell = kpi_values_by_period_ids[period.id][kpi.name].get(
+            'dimensions', {}).get(dimension_value)
+        if not compare_col:
+            return cell or {'val_r': ''}
+        compare_cell = kpi_values_by_period_ids[compare_col.id][kpi.name].get(
+            'dimensions', {}).get(dimension_value)
+        return {
+            'val_r': formatter.render_comparison(
+                kpi,
+                cell and cell['val'],
+                compare_cell and compare_cell['val'],
+                period.normalize_factor,
+                compare_col.normalize_factor)
+        }
+
+    @api.multi
+    def _add_dimension_columns(self, period, header_col, header, content,
+                               kpi_values_by_period_ids, dimension_labels):
+        """ Add a column for each value of the dimension of KPI's with
+        expand in a period, with the values of these KPI's """
+        self.ensure_one()
+        kpis = self.report_id.kpi_ids
+        kpi_values = kpi_values_by_period_ids[period.id]
+        dimension_values = set()
+        for kpi in kpis:
+            if kpi.expand:
+                dimension_values.update(
+                    kpi_values[kpi.name].get('dimensions', ()))
+        for dimension_value in sorted(dimension_values,
+                                      key=dimension_labels.get):
+            header[0]['cols'].append({
+                'name': u'%s - %s' % (period.name,
+                                      dimension_labels[dimension_value]),
+                'date': header_col['date'],
+            })
+            for kpi, row in zip(kpis, content):
+                if kpi.expand:
+                    row['cols'].append(self._get_dimension_cell(
+                        kpi, dimension_value, period, None,
+                        kpi_values_by_period_ids, None))
                 else:
-                    header_date = self._format_date(lang_id, period.date_from)
-            header[0]['cols'].append(dict(name=period.name, date=header_date))
-            # add kpi values
-            kpi_values = kpi_values_by_period_ids[period.id]
-            for kpi_name in kpi_values:
-                rows_by_kpi_name[kpi_name]['cols'].append(kpi_values[kpi_name])
-
-            # add comparison columns
-            for compare_col in period.comparison_column_ids:
-                compare_kpi_values = \
-                    kpi_values_by_period_ids.get(compare_col.id)
-                if compare_kpi_values:
-                    # add the comparison column header
-                    header[0]['cols'].append(
-                        dict(name=_('%s vs %s') % (period.name,
-                                                   compare_col.name),
-                             date=''))
-                    # add comparison values
-                    for kpi in self.report_id.kpi_ids:
-                        rows_by_kpi_name[kpi.name]['cols'].append({
-                            'val_r': kpi.render_comparison(
-                                lang_id,
-                                kpi_values[kpi.name]['val'],
-                                compare_kpi_values[kpi.name]['val'],
-                                period.normalize_factor,
-                                compare_col.normalize_factor)
-                        })
-
-        return {'header': header,
-                'content': content}
+                    row['cols'].append({'val_r': ''})
+
+    @api.multi
+    def _add_dimension_rows(self, lang_id, periods, content,
+                            kpi_values_by_period_ids, dimension_labels,
+                            formatter):
+        """ Insert below the row of each KPI with expand a row for each
+        value of the dimension, with the columns of all periods.
+
+        Returns the new content. """
+        self.ensure_one()
+        columns = [(period, compare_col)
+                   for period in periods
+                   for header_col, compare_col in
+                   self._get_period_columns(lang_id, period)]
+        res = []
+        for kpi, row in zip(self.report_id.kpi_ids, content):
+            res.append(row)
+            if not kpi.expand:
+                continue
+            dimension_values = set()
+            for kpi_values in kpi_values_by_period_ids.values():
+                dimension_values.update(
+                    kpi_values[kpi.name].get('dimensions', ()))
+            for dimension_value in sorted(dimension_values,
+                                          key=dimension_labels.get):
+                res.append({
+                    'kpi_name': dimension_labels[dimension_value],
+                    'cols': [self._get_dimension_cell(
+                        kpi, dimension_value, period, compare_col,
+                        kpi_values_by_period_ids, formatter)
+                        for period, compare_col in columns],
+                    'default_style': kpi.default_css_style,
+                    'dimension': True,
+                })
+        return res
+
+    @api.multi
+    def _compute_report(self, watermarks=None):
+        self.ensure_one()
+
+        profiler = NULL_PROFILER
+        if self._is_profiling():
+            profiler = Profiler()
+            start = time.time()
+            sql_count = self.env.cr.sql_log_count
+
+        # fetch user language only once
+        lang_id = self._get_lang_id()
+        formatter = self.env['mis.report.kpi']._get_formatter(lang_id)
+
+        # compute kpi values for each period
+        periods = self.period_ids.filtered(lambda p: p.valid)
+        kpi_values_by_period_ids, parallel = self._compute_kpi_values(
+            lang_id, periods, formatter, profiler, watermarks)
+
+        # prepare header and content
+        header, content = self._get_report_layout()
+        rows_by_kpi_name = dict(zip(self.report_id.kpi_ids.mapped('name'),
+                                    content))
+
+        # populate header and content
+        if self.expand_by:
+            dimension_labels = self._get_dimension_labels(
+                kpi_values_by_period_ids)
+        for period in periods:
+            for header_col, compare_col in \
+                    self._get_period_columns(lang_id, period):
+                header[0]['cols'].append(header_col)
+                column_cells = self._get_column_cells(
+                    period, compare_col, kpi_values_by_period_ids, formatter)
+                for row, cell in zip(content, column_cells):
+                    row['cols'].append(cell)
+                if self.expand_by and self.expand_mode == 'columns' and \
+                        not compare_col:
+                    self._add_dimension_columns(
+                        period, header_col, header, content,
+                        kpi_values_by_period_ids, dimension_labels)
+        if self.expand_by and self.expand_mode == 'rows':
+            content = self._add_dimension_rows(
+                lang_id, periods, content, kpi_values_by_period_ids,
+                dimension_labels, formatter)
+
+        res = {'header': header,
+               'content': content}
+
+        if profiler.enabled:
+            total_sql = self.env.cr.sql_log_count - sql_count
+            if parallel:
+                # add queries of the cursors of threads
+                total_sql += sum(entry['sql'] for entry in profiler.entries
+                                 if entry['period_id'])
+            profile = res['profile'] = self._get_profile(
+                profiler, time.time() - start, total_sql)
+            # annotate cells with their time, for the heat map of the widget
+            max_time = max([t for cells in profile['cells'].values()
+                            for t in cells.values()] or [0.0])
+            for kpi_name, row in rows_by_kpi_name.items():
+                for col in row['cols']:
+                    cell_time = profile['cells'][kpi_name].get(
+                        col.get('period_id'))
+                    if cell_time is not None:
+                        col['profile_time'] = cell_time
+                        col['profile_ratio'] = \
+                            max_time and cell_time / max_time
+            self.env['mis.report.instance.profile']._record(self, profile)
+
+        return res
+
+    @api.multi
+    def _get_profile(self, profiler, total_time, total_sql):
+        """ Summarize the profiling entries of a computation.
+
+        Returns a dictionary with
+            * total_time, total_sql: the time and number of SQL queries
+              of the whole computation
+            * entries: the profiling entries (see Profiler),
+              longest first
+            * cells: {kpi name: {period id: time}}, where time is the
+              time to evaluate the kpi plus the time to query the
+              accounting data and queries it reads
+            * periods: {period id: period name}
+        """
+        self.ensure_one()
+        compiled_kpis = self.report_id._get_compiled_kpis()
+        query_names = set(self.report_id.query_ids.mapped('name'))
+        modes_by_domain = defaultdict(set)
+        for field, mode, account_codes, domain in compiled_kpis.aep_vars:
+            modes_by_domain[domain].add(mode)
+        # accounting data is queried per domain and mode, or per domain
+        # for all modes and periods at once when it is prefetched
+        aep_keys_by_var_name = {}
+        for (field, mode, account_codes, domain), var_name in \
+                compiled_kpis.aep_vars.items():
+            aep_keys_by_var_name[var_name] = [
+                AEP.get_profile_key(domain, mode),
+                AEP.get_profile_key(
+                    domain, ''.join(sorted(modes_by_domain[domain]))),
+            ]
+        # {(category, key, period_id): time}
+        times = defaultdict(float)
+        for entry in profiler.entries:
+            times[(entry['category'], entry['key'],
+                   entry['period_id'])] += entry['time']
+        periods = self.period_ids.filtered(lambda p: p.valid)
+        cells = {}
+        for name, used_names in zip(compiled_kpis.names,
+                                    compiled_kpis.used_names):
+            inputs = set([('kpi', name)])
+            for n in used_names:
+                if n in aep_keys_by_var_name:
+                    inputs.update(('aep', key)
+                                  for key in aep_keys_by_var_name[n])
+                elif n in query_names:
+                    inputs.add(('query', n))
+            cells[name] = {}
+            for period in periods:
+                # steps done once for all periods (prefetching, vectorised
+                # evaluation) are not attached to a period, and are
+                # counted in each period
+                cells[name][period.id] = sum(
+                    times.get((category, key, period.id), 0.0) +
+                    times.get((category, key, None), 0.0)
+                    for category, key in inputs)
+        return {
+            'total_time': total_time,
+            'total_sql': total_sql,
+            'entries': sorted(profiler.entries,
+                              key=lambda e: e['time'], reverse=True),
+            'cells': cells,
+            'periods': dict((p.id, p.name) for p in periods),
+        }
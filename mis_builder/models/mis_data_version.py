@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import bisect
+
+import psycopg2
+
+from openerp import api, fields, models
+
+# changing these fields of move lines changes the month of their version
+_MOVE_LINE_DATE_FIELDS = ('date', 'period_id')
+
+
+class MisDataVersion(models.Model):
+    """ A version of the move lines of each month, incremented in the
+    transactions creating, modifying or deleting move lines of the month,
+    or posting or cancelling their moves.
+
+    The month of a move line is the first month of its date and of
+    the start of its fiscal period, so the versions of the months up to
+    a date change when a move line that a report column ending at that
+    date may include changes. They are used in the data watermark of
+    cached MIS report results (see MisReportInstance._get_data_watermarks),
+    which is then read without scanning move lines.
+
+    Versions are updated in the transaction modifying move lines, so
+    a version is visible with the changes it counts. The updated rows
+    stay locked until the end of the transaction, so transactions
+    modifying move lines of the same month wait for each other.
+    """
+
+    _name = 'mis.data.version'
+    _description = 'MIS Builder data version'
+    _log_access = False
+
+    month = fields.Date(required=True, readonly=True, index=True)
+    version = fields.Integer(required=True, readonly=True)
+
+    _sql_constraints = [
+        ('month_unique', 'unique(month)',
+         'Data versions must be unique by month!'),
+    ]
+
+    @api.model
+    def _increment_month(self, month):
+        cr = self.env.cr
+        cr.execute("UPDATE %s SET version = version + 1 WHERE month = %%s"
+                   % self._table, (month,))
+        if cr.rowcount:
+            return
+        try:
+            with cr.savepoint():
+                cr.execute("INSERT INTO %s (month, version) VALUES (%%s, 1)"
+                           % self._table, (month,), log_exceptions=False)
+        except psycopg2.IntegrityError:
+            # inserted by a concurrent transaction since the update
+            cr.execute("UPDATE %s SET version = version + 1 "
+                       "WHERE month = %%s" % self._table, (month,))
+
+    @api.model
+    def _increment_move_lines(self, line_ids):
+        """ Increment the versions of the months of move lines """
+        if not line_ids:
+            return
+        cr = self.env.cr
+        # months are updated in a fixed order, so concurrent
+        # transactions do not deadlock
+        cr.execute("""
+            SELECT DISTINCT
+                date_trunc('month', LEAST(l.date, p.date_start))::date
+            FROM account_move_line l
+            JOIN account_period p ON p.id = l.period_id
+            WHERE l.id IN %s
+            ORDER BY 1
+        """, (tuple(line_ids),))
+        for month, in cr.fetchall():
+            self._increment_month(month)
+        self.invalidate_cache()
+
+    def _increment_moves(self, cr, uid, move_ids, context=None):
+        if not move_ids:
+            return
+        cr.execute("SELECT id FROM account_move_line WHERE move_id IN %s",
+                   (tuple(move_ids),))
+        self._increment_move_lines(cr, uid, [r[0] for r in cr.fetchall()],
+                                   context=context)
+
+    @api.model
+    def _get_versions(self, dates):
+        """ Return {date: version} where version is the sum of the versions
+        of the months up to date, which increases when move lines that a
+        report column ending at date may include change. """
+        self.env.cr.execute(
+            "SELECT to_char(month, 'YYYY-MM-DD'), version FROM %s "
+            "ORDER BY month" % self._table)
+        months = []
+        cumulated = []
+        version = 0
+        for month, month_version in self.env.cr.fetchall():
+            version += month_version
+            months.append(month)
+            cumulated.append(version)
+        res = {}
+        for date in dates:
+            i = bisect.bisect_right(months, date)
+            res[date] = cumulated[i - 1] if i else 0
+        return res
+
+
+class AccountMoveLine(models.Model):
+
+    _inherit = 'account.move.line'
+
+    def create(self, cr, uid, vals, context=None, check=True):
+        res = super(AccountMoveLine, self).create(
+            cr, uid, vals, context=context, check=check)
+        self.pool['mis.data.version']._increment_move_lines(
+            cr, uid, [res], context=context)
+        return res
+
+    def write(self, cr, uid, ids, vals, context=None, check=True,
+              update_check=True):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        version_obj = self.pool['mis.data.version']
+        version_obj._increment_move_lines(cr, uid, ids, context=context)
+        res = super(AccountMoveLine, self).write(
+            cr, uid, ids, vals, context=context, check=check,
+            update_check=update_check)
+        if any(f in vals for f in _MOVE_LINE_DATE_FIELDS):
+            version_obj._increment_move_lines(cr, uid, ids, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None, check=True):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool['mis.data.version']._increment_move_lines(
+            cr, uid, ids, context=context)
+        return super(AccountMoveLine, self).unlink(
+            cr, uid, ids, context=context, check=check)
+
+
+class AccountMove(models.Model):
+
+    _inherit = 'account.move'
+
+    def post(self, cr, uid, ids, context=None):
+        # the move state is changed with SQL
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool['mis.data.version']._increment_moves(
+            cr, uid, ids, context=context)
+        return super(AccountMove, self).post(cr, uid, ids, context=context)
+
+    def button_cancel(self, cr, uid, ids, context=None):
+        # the move state is changed with SQL
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool['mis.data.version']._increment_moves(
+            cr, uid, ids, context=context)
+        return super(AccountMove, self).button_cancel(
+            cr, uid, ids, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if 'state' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool['mis.data.version']._increment_moves(
+                cr, uid, ids, context=context)
+        return super(AccountMove, self).write(
+            cr, uid, ids, vals, context=context)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import datetime
+import json
+import logging
+
+import psycopg2
+
+from openerp import api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+
+class MisReportInstancePrecomputed(models.Model):
+    """ The result of mis.report.instance.compute() for a user, computed
+    in advance by a scheduled job for instances with precompute set.
+
+    The result is served to the user in the preview and dashboards
+    (see MisReportInstance.compute_layout()) as long as the settings of
+    the report are unchanged (see MisReportInstance._get_settings_key()),
+    with the date it was computed at, even if the accounting data has
+    changed since then. Exports always compute the report.
+
+    Results of users not having the instance in a dashboard are
+    precomputed while they open it, and deleted when they have not opened
+    it for mis_builder.precompute_expiry_days days (7 by default). At most
+    mis_builder.precompute_max_users such users (20 by default), who
+    opened it last, are precomputed per instance.
+    """
+
+    _name = 'mis.report.instance.precomputed'
+    _description = 'MIS Builder precomputed result'
+    _log_access = False
+
+    instance_id = fields.Many2one('mis.report.instance',
+                                  string='Report instance',
+                                  required=True, readonly=True,
+                                  ondelete='cascade', index=True)
+    user_id = fields.Many2one('res.users', string='User',
+                              required=True, readonly=True,
+                              ondelete='cascade')
+    date = fields.Datetime(string='As of', readonly=True)
+    access_date = fields.Datetime(string='Last opened', readonly=True)
+    settings_key = fields.Text(readonly=True)
+    data = fields.Text(readonly=True)
+
+    _sql_constraints = [
+        ('instance_user_unique', 'unique(instance_id, user_id)',
+         'Precomputed results must be unique by instance and user!'),
+    ]
+
+    @api.model
+    def _get_result(self, instance):
+        """ Return the precomputed result of an instance for the current
+        user, or None if there is none for the current settings """
+        precomputed = self.sudo().search(
+            [('instance_id', '=', instance.id),
+             ('user_id', '=', self.env.uid)])
+        if not precomputed or \
+                precomputed.settings_key != repr(instance._get_settings_key()):
+            return None
+        res = json.loads(precomputed.data)
+        res['as_of'] = precomputed.date
+        self.env.cr.execute(
+            "UPDATE %s SET access_date = %%s WHERE id = %%s" % self._table,
+            (fields.Datetime.now(), precomputed.id))
+        return res
+
+    @api.model
+    def _store_result(self, instance, res, access=True):
+        """ Store the result of an instance for the current user,
+        and set its as_of date.
+
+        access tells if the user is opening the instance, as opposed
+        to the scheduled job precomputing it. """
+        res['as_of'] = fields.Datetime.now()
+        vals = {
+            'date': res['as_of'],
+            'settings_key': repr(instance._get_settings_key()),
+            'data': json.dumps(res),
+        }
+        if access:
+            vals['access_date'] = res['as_of']
+        precomputed = self.sudo().search(
+            [('instance_id', '=', instance.id),
+             ('user_id', '=', self.env.uid)])
+        if precomputed:
+            precomputed.write(vals)
+        else:
+            vals.update(instance_id=instance.id, user_id=self.env.uid)
+            precomputed.create(vals)
+
+    @api.model
+    def _get_config_int(self, key, default):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            key, str(default)))
+
+    @api.model
+    def _get_expiry_date(self):
+        days = self._get_config_int('mis_builder.precompute_expiry_days', 7)
+        return fields.Datetime.to_string(
+            datetime.datetime.utcnow() - datetime.timedelta(days=days))
+
+    @api.model
+    def _get_recent_user_ids(self, instance):
+        """ Return the ids of the users who opened the instance recently,
+        last opened first """
+        max_users = self._get_config_int('mis_builder.precompute_max_users',
+                                         20)
+        return self.sudo().search(
+            [('instance_id', '=', instance.id),
+             ('access_date', '>=', self._get_expiry_date())],
+            order='access_date desc',
+            limit=max_users).mapped('user_id').ids
+
+    @api.model
+    def _delete_other_users(self, instance, user_ids):
+        """ Delete the results of an instance for users other than
+        user_ids (those not precomputed anymore) """
+        self.sudo().search(
+            [('instance_id', '=', instance.id),
+             ('user_id', 'not in', user_ids)]).unlink()
+
+    @api.model
+    def _trigger_precompute(self):
+        """ Run the precomputation job as soon as possible, unless it is
+        running now or already due.
+
+        The next call of the job is read with the current cursor, so
+        postings find the job already due without more queries. When it
+        is not, the next call is set in a separate transaction, committed
+        at once, so the row of the job is not locked until the end of
+        the current transaction (eg a posting), which would make
+        concurrent postings and the scheduler wait for it. The job runs at
+        the next poll of the scheduler, normally after the current
+        transaction is committed; changes committed after it started are
+        precomputed by its next run. """
+        cron = self.env.ref('mis_builder.ir_cron_mis_report_precompute',
+                            raise_if_not_found=False)
+        if not cron:
+            return
+        now = fields.Datetime.now()
+        self.env.cr.execute(
+            "SELECT active AND nextcall > %s FROM ir_cron WHERE id = %s",
+            (now, cron.id))
+        row = self.env.cr.fetchone()
+        if not row or not row[0]:
+            # inactive or already due
+            return
+        if not self.env['mis.report.instance'].sudo().search(
+                [('precompute', '=', True)], limit=1):
+            return
+        cr = self.pool.cursor()
+        try:
+            with tools.mute_logger('openerp.sql_db'):
+                cr.execute("SELECT id FROM ir_cron WHERE id = %s "
+                           "FOR UPDATE NOWAIT", (cron.id,))
+            cr.execute("UPDATE ir_cron SET nextcall = %s "
+                       "WHERE id = %s AND nextcall > %s",
+                       (now, cron.id, now))
+            cr.commit()
+        except psycopg2.OperationalError:
+            # the job is running
+            cr.rollback()
+        finally:
+            cr.close()
+
+
+class AccountMove(models.Model):
+
+    _inherit = 'account.move'
+
+    def post(self, cr, uid, ids, context=None):
+        res = super(AccountMove, self).post(cr, uid, ids, context=context)
+        # refresh precomputed results after posting
+        self.pool['mis.report.instance.precomputed']._trigger_precompute(
+            cr, uid, context=context)
+        return res
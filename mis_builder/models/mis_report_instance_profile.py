@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import json
+
+from openerp import api, fields, models
+
+
+class MisReportInstanceProfile(models.Model):
+    """ The profile of a computation of a MIS report instance.
+
+    A profile is recorded each time an instance is computed with profiling
+    enabled, with the version (last modification date) of the report
+    template, so the evolution of computation times can be followed
+    when the template or the data change.
+    """
+
+    _name = 'mis.report.instance.profile'
+    _description = 'MIS Builder computation profile'
+    _order = 'date desc, id desc'
+
+    instance_id = fields.Many2one('mis.report.instance',
+                                  string='Report instance',
+                                  required=True, readonly=True,
+                                  ondelete='cascade', index=True)
+    report_id = fields.Many2one('mis.report', string='Report',
+                                readonly=True, ondelete='cascade')
+    report_write_date = fields.Datetime(string='Report version',
+                                        readonly=True)
+    date = fields.Datetime(string='Date', readonly=True,
+                           default=fields.Datetime.now)
+    user_id = fields.Many2one('res.users', string='User', readonly=True)
+    total_time = fields.Float(string='Time (s)', readonly=True,
+                              digits=(16, 3))
+    sql_count = fields.Integer(string='SQL queries', readonly=True)
+    kpi_count = fields.Integer(string='KPI\'s', readonly=True)
+    period_count = fields.Integer(string='Periods', readonly=True)
+    data = fields.Text(string='Profile', readonly=True)
+
+    @api.model
+    def _record(self, instance, profile):
+        """ Record the profile returned by mis.report.instance.compute() """
+        return self.sudo().create({
+            'instance_id': instance.id,
+            'report_id': instance.report_id.id,
+            'report_write_date': instance.report_id.write_date,
+            'user_id': self.env.uid,
+            'total_time': profile['total_time'],
+            'sql_count': profile['total_sql'],
+            'kpi_count': len(profile['cells']),
+            'period_count': len(profile['periods']),
+            'data': json.dumps(profile, indent=1, sort_keys=True),
+        })
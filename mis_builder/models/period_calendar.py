@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+
+import bisect
+
+
+class PeriodCalendar(object):
+    """ The normal (non special) fiscal periods of a company, ordered by
+    start date, loaded with one query, to look up periods by date with
+    bisect instead of searching account.period. Dates are strings, as
+    returned by the orm and the cursor.
+
+    Calendars are meant to be kept for one computation (see
+    get_period_calendar()), and are not invalidated when periods
+    are modified.
+    """
+
+    def __init__(self, cr, company_id):
+        cr.execute("""
+            SELECT id, date_start, date_stop
+            FROM account_period
+            WHERE company_id = %s AND special IS NOT TRUE
+            ORDER BY date_start, id
+        """, (company_id,))
+        rows = cr.fetchall()
+        self.ids = [row[0] for row in rows]
+        self.date_starts = [row[1] for row in rows]
+        self.date_stops = [row[2] for row in rows]
+
+    def find(self, date):
+        """ Return the index of the period containing date, or None """
+        i = bisect.bisect_right(self.date_starts, date) - 1
+        if i < 0 or self.date_stops[i] < date:
+            return None
+        return i
+
+    def get_slice(self, date, offset, duration):
+        """ Return the ids of duration periods starting offset periods
+        after the period containing date, or None if there are not
+        enough periods """
+        i = self.find(date)
+        if i is None:
+            return None
+        i += offset
+        if i < 0 or i + duration > len(self.ids):
+            return None
+        return self.ids[i:i + duration]
+
+    def get_previous(self, date):
+        """ Return the id of the last period starting before date,
+        or None """
+        i = bisect.bisect_left(self.date_starts, date)
+        return self.ids[i - 1] if i else None
+
+    def get_first(self):
+        """ Return the id of the first period, or None """
+        return self.ids[0] if self.ids else None
+
+    def get_between(self, date_from, date_to):
+        """ Return the ids of the periods starting on or after date_from
+        and ending on or before date_to """
+        start = bisect.bisect_left(self.date_starts, date_from)
+        end = bisect.bisect_right(self.date_starts, date_to)
+        return [self.ids[i] for i in range(start, end)
+                if self.date_stops[i] <= date_to]
+
+
+def get_period_calendar(env, company_id, calendars):
+    """ Return the PeriodCalendar of a company, keeping it in calendars,
+    a dictionary kept for the duration of a computation """
+    try:
+        return calendars[company_id]
+    except KeyError:
+        calendar = calendars[company_id] = PeriodCalendar(env.cr, company_id)
+        return calendar
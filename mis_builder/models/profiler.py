@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# © 2016 ACSONE SA/NV (<http://acsone.eu>)
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
+"""
+Profiling of MIS report computations.
+
+A Profiler records the wall time, the number of SQL queries and the number
+of rows of the steps of a report computation (accounting queries, report
+queries, KPI evaluations...). When profiling is not enabled, NULL_PROFILER
+is used, which records nothing.
+"""
+
+import time
+from contextlib import contextmanager
+
+__all__ = ['Profiler', 'NULL_PROFILER']
+
+
+class Profiler(object):
+    """ Collect profiling entries, which are dictionaries with
+    category, key, period_id, time (in seconds), sql (number of queries)
+    and rows (number of rows read, if relevant) """
+
+    enabled = True
+
+    def __init__(self, entries=None, period_id=None):
+        self.entries = [] if entries is None else entries
+        self.period_id = period_id
+
+    def for_period(self, period_id):
+        """ Return a profiler recording entries of a period,
+        in the same list of entries """
+        return Profiler(self.entries, period_id)
+
+    @contextmanager
+    def measure(self, cr, category, key):
+        """ Measure the execution of a block, which may set the
+        number of rows it reads in the yielded entry """
+        entry = {
+            'category': category,
+            'key': key,
+            'period_id': self.period_id,
+            'rows': None,
+        }
+        sql_count = cr.sql_log_count
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['time'] = time.time() - start
+            entry['sql'] = cr.sql_log_count - sql_count
+            # list.append is atomic, so periods computed in
+            # threads can share the list of entries
+            self.entries.append(entry)
+
+
+class NullProfiler(object):
+
+    enabled = False
+    entries = []
+
+    def for_period(self, period_id):
+        return self
+
+    @contextmanager
+    def measure(self, cr, category, key):
+        yield {}
+
+
+NULL_PROFILER = NullProfiler()
@@ -7,6 +7,12 @@ openerp.mis_builder = function(instance) {
             this._super.apply(this, arguments);
             this.mis_report_data = null;
             this.mis_report_instance_id = false;
+            this.profile = false;
+            this.refresh = false;
+            this.generation = 0;
+            // number of batches of periods loaded concurrently
+            this.max_loading_batches = 2;
+            this.is_account_user = null;
             this.field_manager.on("view_content_has_changed", this, this.reload_widget);
         },
 
@@ -38,6 +44,12 @@ openerp.mis_builder = function(instance) {
             if (this.mis_report_instance_id){
                 context['active_ids'] = [this.mis_report_instance_id];
             }
+            if (this.profile){
+                context['mis_report_profile'] = true;
+            }
+            if (this.refresh){
+                context['mis_report_refresh'] = true;
+            }
             return context
         },
         print: function() {
@@ -73,30 +85,121 @@ openerp.mis_builder = function(instance) {
                 self.do_action(result);
             });
         },
+        refresh_content: function() {
+            // compute again, instead of displaying a precomputed result
+            this.refresh = true;
+            this.generate_content();
+        },
+        as_of: function() {
+            return instance.web.format_value(
+                this.mis_report_data.as_of, {type: 'datetime'});
+        },
+        toggle_profile: function() {
+            this.profile = !this.profile;
+            this.generate_content();
+        },
+        profile_style: function(value) {
+            // heat map of the time spent computing a cell
+            if (value.profile_ratio === undefined) {
+                return value.style;
+            }
+            var alpha = (0.6 * value.profile_ratio).toFixed(2);
+            return (value.style || '') +
+                ';background-color: rgba(255, 0, 0, ' + alpha + ')';
+        },
+        profile_title: function(value) {
+            if (value.profile_time === undefined) {
+                return value.val_c;
+            }
+            var title = (value.profile_time * 1000).toFixed(1) + ' ms';
+            return value.val_c ? value.val_c + '\n' + title : title;
+        },
         generate_content: function() {
+            // load the layout of the report, then its columns by batches
+            // of periods, a few at a time, displaying each batch as soon
+            // as it is computed; responses of a previous generation (the
+            // widget has been reloaded or destroyed since) are ignored
             var self = this
-            context = new instance.web.CompoundContext(self.build_context(), self.get_context()|| {}) 
-            new instance.web.Model("mis.report.instance").call(
-                "compute", 
+            var generation = ++self.generation;
+            var context = new instance.web.CompoundContext(self.build_context(), self.get_context()|| {}) 
+            var Instance = new instance.web.Model("mis.report.instance");
+            Instance.call(
+                "compute_layout", 
                 [self.mis_report_instance_id], 
                 {'context': context}
-            ).then(function(result){
-                self.mis_report_data = result;
+            ).then(function(layout){
+                if (generation !== self.generation) {
+                    return;
+                }
+                self.refresh = false;
+                if (layout.result) {
+                    self.mis_report_data = layout.result;
+                    self.renderElement();
+                    return;
+                }
+                self.mis_report_data = {
+                    'header': layout.header,
+                    'content': layout.content,
+                };
                 self.renderElement();
+                var batches = layout.batches.slice();
+                var load_next_batch = function() {
+                    if (generation !== self.generation || !batches.length) {
+                        return;
+                    }
+                    var batch = batches.shift();
+                    Instance.call(
+                        "compute_period_columns",
+                        [self.mis_report_instance_id, _.pluck(batch, 'period_id')],
+                        {'context': context}
+                    ).then(function(rows_by_period){
+                        if (generation !== self.generation) {
+                            return;
+                        }
+                        _.each(batch, function(period, j) {
+                            _.each(rows_by_period[j], function(cells, i) {
+                                var cols = self.mis_report_data.content[i].cols;
+                                Array.prototype.splice.apply(
+                                    cols, [period.col_index, period.col_count].concat(cells));
+                            });
+                        });
+                        self.renderElement();
+                    }).always(load_next_batch);
+                };
+                for (var i = 0; i < self.max_loading_batches; i++) {
+                    load_next_batch();
+                }
             });
         },
+        destroy: function() {
+            // ignore the columns still loading
+            this.generation++;
+            this._super.apply(this, arguments);
+        },
         renderElement: function() {
             this._super();
             var self = this;
             self.$(".oe_mis_builder_print").click(_.bind(this.print, this));
             self.$(".oe_mis_builder_export").click(_.bind(this.export_pdf, this));
             self.$(".oe_mis_builder_settings").click(_.bind(this.display_settings, this));
-            var Users = new instance.web.Model('res.users');
-            Users.call('has_group', ['account.group_account_user']).done(function (res) {
-                if (res) {
+            self.$(".oe_mis_builder_profile").click(_.bind(this.toggle_profile, this));
+            self.$(".oe_mis_builder_refresh").click(_.bind(this.refresh_content, this));
+            var show_buttons = function() {
+                if (self.is_account_user) {
                     self.$(".oe_mis_builder_settings").show();
+                    self.$(".oe_mis_builder_profile").show();
                 }
-            });
+            };
+            if (self.is_account_user === null) {
+                // the widget is rendered each time a column is loaded
+                var Users = new instance.web.Model('res.users');
+                Users.call('has_group', ['account.group_account_user']).done(function (res) {
+                    self.is_account_user = res;
+                    show_buttons();
+                });
+            } else {
+                show_buttons();
+            }
         },
         events: {
             "click a.mis_builder_drilldown": "drilldown",
@@ -108,11 +211,18 @@ openerp.mis_builder = function(instance) {
             if (drilldown) {
                 var period_id = JSON.parse($(event.target).data("period-id"));
                 var val_c = JSON.parse($(event.target).data("expr"));
+                var kwargs = {};
+                // cells of a dimension value (see expand_by)
+                var dimension_value = $(event.target).data("dimension-value");
+                if (dimension_value !== undefined) {
+                    kwargs.dimension_value = JSON.parse(dimension_value);
+                }
                 context = new instance.web.CompoundContext(self.build_context(), self.get_context()|| {}) 
+                kwargs.context = context;
                 new instance.web.Model("mis.report.instance.period").call(
                     "drilldown",
                     [period_id, val_c],
-                    {'context': context}
+                    kwargs
                 ).then(function(result) {
                     if (result) {
                         self.do_action(result);
@@ -2,9 +2,22 @@
 # © 2014-2015 ACSONE SA/NV (<http://acsone.eu>)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+import doctest
+import unittest
+
 import openerp.tests.common as common
+from openerp.exceptions import AccessError, ValidationError
+from openerp.tools.safe_eval import safe_eval
 
+from ..models import account_account
 from ..models import mis_builder
+from ..models import period_calendar
+from ..models.aep import AccountingExpressionProcessor as AEP
+from ..models.aep import OrmQueryBackend, SqlQueryBackend
+from ..models.accounting_none import AccountingNone
+from ..models.aggregate import _sum, _avg, _min, _max
+from ..models.kpi_compiler import CompiledKpis
+from ..models import kpi_vector
 
 
 class TestMisBuilder(common.TransactionCase):
@@ -61,3 +74,538 @@ class TestMisBuilder(common.TransactionCase):
                              'name': u'today'}]
                    }],
              }, data)
+
+    def test_fetch_query_aggregates(self):
+        report = self.env.ref('mis_builder.mis_report_test')
+        aml_model = self.env['account.move.line']
+        domain = [('debit', '>', 0)]
+        field_names = ['debit', 'credit']
+        data = aml_model.search_read(domain, field_names)
+        for aggregate, agg in (('sum', _sum), ('avg', _avg),
+                               ('min', _min), ('max', _max)):
+            s = report._fetch_query_aggregates(
+                aml_model, domain, field_names, aggregate)
+            self.assertEqual(s.count, len(data))
+            for field_name in field_names:
+                self.assertAlmostEqual(getattr(s, field_name),
+                                       agg([d[field_name] for d in data]))
+        s = report._fetch_query_aggregates(
+            aml_model, [('id', '=', 0)], field_names, 'avg')
+        self.assertEqual((s.count, s.debit), (0, None))
+        # non numeric fields are aggregated in python
+        self.assertIsNone(report._fetch_query_aggregates(
+            aml_model, domain, ['date'], 'max'))
+        # records of queries without aggregate are read lazily
+        res = mis_builder.QueryResult(aml_model, domain, field_names, 3)
+        self.assertEqual(len(res), min(len(data), 3))
+        self.assertEqual([r.debit for r in res],
+                         [d['debit'] for d in data[:3]])
+        self.assertEqual(res[0].debit, data[0]['debit'])
+
+    def test_fetch_queries_multi(self):
+        field_ids = [self.ref('account.field_account_move_line_debit'),
+                     self.ref('account.field_account_move_line_credit')]
+        report = self.env['mis.report'].create(dict(
+            name='test queries multi',
+            query_ids=[(0, 0, dict(
+                name='q_%s' % aggregate,
+                model_id=self.ref('account.model_account_move_line'),
+                field_ids=[(6, 0, field_ids)],
+                date_field=self.ref('account.field_account_move_line_date'),
+                aggregate=aggregate,
+            )) for aggregate in ('sum', 'avg', 'min', 'max')],
+        ))
+        periods = self.env['account.period'].search(
+            [('special', '=', False)], order='date_start', limit=3)
+        date_ranges = [(p.date_start, p.date_stop) for p in periods]
+        prefetched_queries_list = report._fetch_queries_multi(date_ranges)
+        for (date_from, date_to), prefetched_queries in \
+                zip(date_ranges, prefetched_queries_list):
+            expected = report._fetch_queries(date_from, date_to)
+            self.assertEqual(sorted(prefetched_queries), sorted(expected))
+            for name, s in expected.items():
+                self.assertEqual(prefetched_queries[name].count, s.count)
+                for field_name in ('debit', 'credit'):
+                    self.assertAlmostEqual(
+                        getattr(prefetched_queries[name], field_name),
+                        getattr(s, field_name))
+
+    def test_fetch_queries_access_rights(self):
+        report = self.env['mis.report'].create(dict(
+            name='test queries access rights',
+            query_ids=[(0, 0, dict(
+                name='q_sum',
+                model_id=self.ref('account.model_account_move_line'),
+                field_ids=[(6, 0, [
+                    self.ref('account.field_account_move_line_debit')])],
+                date_field=self.ref('account.field_account_move_line_date'),
+                aggregate='sum',
+            ))],
+        ))
+        user = self.env['res.users'].create(dict(
+            name='test queries access rights',
+            login='test_queries_access_rights',
+            groups_id=[(6, 0, [self.ref('base.group_user')])]))
+        self.assertFalse(self.env['account.move.line'].sudo(user).
+                         check_access_rights('read', raise_exception=False))
+        period = self.env['account.period'].search(
+            [('special', '=', False)], order='date_start', limit=1)
+        report = report.sudo(user)
+        with self.assertRaises(AccessError):
+            report._fetch_queries(period.date_start, period.date_stop)
+        with self.assertRaises(AccessError):
+            report._fetch_queries_multi(
+                [(period.date_start, period.date_stop)] * 2)
+
+    def test_aep_do_queries_multi(self):
+        root_account = self.env.ref('account.chart0')
+        periods = self.env['account.period'].search(
+            [('special', '=', False),
+             ('company_id', '=', root_account.company_id.id)],
+            order='date_start', limit=3)
+        columns = [(periods[0], periods[0]), (periods[1], periods[2])]
+        expr = 'bal[] + deb[] + bali[] + crde[]'
+        aep = AEP(self.env)
+        aep.parse_expr(expr)
+        aep.done_parsing(root_account)
+        expected = []
+        for period_from, period_to in columns:
+            aep.do_queries(period_from.date_start, period_to.date_stop,
+                           period_from, period_to, 'all')
+            expected.append(aep.replace_expr(expr))
+        aep.do_queries_multi(columns, 'all')
+        for (period_from, period_to), expected_expr in zip(columns, expected):
+            aep.do_queries(period_from.date_start, period_to.date_stop,
+                           period_from, period_to, 'all')
+            localdict = {'AccountingNone': AccountingNone}
+            self.assertAlmostEqual(
+                safe_eval(aep.replace_expr(expr), localdict),
+                safe_eval(expected_expr, localdict))
+
+    def test_aep_get_var_value(self):
+        aep = AEP(self.env)
+        aep._account_ids_by_code['70'] = set([1, 2, 3])
+        aep._data = {((), 'p'): {1: (10.0, 2.0), 2: (0.0, 3.0)},
+                     ((), 'i'): {}}
+        self.assertEqual(aep.get_var_value('bal', 'p', ('70',), ()), 5.0)
+        self.assertEqual(aep.get_var_value('deb', 'p', ('70',), ()), 10.0)
+        self.assertEqual(aep.get_var_value('crd', 'p', ('70',), ()), 5.0)
+        self.assertIs(aep.get_var_value('bal', 'i', ('70',), ()),
+                      AccountingNone)
+        self.assertIs(aep.get_var_value('bal', 'p', ('60',), ()),
+                      AccountingNone)
+
+    def test_aep_dimension(self):
+        root_account = self.env.ref('account.chart0')
+        periods = self.env['account.period'].search(
+            [('special', '=', False),
+             ('company_id', '=', root_account.company_id.id)],
+            order='date_start', limit=3)
+        var = ('bal', 'p', (None,), ())
+        aep = AEP(self.env, dimension='partner_id')
+        aep.parse_expr('bal[]')
+        aep.done_parsing(root_account)
+        aep.do_queries(periods[0].date_start, periods[2].date_stop,
+                       periods[0], periods[2], 'all')
+        values = aep.get_var_values_by_dimension(*var)
+        self.assertEqual(set(values), aep.get_dimension_values())
+        self.assertAlmostEqual(sum(values.values()), aep.get_var_value(*var))
+        for partner_id, value in values.items():
+            partner_aep = AEP(self.env)
+            expr = "bal[][('partner_id', '=', %r)]" % (partner_id or False,)
+            partner_aep.parse_expr(expr)
+            partner_aep.done_parsing(root_account)
+            partner_aep.do_queries(periods[0].date_start, periods[2].date_stop,
+                                   periods[0], periods[2], 'all')
+            self.assertAlmostEqual(
+                value, safe_eval(partner_aep.replace_expr(expr),
+                                 {'AccountingNone': AccountingNone}))
+        # prefetched data is grouped by dimension too
+        aep.do_queries_multi([(periods[0], periods[0]),
+                              (periods[0], periods[2])], 'all')
+        aep.do_queries(periods[0].date_start, periods[2].date_stop,
+                       periods[0], periods[2], 'all')
+        self.assertEqual(aep.get_var_values_by_dimension(*var), values)
+
+    def test_expand_by_dimension(self):
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        report = instance.report_id
+        report.kpi_ids[0].copy({'name': 'k_bal', 'description': 'balance',
+                                'expression': 'bal[]', 'expand': True})
+        instance.write({'expand_by': 'partner_id', 'target_move': 'all'})
+        # a column over all move lines
+        instance.period_ids.write({'offset': -36500, 'duration': 73000})
+        partners = self.env['account.move.line'].search(
+            [('account_id', 'child_of', instance.root_account.id)]).mapped(
+            'partner_id')
+        res = instance.compute()
+        rows = [row for row in res['content'] if row.get('dimension')]
+        self.assertEqual(set(row['kpi_name'] for row in rows
+                             if row['kpi_name'] != 'Undefined'),
+                         set(partners.mapped('display_name')))
+        for row in rows:
+            self.assertEqual(len(row['cols']),
+                             len(res['header'][0]['cols']))
+        instance.expand_mode = 'columns'
+        res = instance.compute()
+        self.assertEqual(len(res['content']), len(report.kpi_ids))
+        self.assertEqual(len(res['header'][0]['cols']),
+                         len(instance.period_ids.filtered(lambda p: p.valid)) +
+                         len(rows))
+
+    def test_aep_query_backends(self):
+        domain = [('move_id.state', '=', 'posted')]
+        groupby = ['account_id', 'period_id']
+        self.assertEqual(
+            sorted(SqlQueryBackend().read_sums(self.env, domain, groupby)),
+            sorted(OrmQueryBackend().read_sums(self.env, domain, groupby)))
+
+    def test_aep_tokenize(self):
+        expr = "bal[70] + crdi[60,61][('journal_id.code', '=', 'BNK')]"
+        tokens = AEP._tokenize(expr)
+        self.assertIs(AEP._tokenize(expr), tokens)
+        self.assertEqual(tokens, (
+            ('bal', 'p', ('70',), (), (0, 7)),
+            ('crd', 'i', ('60', '61'),
+             (('journal_id.code', '=', 'BNK'),), (10, 54)),
+        ))
+        self.assertEqual(
+            AEP._replace_tokens(expr, lambda f, m, c, d: f + m),
+            'balp + crdi')
+
+    def test_account_code_index(self):
+        self.assertFalse(doctest.testmod(account_account).failed)
+        account_model = self.env['account.account']
+        root = self.env.ref('account.chart0')
+        codes = [None] + list(set(
+            account_model.search([]).mapped('code'))) + ['1%', 'X1%', '%']
+        res = account_model._mis_get_account_ids_by_codes(root.id, codes)
+        for code in codes:
+            operator = code and '%' in code and 'like' or '='
+            domain = [('code', operator, code or root.code),
+                      ('parent_id', 'child_of', root.id)]
+            expected = set()
+            for account in account_model.search(domain):
+                if account.type in ('view', 'consolidation'):
+                    expected.update(account._get_children_and_consol())
+                else:
+                    expected.add(account.id)
+            self.assertEqual(res[code], expected, code)
+
+    def test_account_code_cache_invalidation(self):
+        account_model = self.env['account.account']
+        root = self.env.ref('account.chart0')
+        account = self.env.ref('account.a_sale')
+        code = account.code
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        settings_key = instance._get_settings_key()
+        self.assertIn(account.id, account_model._mis_get_account_ids_by_code(
+            root.id, code))
+        account.write({'active': False})
+        self.assertNotIn(account.id,
+                         account_model._mis_get_account_ids_by_code(
+                             root.id, code))
+        account.write({'active': True, 'code': code + 'X'})
+        self.assertNotIn(account.id,
+                         account_model._mis_get_account_ids_by_code(
+                             root.id, code))
+        self.assertIn(account.id, account_model._mis_get_account_ids_by_code(
+            root.id, code + 'X'))
+        # results computed with the former accounts are not reused
+        self.assertNotEqual(instance._get_settings_key(), settings_key)
+
+    def test_period_calendar(self):
+        company = self.env.ref('base.main_company')
+        periods = self.env['account.period'].search(
+            [('special', '=', False), ('company_id', '=', company.id)],
+            order='date_start')
+        calendar = period_calendar.PeriodCalendar(self.env.cr, company.id)
+        self.assertEqual(calendar.ids, periods.ids)
+        self.assertEqual(calendar.get_first(), periods[0].id)
+        self.assertIsNone(calendar.get_previous(periods[0].date_start))
+        self.assertEqual(calendar.get_previous(periods[1].date_start),
+                         periods[0].id)
+        self.assertEqual(calendar.get_slice(periods[1].date_stop, -1, 2),
+                         periods[:2].ids)
+        self.assertIsNone(calendar.get_slice(periods[0].date_start, -1, 1))
+        self.assertIsNone(calendar.get_slice('1900-01-01', 0, 1))
+        self.assertEqual(
+            calendar.get_between(periods[1].date_start, periods[-1].date_stop),
+            periods[1:].ids)
+
+    def test_kpi_evaluation_order(self):
+        compiled_kpis = CompiledKpis([
+            ('a', 'b + 1'),
+            ('b', 'bal[70]'),
+            ('c', 'd'),
+            ('d', 'c + a'),
+            ('e', 'sum(b for b in [a])'),
+        ])
+        self.assertEqual(compiled_kpis.order, [1, 0, 4, 2, 3])
+        self.assertEqual(compiled_kpis.cycles, {2: ['d'], 3: ['c']})
+
+    def test_period_balance(self):
+        root_account = self.env.ref('account.chart0')
+        period = self.env['account.period'].search(
+            [('special', '=', False),
+             ('company_id', '=', root_account.company_id.id)],
+            order='date_start desc', limit=1)
+        expr = 'bal[] + bali[] + deb[] + crde[]'
+
+        def _eval():
+            aep = AEP(self.env)
+            aep.parse_expr(expr)
+            aep.done_parsing(root_account)
+            aep.do_queries(period.date_start, period.date_stop,
+                           period, period, 'posted')
+            return safe_eval(aep.replace_expr(expr),
+                             {'AccountingNone': AccountingNone})
+
+        period_balance_model = self.env['mis.account.period.balance']
+        expected = _eval()
+        period_balance_model.rebuild()
+        self.assertEqual(period_balance_model.check_consistency(), [])
+        self.assertAlmostEqual(_eval(), expected)
+        # lines created when posting on a centralised journal
+        # are accounted for once, in posted balances
+        journal = self.env.ref('account.sales_journal')
+        journal.write({'centralisation': True, 'update_posted': True})
+        move = self.env['account.move'].create(dict(
+            journal_id=journal.id,
+            period_id=period.id,
+            date=period.date_start,
+            line_id=[
+                (0, 0, dict(name='test', debit=100.0,
+                            period_id=period.id, date=period.date_start,
+                            account_id=self.ref('account.a_recv'))),
+                (0, 0, dict(name='test', credit=100.0,
+                            period_id=period.id, date=period.date_start,
+                            account_id=self.ref('account.a_sale'))),
+            ],
+        ))
+        self.assertEqual(period_balance_model.check_consistency(), [])
+        move.button_validate()
+        self.assertEqual(move.state, 'posted')
+        self.assertEqual(period_balance_model.check_consistency(), [])
+        move.button_cancel()
+        self.assertEqual(period_balance_model.check_consistency(), [])
+        # period balances are read with the record rules of move lines
+        aep = AEP(self.env)
+        self.assertEqual(aep._get_period_balance_rule_domain(), [])
+        user = self.env['res.users'].create(dict(
+            name='test period balance', login='test_period_balance',
+            groups_id=[(6, 0, [self.ref('base.group_user')])]))
+        aep = AEP(self.env(user=user.id))
+        rule_domain = aep._get_period_balance_rule_domain()
+        self.assertTrue(rule_domain)
+        self.assertIn('company_id', [e[0] for e in rule_domain
+                                     if isinstance(e, (list, tuple))])
+        period_balance_model.disable()
+
+    @unittest.skipUnless(kpi_vector.HAS_NUMPY, "numpy is not installed")
+    def test_vectorized_evaluation(self):
+        self.assertFalse(doctest.testmod(kpi_vector).failed)
+        report = self.env['mis.report'].create(dict(
+            name='test vectorized',
+            kpi_ids=[
+                (0, 0, dict(name='a', description='a',
+                            expression='bal[70%] - balp[60%]')),
+                (0, 0, dict(name='b', description='b',
+                            expression='a / bal[70%] * 100',
+                            type='pct')),
+                (0, 0, dict(name='c', description='c',
+                            expression='a if a > 0 else -a')),
+                (0, 0, dict(name='d', description='d',
+                            expression='-(b + c) // 2')),
+            ],
+        ))
+        instance = self.env['mis.report.instance'].create(dict(
+            name='test vectorized',
+            report_id=report.id,
+            root_account=self.env.ref('account.chart0').id,
+            target_move='all',
+            period_ids=[(0, 0, dict(name='p%d' % i, type='fp',
+                                    offset=-i, duration=1))
+                        for i in range(3)],
+        ))
+        expected = instance.compute()
+        instance.vectorize = True
+        self.assertEqual(instance.compute(), expected)
+
+    def test_kpi_formatter(self):
+        lang_id = self.env['res.lang'].search([('code', '=', 'en_US')]).id
+        kpi = self.env.ref('mis_builder.mis_report_kpi_test')
+        formatter = self.env['mis.report.kpi']._get_formatter(lang_id)
+        self.assertEqual(
+            formatter.render_num(-1234567.891, '1e3', 1, '$', ''),
+            u'$\u202f\u20111,234.6\xa0k')
+        self.assertEqual(
+            formatter.render_row(kpi, [1000.0, AccountingNone, None]),
+            [kpi.render(lang_id, 1000.0), u'', u''])
+
+    def test_profile(self):
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        res = instance.compute()
+        self.assertNotIn('profile', res)
+        self.assertFalse(instance.profile_ids)
+        res = instance.with_context(mis_report_profile=True).compute()
+        profile = res['profile']
+        self.assertTrue(profile['entries'])
+        self.assertEqual(set(profile['cells']),
+                         set(instance.report_id.kpi_ids.mapped('name')))
+        instance.invalidate_cache()
+        self.assertEqual(len(instance.profile_ids), 1)
+        self.assertEqual(instance.profile_ids.sql_count,
+                         profile['total_sql'])
+
+    def test_window_cache(self):
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        expected = instance.compute()
+        instance.cache_results = True
+        periods = instance.period_ids.filtered(lambda p: p.valid)
+        # nothing is cached while the transaction has uncommitted writes
+        self.assertEqual(instance.compute(), expected)
+        keys = instance._get_window_cache_keys(periods)
+        self.assertEqual(set(keys), set(periods.ids))
+        for key in keys.values():
+            self.assertNotIn(key, mis_builder._window_cache)
+        self.assertNotIn(instance._get_compute_cache_key(),
+                         mis_builder._compute_cache)
+        # as if the settings of the instances were committed
+        instance_class = type(instance)
+        instance_class._has_pending_writes = lambda self: False
+        try:
+            self.assertEqual(instance.compute(), expected)
+            for key in keys.values():
+                self.assertIn(key, mis_builder._window_cache)
+            self.assertIn(instance._get_compute_cache_key(),
+                          mis_builder._compute_cache)
+            # the columns of a copy of the instance are reused
+            instance2 = instance.copy()
+            res = instance2.compute()
+        finally:
+            del instance_class._has_pending_writes
+        self.assertEqual(
+            [[col['val_r'] for col in row['cols']] for row in res['content']],
+            [[col['val_r'] for col in row['cols']]
+             for row in expected['content']])
+        self.assertEqual(
+            set(col['period_id'] for row in res['content']
+                for col in row['cols'] if 'period_id' in col),
+            set(instance2.period_ids.filtered(lambda p: p.valid).ids))
+
+    def test_data_version(self):
+        period = self.env['account.period'].search(
+            [('special', '=', False)], order='date_start desc', limit=1)
+        version_model = self.env['mis.data.version']
+        dates = [period.date_start, period.date_stop]
+
+        def _versions():
+            versions = version_model._get_versions(dates)
+            return [versions[date] for date in dates]
+
+        before = _versions()
+        move = self.env['account.move'].create(dict(
+            journal_id=self.ref('account.sales_journal'),
+            period_id=period.id,
+            date=period.date_stop,
+            line_id=[
+                (0, 0, dict(name='test', debit=100.0,
+                            period_id=period.id, date=period.date_stop,
+                            account_id=self.ref('account.a_recv'))),
+                (0, 0, dict(name='test', credit=100.0,
+                            period_id=period.id, date=period.date_stop,
+                            account_id=self.ref('account.a_sale'))),
+            ],
+        ))
+        created = _versions()
+        # lines count from the start of their fiscal period
+        self.assertGreater(created[0], before[0])
+        self.assertGreater(created[1], before[1])
+        move.button_validate()
+        self.assertGreater(_versions()[1], created[1])
+
+    def test_compute_workers(self):
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        self.assertFalse(instance._has_pending_writes())
+        lang_id = instance._get_lang_id()
+        formatter = self.env['mis.report.kpi']._get_formatter(lang_id)
+        periods = instance.period_ids.filtered(lambda p: p.valid)
+        expected = instance._compute_kpi_values(
+            lang_id, periods, formatter)[0]
+        aep = instance.report_id._prepare_aep(instance.root_account)
+        instance._prefetch_aep(aep, periods)
+        res = instance._compute_periods_parallel(
+            lang_id, aep, periods, formatter, workers=2)
+        self.assertEqual(res, expected)
+        # threads would not see the changes of the transaction
+        instance.compute_workers = 2
+        self.assertTrue(instance._has_pending_writes())
+        self.assertEqual(
+            instance._compute_kpi_values(lang_id, periods, formatter),
+            (expected, False))
+        with self.assertRaises(ValidationError):
+            instance.compute_workers = mis_builder.MAX_COMPUTE_WORKERS + 1
+
+    def test_precompute(self):
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        Precomputed = self.env['mis.report.instance.precomputed']
+        instance.precompute = True
+        # exports are always computed
+        res = instance.compute()
+        self.assertNotIn('as_of', res)
+        self.assertFalse(Precomputed.search(
+            [('instance_id', '=', instance.id)]))
+        # the preview stores the result, and serves it the next time
+        res = instance.compute_layout()['result']
+        self.assertTrue(res['as_of'])
+        precomputed = Precomputed.search([('instance_id', '=', instance.id)])
+        self.assertEqual(precomputed.user_id, self.env.user)
+        self.assertTrue(precomputed.access_date)
+        self.assertEqual(instance.compute_layout(), {'result': res})
+        self.assertEqual(Precomputed._get_result(instance), res)
+        self.assertEqual(instance._get_precompute_user_ids(), [self.env.uid])
+        # results are not served for another base date
+        instance.date = '2010-01-01'
+        self.assertIsNone(Precomputed._get_result(instance))
+        # users who did not open the instance recently are not precomputed
+        precomputed.access_date = '2000-01-01 00:00:00'
+        self.assertEqual(instance._get_precompute_user_ids(), [])
+        Precomputed._delete_other_users(instance, [])
+        self.assertFalse(precomputed.exists())
+
+    def test_progressive_loading(self):
+        instance = self.env.ref('mis_builder.mis_report_instance_test')
+        expected = instance.compute()
+        layout = instance.compute_layout()
+        self.assertEqual(layout['header'], expected['header'])
+        self.assertTrue(layout['periods'])
+        self.assertEqual(
+            sorted(p['period_id'] for batch in layout['batches']
+                   for p in batch),
+            sorted(p['period_id'] for p in layout['periods']))
+        for batch in layout['batches']:
+            rows_by_period = instance.compute_period_columns(
+                [period['period_id'] for period in batch])
+            self.assertEqual(len(rows_by_period), len(batch))
+            for period, rows in zip(batch, rows_by_period):
+                self.assertEqual(len(rows), len(layout['content']))
+                for row, cells in zip(layout['content'], rows):
+                    self.assertEqual(len(cells), period['col_count'])
+                    i = period['col_index']
+                    row['cols'][i:i + period['col_count']] = cells
+        self.assertEqual(layout['content'], expected['content'])
+        self.assertEqual(instance.compute_period_columns([0]), [[]])
+        # refreshing a precomputed instance stores the new result
+        instance.precompute = True
+        instance.compute_layout()
+        Precomputed = self.env['mis.report.instance.precomputed']
+        Precomputed.search([('instance_id', '=', instance.id)]).write(
+            {'date': '2000-01-01 00:00:00'})
+        self.assertEqual(instance.compute_layout()['result']['as_of'],
+                         '2000-01-01 00:00:00')
+        res = instance.with_context(
+            mis_report_refresh=True).compute_layout()['result']
+        self.assertNotEqual(res['as_of'], '2000-01-01 00:00:00')
+        self.assertEqual(Precomputed._get_result(instance)['as_of'],
+                         res['as_of'])
@@ -15,6 +15,10 @@ class AddMisReportInstanceDashboard(models.TransientModel):
                                    string="Dashboard", required=True,
                                    domain="[('res_model', '=', "
                                           "'board.board')]")
+    precompute = fields.Boolean(
+        string='Precompute',
+        help='Compute the report in advance for the users of the '
+             'dashboard, so it opens without waiting.')
 
     @api.model
     def default_get(self, fields):
@@ -23,14 +27,20 @@ class AddMisReportInstanceDashboard(models.TransientModel):
             res = super(AddMisReportInstanceDashboard, self).default_get(
                 fields)
             # get report instance name
-            res['name'] = self.env['mis.report.instance'].browse(
-                self.env.context['active_id']).name
+            instance = self.env['mis.report.instance'].browse(
+                self.env.context['active_id'])
+            res['name'] = instance.name
+            res['precompute'] = instance.precompute
         return res
 
     @api.multi
     def action_add_to_dashboard(self):
         assert self.env.context.get('active_id', False), \
             "active_id missing in context"
+        instance = self.env['mis.report.instance'].browse(
+            self.env.context['active_id'])
+        if self.precompute != instance.precompute:
+            instance.precompute = self.precompute
         # create the act_window corresponding to this report
         self.env.ref('mis_builder.mis_report_instance_result_view_form')
         view = self.env.ref(